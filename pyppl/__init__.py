@@ -8,6 +8,7 @@ import sys
 import copy as pycopy
 from os import path
 from time import time
+from threading import Thread
 
 from .aggr import Aggr
 from .proc import Proc
@@ -17,7 +18,8 @@ from .channel import Channel
 from .parameters import params, Parameters, commands
 from .proctree import ProcTree
 from .exception import PyPPLProcFindError, PyPPLProcRelationError
-from .utils import Box, jsonLoads
+from .utils import Box, jsonLoads, Queue, QueueEmpty
+from .utils.safefs import SafeFs
 from . import logger, utils, runners
 
 VERSION = "2019.2.20"
@@ -108,11 +110,30 @@ class PyPPL (object):
 			del self.config['_flowchart']
 		self.fcconfig = fcconfig
 
+		schedconfig = {
+			# number of processes allowed to run at the same time, 0 for no limit
+			'nprocs': 1,
+			# global job slots shared by the processes running at the same time, 0 for no limit
+			'slots' : 0,
+			# host capacity (cores and memory) shared by the jobs of the processes running at the same time,
+			# against which the resources requested by the jobs are packed, 0 for no limit
+			'cores' : 0,
+			# mem in MB or with a unit (K, M, G, T), i.e. "64G"
+			'mem'   : 0,
+			# prioritize the processes and jobs on the critical path, estimated from the runtimes in last run
+			'critical': False
+		}
+		if '_sched' in self.config:
+			utils.dictUpdate(schedconfig, self.config['_sched'])
+			del self.config['_sched']
+		self.schedconfig = schedconfig
+
 		logconfig = {
 			'levels'   : 'normal',
 			'theme'    : True,
 			'lvldiff'  : [],
 			'pbar'     : 50,
+			'pbarfreq' : 10,
 			'shortpath': {},
 			# current directory instead of script directory
 			'file':    './%s%s.pyppl.log' % (
@@ -127,9 +148,11 @@ class PyPPL (object):
 			del self.config['_log']
 
 		Jobmgr.PBAR_SIZE = logconfig['pbar']
+		Jobmgr.PBAR_FREQ = logconfig['pbarfreq']
 		Proc.SHORTPATH.update(logconfig['shortpath'] or {})
 		logconfig['logfile'] = logconfig['file']
 		del logconfig['pbar']
+		del logconfig['pbarfreq']
 		del logconfig['file']
 		del logconfig['shortpath']
 
@@ -260,6 +283,84 @@ class PyPPL (object):
 			logger.logger.debug('* %s', ' -> '.join(pt))
 		return self
 
+	def _runProc(self, proc, profile):
+		"""
+		Run a single process
+		@params:
+			`proc`   : The process
+			`profile`: the profile used to run
+		"""
+		if proc.origin != proc.id:
+			name = '{} ({}): {}'.format(proc.name(True), proc.origin, proc.desc)
+		else:
+			name = '{}: {}'.format(proc.name(True), proc.desc)
+		#nlen = max(85, len(name) + 3)
+		#logger.logger.info ('[PROCESS] +' + '-'*(nlen-3) + '+')
+		#logger.logger.info ('[PROCESS] |%s%s|' % (name, ' '*(nlen - 3 - len(name))))
+		decorlen = max(80, len(name))
+		logger.logger.info ('-' * decorlen, extra = {'loglevel': 'PROCESS'})
+		logger.logger.info (name, extra = {'loglevel': 'PROCESS'})
+		logger.logger.info ('-' * decorlen, extra = {'loglevel': 'PROCESS'})
+		logger.logger.info (
+			'%s => %s => %s', 
+			ProcTree.getPrevStr(proc), 
+			proc.name(), 
+			ProcTree.getNextStr(proc), 
+			extra = {'loglevel': 'DEPENDS', 'proc': proc.id}
+		)
+		proc.run(profile, pycopy.deepcopy(self.config))
+
+	def _runConcurrently(self, profile):
+		"""
+		Run the processes concurrently.
+		Every process ready to run (all processes it depends on have done) is started in a thread,
+		with at most `nprocs` processes running at the same time.
+		@params:
+			`profile`: the profile used to run
+		"""
+		nprocs  = self.schedconfig['nprocs']
+		doneQ   = Queue()
+		running = set()
+		failed  = None
+
+		def runProc(proc):
+			"""Run a process in a thread and report when it's done"""
+			try:
+				self._runProc(proc, profile)
+				doneQ.put((proc, None))
+			# SystemExit raised when a process fails
+			except BaseException as ex:
+				doneQ.put((proc, ex))
+
+		try:
+			while True:
+				if not failed:
+					for proc in self.tree.getReadyToRun(nprocs - len(running) if nprocs else None):
+						thread = Thread(target = runProc, args = (proc, ))
+						thread.daemon = True
+						thread.start()
+						running.add(proc)
+				if not running:
+					break
+				try:
+					proc, ex = doneQ.get(timeout = 1)
+				except QueueEmpty:
+					continue
+				running.remove(proc)
+				if ex is None:
+					ProcTree.setDone(proc)
+				elif not failed:
+					failed = ex
+					# stop the other processes
+					Jobmgr.killAll()
+		except KeyboardInterrupt:
+			logger.logger.warning('Ctrl-C detected, quitting pipeline ...')
+			Jobmgr.killAll()
+			sys.exit(1)
+
+		if failed:
+			raise failed
+
 	def run (self, profile = 'default'):
 		"""
 		Run the pipeline
@@ -269,31 +370,24 @@ class PyPPL (object):
 			The pipeline object itself.
 		"""
 		timer     = time()
+		# the directories could be changed since last run
+		SafeFs._dirmtimeForget()
 
-		#dftconfig = self._getProfile(profile)
-		proc = self.tree.getNextToRun()
-		while proc:
-			if proc.origin != proc.id:
-				name = '{} ({}): {}'.format(proc.name(True), proc.origin, proc.desc)
-			else:
-				name = '{}: {}'.format(proc.name(True), proc.desc)
-			#nlen = max(85, len(name) + 3)
-			#logger.logger.info ('[PROCESS] +' + '-'*(nlen-3) + '+')
-			#logger.logger.info ('[PROCESS] |%s%s|' % (name, ' '*(nlen - 3 - len(name))))
-			decorlen = max(80, len(name))
-			logger.logger.info ('-' * decorlen, extra = {'loglevel': 'PROCESS'})
-			logger.logger.info (name, extra = {'loglevel': 'PROCESS'})
-			logger.logger.info ('-' * decorlen, extra = {'loglevel': 'PROCESS'})
-			logger.logger.info (
-				'%s => %s => %s', 
-				ProcTree.getPrevStr(proc), 
-				proc.name(), 
-				ProcTree.getNextStr(proc), 
-				extra = {'loglevel': 'DEPENDS', 'proc': proc.id}
-			)
-			proc.run(profile, pycopy.deepcopy(self.config))
-
+		Jobmgr.SLOTS = self.schedconfig['slots']
+		Jobmgr.RESOURCES = {
+			'cores': int(self.schedconfig['cores']),
+			'mem'  : utils.parseMem(self.schedconfig['mem'])
+		}
+		if self.schedconfig['critical']:
+			self.tree.setCritical(Proc._estimate)
+		if self.schedconfig['nprocs'] != 1:
+			self._runConcurrently(profile)
+		else:
+			#dftconfig = self._getProfile(profile)
 			proc = self.tree.getNextToRun()
+			while proc:
+				self._runProc(proc, profile)
+				proc = self.tree.getNextToRun()
 
 		unran = self.tree.unranProcs()
 		if unran:
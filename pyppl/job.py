@@ -4,13 +4,15 @@ job module for PyPPL
 import sys
 import re
 import json
-from os import path, makedirs, utime, listdir
+from hashlib import md5
+from os import path, makedirs, utime, listdir, readlink, symlink, stat
 from glob import glob
 from collections import OrderedDict
 from datetime import datetime
 from threading import Lock
+from subprocess import list2cmdline
 from .logger import logger
-from .utils import cmd, safefs, string_types, briefPath, jsonLoads
+from .utils import cmd, safefs, string_types, briefPath, jsonLoads, parseMem
 from .utils.box import Box
 from .exception import JobInputParseError, JobOutputParseError
 
@@ -69,6 +71,12 @@ class Job(object):
 
 	LOGLOCK = Lock()
 
+	# a process could have a lot of jobs, the paths and data are derived when they are used
+	__slots__ = (
+		'index', 'status', 'config', 'dir', 'fout', 'ferr', 'lastout', 'lasterr', 'logger', 'ntry',
+		'resources', 'runner', '_rc', '_pid', '_sig', '_shkey', '_input', '_output', '_data'
+	)
+
 	def __init__(self, index, config):
 		"""
 		Initiate a job
@@ -80,42 +88,118 @@ class Job(object):
 		self.status    = Job.STATUS_INITIATED
 		self.config    = config
 		self.dir       = path.abspath(path.join (config['workdir'], str(index + 1)))
-		self.indir     = path.join(self.dir, "input")
-		self.outdir    = path.join(self.dir, "output")
-		self.script    = path.join(self.dir, "job.script")
-		self.rcfile    = path.join(self.dir, "job.rc")
-		self.outfile   = path.join(self.dir, "job.stdout")
-		self.errfile   = path.join(self.dir, "job.stderr")
 		self.fout      = None
 		self.ferr      = None
 		self.lastout   = ''
 		self.lasterr   = ''
-		self.cachefile = path.join(self.dir, "job.cache")
-		self.cachedir  = path.join(self.outdir, '.pypplcache')
-		self.pidfile   = path.join(self.dir, "job.pid")
 		self.logger    = config.get('logger', logger)
 		self.ntry      = 0
-		self.input     = {}
-		# need to pass this to next procs, so have to keep order
-		self.output    = OrderedDict()
-		self.data      = Box(
-			job = Box(
-				index    = self.index,
-				indir    = self.indir,
-				outdir   = self.outdir,
-				dir      = self.dir,
-				outfile  = self.outfile,
-				errfile  = self.errfile,
-				pidfile  = self.pidfile,
-				cachedir = self.cachedir
-			),
-			i = Box(),
-			o = Box()
-		)
-		self.data.update(self.config.get('procvars', {}))
+		# the resources requested, i.e. {'cores': 1, 'mem': 0 (MB)}
+		self.resources = {}
 		self.runner = None
 		self._rc    = None
 		self._pid   = None
+		# the signature checked by isTrulyCached, to be stored by cache
+		self._sig   = None
+		# the key in the shared cache, see sharedKey
+		self._shkey = None
+		# created when they are used (the job is built), see the properties
+		self._input  = None
+		self._output = None
+		self._data   = None
+
+	@property
+	def indir(self):
+		"""The input directory"""
+		return path.join(self.dir, "input")
+
+	@property
+	def outdir(self):
+		"""The output directory"""
+		return path.join(self.dir, "output")
+
+	@property
+	def script(self):
+		"""The script file"""
+		return path.join(self.dir, "job.script")
+
+	@property
+	def rcfile(self):
+		"""The file of the return code"""
+		return path.join(self.dir, "job.rc")
+
+	@property
+	def outfile(self):
+		"""The file of the stdout"""
+		return path.join(self.dir, "job.stdout")
+
+	@property
+	def errfile(self):
+		"""The file of the stderr"""
+		return path.join(self.dir, "job.stderr")
+
+	@property
+	def cachefile(self):
+		"""The file of the signature (written by earlier versions)"""
+		return path.join(self.dir, "job.cache")
+
+	@property
+	def cachedir(self):
+		"""The cache directory in the output directory"""
+		return path.join(self.dir, "output", ".pypplcache")
+
+	@property
+	def pidfile(self):
+		"""The file of the job id"""
+		return path.join(self.dir, "job.pid")
+
+	@property
+	def input(self):
+		"""The input of the job"""
+		if self._input is None:
+			self._input = {}
+		return self._input
+
+	@input.setter
+	def input(self, value):
+		self._input = value
+
+	@property
+	def output(self):
+		"""The output of the job"""
+		if self._output is None:
+			# need to pass this to next procs, so have to keep order
+			self._output = OrderedDict()
+		return self._output
+
+	@output.setter
+	def output(self, value):
+		self._output = value
+
+	@property
+	def data(self):
+		"""The data to render the templates"""
+		if self._data is None:
+			self._data = Box(
+				job = Box(
+					index    = self.index,
+					indir    = self.indir,
+					outdir   = self.outdir,
+					dir      = self.dir,
+					outfile  = self.outfile,
+					errfile  = self.errfile,
+					pidfile  = self.pidfile,
+					cachedir = self.cachedir
+				),
+				i = Box(),
+				o = Box()
+			)
+			self._data.update(self.config.get('procvars', {}))
+		return self._data
+
+	@data.setter
+	def data(self, value):
+		self._data = value
 
 	def showError (self, totalfailed):
 		"""
@@ -271,10 +355,15 @@ class Job(object):
 			if self.index == 0:
 				self.report()
 			self._prepScript()
+			self._prepResources()
 			# check cache
 			if self.isTrulyCached() or self.isExptCached():
 				self.status = Job.STATUS_DONECACHED
 				self.done(export = self.config['acache'])
+			elif self.isSharedCached():
+				# the output files have not been exported by this pipeline
+				self.status = Job.STATUS_DONECACHED
+				self.done()
 			else:
 				self.runner = self.config['runner'](self)
 				self.status = Job.STATUS_BUILT
@@ -284,39 +373,41 @@ class Job(object):
 				f.write(str(format_exc()))
 			self.status = Job.STATUS_BUILTFAILED
 
-	def _linkInfile(self, orgfile):
+	def _linkInfile(self, orgfile, staged, links, index):
 		"""
-		Create links for input files
+		Create links for input files.
+		The link is named by the basename of the original file, or `[<n>]<basename>` if the basename
+		has been taken by a different file. The link is only created if it doesn't exist or it links
+		to some other file.
 		@params:
 			`orgfile`: The original input file
+			`staged` : The links staged in this build (name => original file)
+			`links`  : The links existing in the input directory (name => target, `None` if not a link)
+			`index`  : The names assigned in this build by basename (basename => [the last `<n>`, {file id => name}]),
+				so that the names are resolved without going through the links with the same basename.
 		@returns:
 			The link to the original file.
 		"""
 		basename = path.basename(orgfile)
-		infile   = path.join(self.indir, basename)
-		#return infile
-		safefs.SafeFs._link(orgfile, infile, overwrite = False)
-		#if safefs.SafeFs(infile, orgfile).samefile():
-		if path.samefile(infile, orgfile):
-			return infile
-
-		existInfiles = [fn for fn in listdir(self.indir) if fn.endswith(']' + basename)]
-		if not existInfiles:
-			num = 1
-		elif len(existInfiles) < 100:
-			num = 0
-			for eifile in existInfiles:
-				infile = path.join(self.indir, eifile)
-				#if safefs.SafeFs(eifile, orgfile).samefile():
-				if path.samefile(infile, orgfile):
-					return infile
-				n   = int(eifile[1:eifile.find(']')])
-				num = max(num, n) + 1
-		else: # pragma: no cover
-			num = max(int(eifile[1:eifile.find(']')]) for eifile in existInfiles) + 1
-
-		infile = path.join(self.indir, '[{}]{}'.format(num, basename))
-		safefs.SafeFs._link(orgfile, infile)
+		orgstat  = stat(orgfile)
+		# the same file as path.samefile tells
+		fileid   = (orgstat.st_dev, orgstat.st_ino)
+		names    = index.setdefault(basename, [0, {}])
+		if fileid in names[1]:
+			return path.join(self.indir, names[1][fileid])
+		name = basename
+		while name in staged:
+			names[0] += 1
+			name = '[{}]{}'.format(names[0], basename)
+		names[1][fileid] = name
+		staged[name] = orgfile
+
+		infile = path.join(self.indir, name)
+		if links.get(name) != orgfile:
+			if name in links:
+				safefs.SafeFs._remove(infile)
+			symlink(orgfile, infile)
+			links[name] = orgfile
 		return infile
 
 	def _prepInput (self):
@@ -324,8 +415,20 @@ class Job(object):
 		Prepare input, create link to input files and set other placeholders
 		"""
 		from . import Proc
-		safefs.SafeFs._remove(self.indir)
-		makedirs(self.indir)
+		# only the links changed are created or removed, 
+		# so that the input directory is not rewritten for the reruns and retries
+		links = {}
+		if path.isdir(self.indir) and not path.islink(self.indir):
+			for name in listdir(self.indir):
+				try:
+					links[name] = readlink(path.join(self.indir, name))
+				except OSError:
+					links[name] = None
+		else:
+			safefs.SafeFs._remove(self.indir)
+			makedirs(self.indir)
+		staged = {}
+		index  = {}
 
 		for key, val in self.config['input'].items():
 			self.input[key] = {}
@@ -344,7 +447,7 @@ class Job(object):
 
 					indata   = path.abspath(indata)
 					basename = path.basename(indata)
-					infile   = self._linkInfile(indata)
+					infile   = self._linkInfile(indata, staged, links, index)
 					if basename != path.basename(infile):
 						self.logger.warning ("Input file renamed: %s -> %s" % (basename, path.basename(infile)), extra = {
 							'proc'  : self.config['proc'],
@@ -391,7 +494,7 @@ class Job(object):
 
 						data     = path.abspath(data)
 						basename = path.basename(data)
-						infile   = self._linkInfile(data)
+						infile   = self._linkInfile(data, staged, links, index)
 						if basename != path.basename(infile):
 							self.logger.warning('Input file renamed: {} -> {}'.format(basename, path.basename(infile)), extra = {
 								'proc'  : self.config['proc'],
@@ -410,6 +513,11 @@ class Job(object):
 				self.input[key]['data'] = indata
 				self.data['i'][key]    = indata
 
+		# links left by last build
+		for name in links:
+			if name not in staged:
+				safefs.SafeFs._remove(path.join(self.indir, name))
+
 	def _prepOutput (self):
 		"""
 		Build the output data.
@@ -473,6 +581,14 @@ class Job(object):
 			with open (self.script, 'w') as f:
 				f.write(script)
 
+	def _prepResources (self):
+		"""
+		Render the resources requested by the job
+		"""
+		for key, val in self.config.get('resources', {}).items():
+			val = val.render(self.data)
+			self.resources[key] = parseMem(val) if key == 'mem' else int(float(val))
+
 	@property
 	def rc(self):
 		"""
@@ -520,6 +636,22 @@ class Job(object):
 		with open(self.pidfile, 'w') as f:
 			f.write(str(val))
 
+	@staticmethod
+	def lastRuntime(jobdir):
+		"""
+		Get the runtime of a job from its last run: from the time it was submitted (pidfile written)
+		to the time it ended (rcfile written).
+		@params:
+			`jobdir`: The directory of the job
+		@returns:
+			The runtime in seconds, `None` if unknown
+		"""
+		try:
+			runtime = path.getmtime(path.join(jobdir, 'job.rc')) - path.getmtime(path.join(jobdir, 'job.pid'))
+		except OSError:
+			return None
+		return runtime if runtime >= 0 else None
+
 	def isTrulyCached (self):
 		"""
 		Check whether a job is truly cached (by signature)
@@ -527,31 +659,35 @@ class Job(object):
 		if not self.config['cache']:
 			return False
 		from . import Proc
-		if not path.exists (self.cachefile):
-			self.logger.debug("Not cached as cache file not exists.", extra = {
-				'level2': "CACHE_SIGFILE_NOTEXISTS",
-				'jobidx': self.index,
-				'joblen': self.config['procsize'],
-				'pbar'  : False,
-				'proc'  : self.config['proc']
-			})
-			return False
+		sigstore = self.config.get('sigstore')
+		sigOld   = sigstore.get(self.index) if sigstore else None
+		# not in the signature store, try the cache file of the job (written by earlier versions)
+		if sigOld is None:
+			if not path.exists (self.cachefile):
+				self.logger.debug("Not cached as cache file not exists.", extra = {
+					'level2': "CACHE_SIGFILE_NOTEXISTS",
+					'jobidx': self.index,
+					'joblen': self.config['procsize'],
+					'pbar'  : False,
+					'proc'  : self.config['proc']
+				})
+				return False
 
-		with open (self.cachefile, 'rb') as f:
-			sig = f.read().decode()
+			with open (self.cachefile, 'rb') as f:
+				sig = f.read().decode()
 
-		if not sig:
-			self.logger.debug("Not cached because previous signature is empty.", extra = {
-				'level2': "CACHE_EMPTY_PREVSIG",
-				'jobidx': self.index,
-				'joblen': self.config['procsize'],
-				'pbar'  : False,
-				'proc'  : self.config['proc']
-			})
-			return False
+			if not sig:
+				self.logger.debug("Not cached because previous signature is empty.", extra = {
+					'level2': "CACHE_EMPTY_PREVSIG",
+					'jobidx': self.index,
+					'joblen': self.config['procsize'],
+					'pbar'  : False,
+					'proc'  : self.config['proc']
+				})
+				return False
 
-		sigOld = jsonLoads(sig)
-		sigNow = self.signature()
+			sigOld = jsonLoads(sig)
+		sigNow = self.signature(self.config.get('filesigs'))
 		if not sigNow:
 			self.logger.debug("Not cached because current signature is empty.", extra = {
 				'level2': "CACHE_EMPTY_CURRSIG",
@@ -562,6 +698,18 @@ class Job(object):
 			})
 			return False
 
+		def isChanged(otime, ntime):
+			"""Whether a file is changed: newer by the modified time, or different by the content hash"""
+			if isinstance(otime, (int, float)) and isinstance(ntime, (int, float)):
+				return ntime > otime
+			return ntime != otime
+
+		def showTime(ftime):
+			"""Show the modified time or the content hash of a file in logs"""
+			if isinstance(ftime, (int, float)):
+				return '{} ({})'.format(ftime, datetime.fromtimestamp(ftime))
+			return ftime
+
 		def compareVar(osig, nsig, key, logkey):
 			"""Compare var in signature"""
 			for k in osig.keys():
@@ -587,7 +735,7 @@ class Job(object):
 			for k in osig.keys():
 				ofile, otime = osig[k]
 				nfile, ntime = nsig[k]
-				if nfile == ofile and ntime <= otime: continue
+				if nfile == ofile and not isChanged(otime, ntime): continue
 				if nfile != ofile:
 					self.logger.debug((
 						"Not cached because {key} file({k}) is different:\n" +
@@ -601,19 +749,17 @@ class Job(object):
 						'proc'  : self.config['proc']
 					})
 					return False
-				if timekey and ntime > otime:
+				if timekey and isChanged(otime, ntime):
 					self.logger.debug((
 						"Not cached because {key} file({k}) is newer: {ofile}\n" +
-						"...... - Previous: {otime} ({transotime})\n" +
-						"...... - Current : {ntime} ({transntime})"
+						"...... - Previous: {otime}\n" +
+						"...... - Current : {ntime}"
 					).format(
-						key        = key,
-						k          = k,
-						ofile      = ofile,
-						otime      = otime,
-						transotime = datetime.fromtimestamp(otime),
-						ntime      = ntime,
-						transntime = datetime.fromtimestamp(ntime)
+						key   = key,
+						k     = k,
+						ofile = ofile,
+						otime = showTime(otime),
+						ntime = showTime(ntime)
 					), extra = {
 						'level2': timekey,
 						'jobidx': self.index,
@@ -640,7 +786,7 @@ class Job(object):
 						nfile, ntime = None, None
 					else:
 						nfile, ntime = nval[i]
-					if nfile == ofile and ntime <= otime: continue
+					if nfile == ofile and not isChanged(otime, ntime): continue
 					if nfile != ofile:
 						self.logger.debug((
 							"Not cached because file {i} is different for {key} files({k}):\n" +
@@ -660,20 +806,18 @@ class Job(object):
 							'proc'  : self.config['proc']
 						})
 						return False
-					if timekey and ntime > otime:
+					if timekey and isChanged(otime, ntime):
 						self.logger.debug((
 							"Not cached because file {i} is newer for {key} files({k}): {ofile}\n" +
-							"...... - Previous: {otime} ({transotime})\n" +
-							"...... - Current : {ntime} ({transntime})"
+							"...... - Previous: {otime}\n" +
+							"...... - Current : {ntime}"
 						).format(
-							i          = i + 1,
-							key        = key,
-							k          = k,
-							ofile      = ofile,
-							otime      = otime,
-							transotime = datetime.fromtimestamp(otime),
-							ntime      = ntime,
-							transntime = datetime.fromtimestamp(ntime)
+							i     = i + 1,
+							key   = key,
+							k     = k,
+							ofile = ofile,
+							otime = showTime(otime),
+							ntime = showTime(ntime)
 						), extra = {
 							'level2': timekey,
 							'jobidx': self.index,
@@ -735,7 +879,8 @@ class Job(object):
 			'output dir',
 			'CACHE_SIGOUTDIR_DIFF'
 		): return False
-		self.rc = 0
+		self.rc   = 0
+		self._sig = sigNow
 		#safefs.move(self.outfile + '.bak', self.outfile)
 		#safefs.move(self.errfile + '.bak', self.errfile)
 		return True
@@ -859,16 +1004,115 @@ class Job(object):
 		#safefs.move(self.errfile + '.bak', self.errfile)
 		return True
 
+	def sharedKey (self):
+		"""
+		Calculate the key of the job in the shared cache (`utils.sharedcache.SharedCache`).
+		The paths of the job directory are replaced in the script, the output and the expectation,
+		and the input files are identified by their content, so that the same job in other pipelines
+		(or other processes) has the same key.
+		@returns:
+			The key, `None` if any of the input files cannot be hashed.
+		"""
+		from . import Proc
+		hashes = self.config['sharedcache'].hashes
+		normalize = lambda data: data.replace(self.dir, '{{job.dir}}') \
+			if isinstance(data, string_types) else data
+
+		with open(self.script) as f:
+			script = normalize(f.read())
+		inputs = {}
+		for key, val in self.input.items():
+			if val['type'] in Proc.IN_VARTYPE:
+				inputs[key] = val['data']
+				continue
+			infiles = [val['data']] if val['type'] in Proc.IN_FILETYPE else val['data']
+			inputs[key] = []
+			for infile in infiles:
+				digest = hashes.filehash(infile) if infile else ''
+				if digest is None:
+					return None
+				inputs[key].append([normalize(infile), digest])
+		outputs = [
+			[key, val['type'], normalize(val['data'])] for key, val in self.output.items()
+		]
+		return md5(json.dumps({
+			'script': script,
+			'input' : inputs,
+			'output': outputs,
+			'expect': normalize(self.config['expect'].render(self.data))
+		}, sort_keys = True, default = repr).encode('utf-8')).hexdigest()
+
+	def _sharedOutfiles (self):
+		"""
+		Get the output files of the job to be stored in the shared cache
+		@returns:
+			The paths of the output files
+		"""
+		from . import Proc
+		return [out['data'] for out in self.output.values() if out['type'] not in Proc.OUT_VARTYPE]
+
+	def isSharedCached (self):
+		"""
+		Take the output files from the shared cache if the job has been done by any pipeline sharing it.
+		@returns:
+			`True` if succeed, otherwise `False`
+		"""
+		shared = self.config.get('sharedcache')
+		if not shared:
+			return False
+		self._shkey = self.sharedKey()
+		if not self._shkey or not shared.fetch(self._shkey, self.outdir, self._sharedOutfiles()):
+			return False
+		safefs.SafeFs._dirmtimeForget(self.outdir)
+		self.logger.debug("Output files taken from shared cache: %s" % shared.entry(self._shkey), extra = {
+			'level2': "SHARED_CACHE_TAKEN",
+			'jobidx': self.index,
+			'joblen': self.config['procsize'],
+			'pbar'  : False,
+			'proc'  : self.config['proc']
+		})
+		self.rc = 0
+		return True
+
+	def cacheShared (self):
+		"""
+		Store the output files of the job to the shared cache
+		"""
+		shared = self.config.get('sharedcache')
+		if not shared:
+			return
+		if not self._shkey:
+			self._shkey = self.sharedKey()
+		if self._shkey and shared.store(self._shkey, self.outdir, self._sharedOutfiles()):
+			self.logger.debug("Output files stored to shared cache: %s" % shared.entry(self._shkey), extra = {
+				'level2': "SHARED_CACHE_STORED",
+				'jobidx': self.index,
+				'joblen': self.config['procsize'],
+				'pbar'  : False,
+				'proc'  : self.config['proc']
+			})
+
 	def cache (self):
 		"""
 		Truly cache the job (by signature)
 		"""
 		if not self.config['cache']:
 			return
-		sig  = self.signature()
-		if sig:
+		# the signature checked is still valid for a cached job, unless its output files are exported
+		sig, self._sig = self._sig, None
+		if not sig or self.config.get('acache'):
+			# the output directories have been changed by the job
+			safefs.SafeFs._dirmtimeForget(self.outdir)
+			sig = self.signature()
+		if not sig:
+			return
+		if self.config.get('sigstore'):
+			# don't append the same signature again
+			if self.config['sigstore'].get(self.index) != sig:
+				self.config['sigstore'].set(self.index, sig)
+		else:
 			with open (self.cachefile, 'w') as f:
-				f.write (sig if not sig else json.dumps(sig))
+				f.write (json.dumps(sig))
 
 	def reset (self):
 		"""
@@ -878,6 +1122,9 @@ class Job(object):
 		#self.logger.info('Resetting job #%s ...' % self.index, 'debug', 'JOB_RESETTING')
 		retry    = self.ntry
 		retrydir = path.join(self.dir, 'retry.' + str(retry))
+		safefs.SafeFs._dirmtimeForget(self.outdir)
+		self._sig   = None
+		self._shkey = None
 		
 		#cleanup retrydir
 		if retry:
@@ -1024,19 +1271,33 @@ class Job(object):
 		@params:
 			`export`: Whether do export
 		"""
+		# before the output files are exported (they may be moved),
+		# not for the cached jobs, which have been stored, or taken from the shared cache
+		if self.status != Job.STATUS_DONECACHED:
+			self.cacheShared()
 		if export:
 			self.export()
 		self.cache()
 
-	def signature (self):
+	def signature (self, filesigs = None):
 		"""
 		Calculate the signature of the job based on the input/output and the script
+		@params:
+			`filesigs`: The signatures of the input/output files shared by the jobs (`sigstore.FileSigs`).
+				Calculated for the job if not given.
 		@returns:
 			The signature of the job
 		"""
 		from . import Proc
 		ret = {}
-		sig = safefs.SafeFs._filesig(self.script)
+		# the content hashes instead of the modified time
+		hashes = self.config.get('hashes')
+		if filesigs:
+			filesig = filesigs.get
+		else:
+			filesig = lambda filepath: safefs.SafeFs._filesig(
+				filepath, dirsig = self.config['dirsig'], hashes = hashes)
+		sig = safefs.SafeFs._filesig(self.script, hashes = hashes)
 		if not sig:
 			self.logger.debug('Empty signature because of script file: %s.' % (self.script), extra = {
 				'level2': 'CACHE_EMPTY_CURRSIG',
@@ -1062,7 +1323,7 @@ class Job(object):
 			if val['type'] in Proc.IN_VARTYPE:
 				ret['i'][Proc.IN_VARTYPE[0]][key] = val['data']
 			elif val['type'] in Proc.IN_FILETYPE:
-				sig = safefs.SafeFs._filesig(val['data'], dirsig = self.config['dirsig'])
+				sig = filesig(val['data'])
 				if not sig:
 					self.logger.debug('Empty signature because of input file: %s.' % (val['data']), extra = {
 						'level2': 'CACHE_EMPTY_CURRSIG',
@@ -1076,7 +1337,7 @@ class Job(object):
 			elif val['type'] in Proc.IN_FILESTYPE:
 				ret['i'][Proc.IN_FILESTYPE[0]][key] = []
 				for infile in sorted(val['data']):
-					sig = safefs.SafeFs._filesig(infile, dirsig = self.config['dirsig'])
+					sig = filesig(infile)
 					if not sig:
 						self.logger.debug('Empty signature because of one of input files: %s.' % (infile), extra = {
 							'level2': 'CACHE_EMPTY_CURRSIG',
@@ -1092,7 +1353,7 @@ class Job(object):
 			if val['type'] in Proc.OUT_VARTYPE:
 				ret['o'][Proc.OUT_VARTYPE[0]][key] = val['data']
 			elif val['type'] in Proc.OUT_FILETYPE:
-				sig = safefs.SafeFs._filesig(val['data'], dirsig = self.config['dirsig'])
+				sig = filesig(val['data'])
 				if not sig:
 					self.logger.debug('Empty signature because of output file: %s.' % (val['data']), extra = {
 						'level2': 'CACHE_EMPTY_CURRSIG',
@@ -1104,7 +1365,7 @@ class Job(object):
 					return ''
 				ret['o'][Proc.OUT_FILETYPE[0]][key] = sig
 			elif val['type'] in Proc.OUT_DIRTYPE:
-				sig = safefs.SafeFs._filesig(val['data'], dirsig = self.config['dirsig'])
+				sig = filesig(val['data'])
 				if not sig:
 					self.logger.debug('Empty signature because of output dir: %s.' % (val['data']), extra = {
 						'level2': 'CACHE_EMPTY_CURRSIG',
@@ -1147,22 +1408,168 @@ class Job(object):
 		)
 		return False
 
-	def poll(self):
+	@staticmethod
+	def _toSubmit(jobs):
 		"""
-		Check the status of a running job
+		Get the jobs to submit at once (not running), and reset them
+		@params:
+			`jobs`: The jobs
+		@returns:
+			The jobs to submit
 		"""
-		if not path.isfile(self.errfile) or not path.isfile(self.outfile):
-			self.status = Job.STATUS_RUNNING
-		elif self.rc != Job.RC_NOTGENERATE:
-			self._flush(end = True)
-			if self.succeed():
-				self.done()
-				self.status = Job.STATUS_DONE
+		tosubmit = []
+		for job in jobs:
+			if job.runner.isRunning():
+				job.logger.info('is already running at {pid}, skip submission.'.format(pid = job.pid), extra = {
+					'proc'    : job.config['proc'],
+					'jobidx'  : job.index,
+					'joblen'  : job.config['procsize'],
+					'loglevel': 'submit',
+					'pbar'    : False,
+				})
 			else:
-				self.status = Job.STATUS_DONEFAILED
-		else: # running
-			self._flush()
+				job.reset()
+				tosubmit.append(job)
+		return tosubmit
+
+	@staticmethod
+	def submitArray(jobs):
+		"""
+		Submit the jobs at once as an array job
+		@params:
+			`jobs`: The jobs to submit, using the same runner
+		@returns:
+			`True` if all the jobs submitted else `False`
+		"""
+		tosubmit = Job._toSubmit(jobs)
+		if not tosubmit:
+			return True
+
+		rs = tosubmit[0].runner.submitArray([job.runner for job in tosubmit])
+		if rs.rc == 0:
+			return True
+		tosubmit[0].logger.error(
+			'Submission of {n} jobs as an array job failed (rc = {rc}, cmd = {cmd})'.format(
+				n = len(tosubmit), rc = rs.rc, cmd = rs.cmd),
+			extra = {
+				'level2': 'SUBMISSION_FAIL',
+				'jobidx'  : tosubmit[0].index,
+				'joblen'  : tosubmit[0].config['procsize'],
+				'pbar'    : False,
+				'proc'    : tosubmit[0].config['proc']
+			}
+		)
+		return False
+
+	@staticmethod
+	def submitChunk(jobs, forks = 1):
+		"""
+		Submit the jobs at once as a chunk: one job of the runner running the scripts of the jobs,
+		`forks` of them at the same time.
+		The first job of the chunk is run in the foreground, so its stdout, stderr and rc are handled 
+		by the runner as usual, the others write their own stdout, stderr and rc files.
+		All the jobs take the pid of the chunk.
+		@params:
+			`jobs` : The jobs to submit, using the same runner
+			`forks`: Number of jobs to run at the same time in the chunk
+		@returns:
+			`True` if all the jobs submitted else `False`
+		"""
+		tosubmit = Job._toSubmit(jobs)
+		if not tosubmit:
+			return True
+
+		first  = tosubmit[0]
+		runner = first.runner
+		if len(tosubmit) > 1:
+			forks    = max(forks, 1)
+			lanes    = [tosubmit[i::forks] for i in range(forks)]
+			rcfiles  = [list2cmdline([job.rcfile]) for job in tosubmit[1:]]
+			chunksrc = [
+				'#!/usr/bin/env bash',
+				'# jobs #%s of %s' % (', #'.join(str(job.index + 1) for job in tosubmit), first.config['proc']),
+				'',
+				# the jobs killed with the chunk
+				'trap \'status=$?; for rcfile in %s; do [[ -e "$rcfile" ]] || echo $status > "$rcfile"; done\' EXIT' % \
+					' '.join(rcfiles),
+				# don't quit on Ctrl-C leaving the jobs running in background, they are killed as a tree
+				'trap \'\' INT',
+				''
+			]
+			def runJob(job):
+				"""The command to run a job of the chunk"""
+				return '%s >%s 2>%s; echo $? >%s' % (
+					job.runner.cmd2run, 
+					list2cmdline([job.outfile]), 
+					list2cmdline([job.errfile]), 
+					list2cmdline([job.rcfile])
+				)
+			for lane in lanes[1:]:
+				if not lane:
+					continue
+				chunksrc.append('{')
+				chunksrc.extend('\t' + runJob(job) for job in lane)
+				chunksrc.append('} &')
+			chunksrc.append(first.runner.cmd2run)
+			chunksrc.append('rc=$?')
+			chunksrc.extend(runJob(job) for job in lanes[0][1:])
+			chunksrc.append('wait')
+			chunksrc.append('exit $rc')
+
+			chunkfile = path.join(first.dir, 'job.chunk')
+			with open(chunkfile, 'w') as f:
+				f.write('\n'.join(chunksrc) + '\n')
+
+			runner = first.config['runner'](_ChunkJob(first, chunkfile))
+			runner.onexit = first.runner.onexit
+			# i.e. the server slot reserved for the first job
+			first.runner.lend(runner)
+		rs = runner.submit()
+		if rs.rc == 0:
+			for job in tosubmit[1:]:
+				job.pid = first.pid
+			return True
+		first.logger.error(
+			'Submission of {n} jobs as a chunk failed (rc = {rc}, cmd = {cmd})'.format(
+				n = len(tosubmit), rc = rs.rc, cmd = rs.cmd),
+			extra = {
+				'level2': 'SUBMISSION_FAIL',
+				'jobidx'  : first.index,
+				'joblen'  : first.config['procsize'],
+				'pbar'    : False,
+				'proc'    : first.config['proc']
+			}
+		)
+		return False
+
+	def checkRunning(self):
+		"""
+		Check whether the job is still running (rcfile not generated) without finishing it.
+		The stdout/stderr will be flushed if it is.
+		@returns:
+			`True` if the job is still running else `False`
+		"""
+		if not path.isfile(self.errfile) or not path.isfile(self.outfile):
 			self.status = Job.STATUS_RUNNING
+			return True
+		if self.rc != Job.RC_NOTGENERATE:
+			return False
+		self._flush()
+		self.status = Job.STATUS_RUNNING
+		return True
+
+	def poll(self):
+		"""
+		Check the status of a running job
+		"""
+		if self.checkRunning():
+			return
+		self._flush(end = True)
+		if self.succeed():
+			self.done()
+			self.status = Job.STATUS_DONE
+		else:
+			self.status = Job.STATUS_DONEFAILED
 
 	def _flush (self, end = False):
 		"""
@@ -1250,3 +1657,25 @@ class Job(object):
 		except Exception:
 			pass
 		self.status = Job.STATUS_KILLED
+
+class _ChunkJob(object):
+	"""
+	The first job of a chunk, as seen by the runner submitting the chunk: 
+	everything is the job's but the script, which is the script of the chunk.
+	"""
+
+	def __init__(self, job, script):
+		"""
+		Constructor
+		@params:
+			`job`   : The first job of the chunk
+			`script`: The script of the chunk
+		"""
+		self.__dict__['job']    = job
+		self.__dict__['script'] = script
+
+	def __getattr__(self, name):
+		return getattr(self.job, name)
+
+	def __setattr__(self, name, value):
+		setattr(self.job, name, value)
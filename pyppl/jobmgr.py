@@ -1,10 +1,13 @@
-
 """
 jobmgr module for PyPPL
 """
 import random
-from time import sleep
+from os import path
+from time import time
+from threading import Event
+from .utils import QueueEmpty
 from .utils.taskmgr import PQueue, ThreadPool, Lock
+from .utils.fsnotify import Watcher
 from .job import Job
 from .logger import logger
 from .exception import JobFailException, JobSubmissionException, JobBuildingException
@@ -12,12 +15,44 @@ from .exception import JobFailException, JobSubmissionException, JobBuildingExce
 class Jobmgr(object):
 	"""
 	A job manager for PyPPL
+	Jobs move between explicit state queues:
+		- `queue`  : Jobs with something to do (build, submit or finish), consumed by the workers
+		- `sbmQ`   : Built (or retrying) jobs waiting for a submission slot
+		- `running`: Submitted jobs, checked by the completion watcher
+	Jobs in flight (submitting, submitted or running) are tracked in `inflight` when they are dispatched
+	and released, so that telling whether jobs can be submitted takes constant time.
+	A job only goes back to `queue` when an event happens to it (built, slot available, completed),
+	so that the running jobs do not occupy the workers.
+	If `config['feed']` is given (stream mode), jobs are put into `queue` by the feeder when they are ready,
+	instead of all at the beginning.
+	If the runner supports array jobs (`runner.array` > 0), the built jobs are dispatched in batches
+	(up to `runner.array` jobs), and each batch is submitted as one array job.
+	If `config['chunk']` is given, the batches (up to `chunk['size']` jobs) are submitted as chunks
+	(see `Job.submitChunk`) instead, and the jobs of a chunk share the slot of the first one.
+	If `config['priority']` is given (the estimated remaining critical path length of the process),
+	the jobs that took longer in last run are built and submitted first, and when slots are released,
+	the managers with higher priority take them first.
+	The directories of the running jobs are watched (see `utils.fsnotify`) if possible, so that a job
+	is checked as soon as its `job.rc` is written, and polled only at the longest interval of its runner.
+	Jobs also take the resources they request (`job.resources`, i.e. cores and memory) from the host
+	capacity budget (`RESOURCES`) when dispatched, so that the jobs are packed against the budget 
+	instead of just being counted.
 
 	@static variables
 		`PBAR_SIZE`:  The length of the progressbar
 		`PBAR_MARKS`: The marks for different job status
 		`PBAR_LEVEL`: The log levels for different job status
+		`PBAR_ORDER`: The priority of job status to show in a cell of the progressbar
+		`PBAR_FREQ` : Max times to render the progressbar per second (0 for no limit)
 		`SMBLOCK`   : The lock used to relatively safely to tell whether jobs can be submitted.
+		`INTERVAL`  : The interval for the workers and the watcher to wait for something to do.
+			A running job is checked at the intervals told by its runner (see `Runner.nextPoll`)
+		`FSNOTIFY`  : Whether to watch the directories of the running jobs for `job.rc`
+		`SLOTS`     : The global job slots shared by the processes running at the same time (0 for no limit)
+		`INUSE`     : The number of global job slots in use
+		`RESOURCES` : The host capacity budget shared by the processes running at the same time (0 for no limit)
+		`RESINUSE`  : The resources in use
+		`MANAGERS`  : The running job managers
 	"""
 	PBAR_SIZE  = 50
 	PBAR_MARKS = {
@@ -54,8 +89,37 @@ class Jobmgr(object):
 		Job.STATUS_KILLING     : 'KILLING',
 		Job.STATUS_KILLED      : 'KILLING',
 	}
+	# the priority of the status to show in a cell of the progressbar
+	PBAR_ORDER = [
+		Job.STATUS_BUILTFAILED,
+		Job.STATUS_SUBMITFAILED,
+		Job.STATUS_ENDFAILED,
+		Job.STATUS_DONEFAILED,
+		Job.STATUS_BUILDING,
+		Job.STATUS_BUILT,
+		Job.STATUS_SUBMITTING,
+		Job.STATUS_SUBMITTED,
+		Job.STATUS_RETRYING,
+		Job.STATUS_RUNNING,
+		Job.STATUS_DONE,
+		Job.STATUS_DONECACHED,
+		Job.STATUS_KILLING,
+		Job.STATUS_KILLED,
+	]
+	# max times to render the progressbar per second, 0 for no limit
+	PBAR_FREQ  = 10
 	# submission lock
 	SBMLOCK = Lock()
+	# interval for the workers and the watcher to wait for something to do
+	INTERVAL = .5
+	FSNOTIFY = True
+	# global job slots
+	SLOTS    = 0
+	INUSE    = 0
+	# host capacity budget, mem in MB
+	RESOURCES = {'cores': 0, 'mem': 0}
+	RESINUSE  = {'cores': 0, 'mem': 0}
+	MANAGERS = []
 
 	def __init__(self, jobs, config):
 		"""
@@ -63,6 +127,12 @@ class Jobmgr(object):
 		@params:
 			`jobs`: All the jobs
 			`config`: The configurations for the job manager
+				- `onend`: A function called with the job index when a job ends
+				- `feed` : A function returning the indices of jobs ready to run, 
+				  `None` if no more jobs will be ready.
+				- `priority`: The priority of the manager to take the global slots
+				- `chunk`: The size of chunks and number of jobs to run at the same time in a chunk
+				  (`{'size': 100, 'forks': 1}`) to submit the jobs as chunks.
 		"""
 		if not jobs:  # no jobs
 			return
@@ -70,22 +140,80 @@ class Jobmgr(object):
 		self.config  = config
 		self.logger  = config.get('logger', logger)
 		self.stop    = False
+		self.lock    = Lock()
+		# number of jobs that will not change any more (done, cached or failed)
+		self.nended  = 0
+		# job index => time to check it
+		self.running = {}
+		# job index => the interval it was checked at last time, growing as long as the job is running
+		self.intervals = {}
+		# to tell when job.rc is written, None if not available
+		self.fswatcher = Watcher.shared() if Jobmgr.FSNOTIFY else None
+		# jobs with their directories being watched
+		self.fswatched = set()
+		# jobs in flight (taking the submission slots)
+		self.inflight = set()
+		# job index => resources taken from the budget
+		self.taken    = {}
+		# to wake up the watcher before a running job is due
+		self.wakeup  = Event()
+		# jobs told to have exited before they are handed to the watcher
+		self.exited  = set()
+		# number of jobs queued to build or being built
+		self.nbuilding = 0
+		# max number of jobs to submit as an array job, 0 to submit them one by one
+		self.arraysize = 0
+		# first index of a batch => indices of the jobs to submit as an array job
+		self.arrays    = {}
+		self.chunk     = config.get('chunk')
+		# first index of a chunk submitted => indices of the jobs in it
+		self.chunks    = {}
+		# first index of a running chunk => (indices of the other jobs in it, those waiting to retry)
+		self.chunkrun  = {}
+		self.priority  = config.get('priority', 0)
+		# job index => the order to build and submit the job, longest first, None to use the index
+		self.ranks     = None
+		if self.priority:
+			runtimes   = [Job.lastRuntime(job.dir) or 0 for job in jobs]
+			self.ranks = [0] * len(jobs)
+			for rank, index in enumerate(sorted(range(len(jobs)), key = lambda i: -runtimes[i])):
+				self.ranks[index] = rank
+		self._initBar()
 
-		queue  = PQueue(batch_len = len(jobs))
-		nslots = min(queue.batch_len, config['nthread'])
+		self.queue = PQueue(batch_len = len(jobs))
+		self.sbmQ  = PQueue(batch_len = len(jobs))
+		nslots = min(self.queue.batch_len, config['nthread'])
 
-		for job in self.jobs:
-			# say nslots = 40
-			# where = 0 if job.index = [0, 19]
-			# where = 1 if job.index = [20, 39]
-			# ...
-			queue.put(job.index, where = int(2*job.index/nslots))
-		
-		ThreadPool(
-			nslots,
-			initializer = self.worker,
-			initargs = queue
-		).join(cleanup = self.cleanup)
+		initializer = [self.watcher] + [self.worker] * nslots
+		initargs    = [()] + [(self.queue, )] * nslots
+		if config.get('feed'):
+			initializer.append(self.feeder)
+			initargs.append((nslots, ))
+		else:
+			self.nbuilding = len(self.jobs)
+			for job in self.jobs:
+				self.queue.put(job.index, where = self._where(job.index, nslots))
+
+		Jobmgr.MANAGERS.append(self)
+		try:
+			ThreadPool(
+				len(initializer),
+				initializer = initializer,
+				initargs    = initargs
+			).join(cleanup = self.cleanup)
+		finally:
+			Jobmgr.MANAGERS.remove(self)
+			for index in list(self.fswatched):
+				self._unwatch(index)
+			# give back the slots of jobs killed, and what the runners took for them (i.e. server slots)
+			for index in self.inflight | set(sum(self.chunks.values(), [])):
+				if self.jobs[index].runner:
+					self.jobs[index].runner.release()
+			with Jobmgr.SBMLOCK:
+				Jobmgr.INUSE -= len(self.inflight)
+				self.inflight.clear()
+				for index in list(self.taken):
+					self._giveBack(index)
 
 	def worker(self, queue):
 		"""
@@ -93,9 +221,36 @@ class Jobmgr(object):
 		@params:
 			`queue`: The priority queue
 		"""
-		while not queue.empty() and not self.stop:
-			self.workon(queue.get(), queue)
-			queue.task_done()
+		while not self.stop:
+			try:
+				index = queue.get(timeout = Jobmgr.INTERVAL)
+			except QueueEmpty:
+				continue
+			try:
+				self.workon(index, queue)
+			finally:
+				queue.task_done()
+
+	def feeder(self, nslots):
+		"""
+		Put the jobs into the queue once they are ready (stream mode)
+		@params:
+			`nslots`: The number of workers
+		"""
+		fed = set()
+		while not self.stop:
+			indices = self.config['feed'](Jobmgr.INTERVAL)
+			if indices is None:
+				# the rest of jobs will never be ready
+				for job in self.jobs:
+					if job.index not in fed:
+						self._end()
+				break
+			for index in indices:
+				fed.add(index)
+				with self.lock:
+					self.nbuilding += 1
+				self.queue.put(index, where = self._where(index, nslots))
 
 	def workon(self, index, queue):
 		"""
@@ -110,49 +265,66 @@ class Jobmgr(object):
 			self.progressbar(index)
 			job.status = Job.STATUS_BUILDING
 			job.build()
+			with self.lock:
+				self.nbuilding -= 1
 			# status then could be: 
 			# STATUS_DONECACHED, STATUS_BUILT, STATUS_BUILTFAILED
 			if job.status == Job.STATUS_DONECACHED:
 				self.progressbar(index)
+				self._end(index)
 			elif job.status == Job.STATUS_BUILTFAILED:
-				self.progressbar(index)
+				self.progressbar(index, force = True)
 				raise JobBuildingException()
 			else: 
-				queue.put(index, where = batch+3)
-		elif job.status == Job.STATUS_BUILT or job.status == Job.STATUS_RETRYING:
-			# when slots are available
-			if self.canSubmit():
-				with Jobmgr.SBMLOCK:
-					job.status = Job.STATUS_SUBMITTING
-				self.progressbar(index)
-				s = job.submit()
-				with Jobmgr.SBMLOCK:
-					job.status = Job.STATUS_SUBMITTED if s else Job.STATUS_SUBMITFAILED
-				if job.status == Job.STATUS_SUBMITFAILED:
-					self.progressbar(index)
-					raise JobSubmissionException()
-			queue.put(index, where = batch+3)
-		elif job.status == Job.STATUS_SUBMITTED or job.status == Job.STATUS_RUNNING:
-			oldstatus = job.status
-			if oldstatus == Job.STATUS_RUNNING:
-				# Just don't run it too frequently
-				sleep(.5)
+				self.arraysize = self.chunk['size'] if self.chunk else job.runner.array
+				self.sbmQ.put(index, where = batch)
+			# jobs waiting for a batch to fill may be dispatched when no more jobs are being built
+			self._dispatch()
+		elif job.status == Job.STATUS_SUBMITTING:
+			# slots have been assigned by _dispatch
+			with self.lock:
+				indices = self.arrays.pop(index, [index])
+			for i in indices:
+				self.progressbar(i)
+				# let the runner tell when the job exits
+				self.jobs[i].runner.onexit = self.notify
+			if len(indices) == 1:
+				submitted = job.submit()
+			elif self.chunk:
+				with self.lock:
+					self.chunks[index]   = indices
+					self.chunkrun[index] = (set(indices[1:]), [])
+				submitted = Job.submitChunk([self.jobs[i] for i in indices], self.chunk['forks'])
+				if not submitted:
+					with self.lock:
+						del self.chunkrun[index]
 			else:
-				self.progressbar(index)
-
-			# check if job finishes, or any logs to output
+				submitted = Job.submitArray([self.jobs[i] for i in indices])
+			for i in indices:
+				self.jobs[i].status = Job.STATUS_SUBMITTED if submitted else Job.STATUS_SUBMITFAILED
+				self.progressbar(i, force = not submitted)
+			if not submitted:
+				for i in indices:
+					self._release(i)
+				raise JobSubmissionException()
+			for i in indices:
+				self._watch(i)
+		elif job.status == Job.STATUS_SUBMITTED or job.status == Job.STATUS_RUNNING:
+			# completion event from the watcher
 			job.poll()
 			# status then could be:
 			# STATUS_RUNNING, STATUS_DONEFAILED, STATUS_DONE
 			if job.status == Job.STATUS_RUNNING:
-				if oldstatus != job.status:
-					self.progressbar(index)
-				queue.put(index, where = batch+3)
+				self._watch(index, backoff = True)
+				return
+			# the chunk led by the job has exited
+			self._chunkExited(index)
 
-			elif job.status == Job.STATUS_DONEFAILED:
+			if job.status == Job.STATUS_DONEFAILED:
 				if job.retry() == 'halt':
 					# status:
 					# STATUS_ENDFAILED, STATUS_RETRYING
+					self.progressbar(index, force = True)
 					raise JobFailException()
 				if job.status == Job.STATUS_RETRYING:
 					self.logger.warning("Retrying %s/%s ...", job.ntry, job.config['errntry'], extra = {
@@ -162,27 +334,246 @@ class Jobmgr(object):
 						'pbar'    : False,
 						'proc'    : self.config['proc']
 					})
-					# retry as soon as possible
-					queue.put(index, where = batch+3)
-				else: # STATUS_ENDFAILED
-					self.progressbar(index)
+					# retry as soon as possible, once its slot and resources are released
+					if not self._waitChunk(index):
+						self._release(index, requeue = True)
+					return
+				# STATUS_ENDFAILED
+				self.progressbar(index, force = True)
+				self._end(index)
 			else:
 				self.progressbar(index)
+				self._end(index)
+			self._release(index)
 
+	def watcher(self):
+		"""
+		The completion watcher.
+		Check the running jobs when they are due, and send the completed ones back to the queue.
+		"""
+		while not self.stop:
+			now = time()
+			with self.lock:
+				due = [index for index, t in self.running.items() if t <= now]
+			for index in due:
+				job = self.jobs[index]
+				oldstatus = job.status
+				if job.checkRunning():
+					if oldstatus != job.status:
+						self.progressbar(index)
+					with self.lock:
+						# no need to check it frequently if we will be told when it's done
+						interval = job.runner.poll['max'] if index in self.fswatched \
+							else job.runner.nextPoll(self.intervals.get(index))
+						self.intervals[index] = interval
+						self.running[index]   = time() + interval
+				else:
+					with self.lock:
+						del self.running[index]
+					self._unwatch(index)
+					self.queue.put(index)
+			with self.lock:
+				timeout = min(self.running.values()) - time() if self.running else Jobmgr.INTERVAL
+			if timeout > 0:
+				self.wakeup.wait(timeout)
+			self.wakeup.clear()
 
-	def progressbar(self, jobidx):
+	def notify(self, index):
 		"""
-		Generate progressbar.
+		Tell the watcher that a running job may have completed, so that it will be checked immediately.
+		This allows the completion to be delivered as an event (i.e. by the runner).
 		@params:
-			`jobidx`: The job index.
-			`loglevel`: The log level in PyPPL log system
+			`index`: The index of the job
+		"""
+		with self.lock:
+			# the jobs in a chunk exit with the chunk
+			for i in self.chunks.pop(index, [index]):
+				if i not in self.running:
+					# not handed to the watcher yet
+					self.exited.add(i)
+				else:
+					self.running[i] = 0
+		self.wakeup.set()
+
+	def _watch(self, index, backoff = False):
+		"""
+		Hand a submitted job to the watcher
+		@params:
+			`index`  : The index of the job
+			`backoff`: Whether the job has been found running, otherwise it was just submitted, 
+				and will be checked at the shortest interval.
+		"""
+		job = self.jobs[index]
+		if self.fswatcher and index not in self.fswatched and \
+			self.fswatcher.watch(job.dir, lambda name: self._onWrite(index, name)):
+			self.fswatched.add(index)
+		with self.lock:
+			interval = job.runner.nextPoll(self.intervals.get(index) if backoff else None)
+			self.intervals[index] = interval
+			if index in self.exited:
+				self.exited.discard(index)
+				self.running[index] = 0
+			else:
+				self.running[index] = time() + interval
+		self.wakeup.set()
+
+	def _unwatch(self, index):
+		"""
+		Stop watching the directory of a job
+		@params:
+			`index`: The index of the job
+		"""
+		if index in self.fswatched:
+			self.fswatched.discard(index)
+			self.fswatcher.unwatch(self.jobs[index].dir)
+
+	def _onWrite(self, index, name):
+		"""
+		Called by the file system watcher when a file is written in the directory of a job
+		@params:
+			`index`: The index of the job
+			`name` : The name of the file, `None` if the file is unknown
+		"""
+		if name is None or name == path.basename(self.jobs[index].rcfile):
+			self.notify(index)
+
+	def _dispatch(self):
+		"""
+		Move jobs waiting for submission to the queue as long as slots are available.
+		For array jobs and chunks, the jobs are held until a full batch can be dispatched or no more jobs are being built.
+		"""
+		with self.lock:
+			if self.arraysize and self.nbuilding > 0:
+				need = self.arraysize
+				# a chunk takes one slot, while an array job takes one slot for each job
+				if not self.chunk:
+					with Jobmgr.SBMLOCK:
+						free = self.config['forks'] - len(self.inflight)
+						if Jobmgr.SLOTS:
+							free = min(free, Jobmgr.SLOTS - Jobmgr.INUSE)
+					need = min(need, free)
+				if self.sbmQ.qsize() < need:
+					return
+			batch = []
+			while not self.stop and not self.sbmQ.empty():
+				# check and take the slot at once, as the global slots are shared by managers
+				with Jobmgr.SBMLOCK:
+					index = self.sbmQ.peek()[0]
+					# the jobs of a chunk ride on the slot of the first one
+					first = not self.chunk or not batch
+					# the runner may have to wait as well (i.e. ssh servers full), not to block a worker
+					if first and not (self.canSubmit(index) and self.jobs[index].runner.reserve()):
+						break
+					self.sbmQ.get_nowait()
+					if first:
+						Jobmgr.INUSE += 1
+						self.inflight.add(index)
+						self._take(index)
+				self.jobs[index].status = Job.STATUS_SUBMITTING
+				if not self.arraysize:
+					self.queue.put(index)
+					continue
+				batch.append(index)
+				if len(batch) >= self.arraysize:
+					self.arrays[batch[0]] = batch
+					self.queue.put(batch[0])
+					batch = []
+			if batch:
+				self.arrays[batch[0]] = batch
+				self.queue.put(batch[0])
+
+	def _waitChunk(self, index):
+		"""
+		Hold a job to retry until the chunk it is in exits, 
+		as the chunk writes the rc files of its jobs not finished when it exits (i.e. killed).
+		@params:
+			`index`: The index of the job
 		@returns:
-			The string representing the progressbar
+			`True` if the job is held, `False` if it's not in a running chunk
+		"""
+		with self.lock:
+			for members, waiting in self.chunkrun.values():
+				if index in members:
+					waiting.append(index)
+					return True
+		return False
+
+	def _chunkExited(self, index):
+		"""
+		Retry the jobs held until the chunk exits, if the job is the first one of a chunk
+		@params:
+			`index`: The index of the job
+		"""
+		with self.lock:
+			_, waiting = self.chunkrun.pop(index, (None, []))
+		for i in waiting:
+			self._release(i, requeue = True)
+
+	def _release(self, index, requeue = False):
+		"""
+		Release the slot of a job that is no longer running, 
+		then jobs of all running managers can be dispatched, as the global slots may be available.
+		@params:
+			`index`  : The index of the job
+			`requeue`: Put the job back to wait for submission (retrying)
+		"""
+		runner = self.jobs[index].runner
+		if runner:
+			runner.release()
+		with Jobmgr.SBMLOCK:
+			# jobs in a chunk, except the first one, don't take slots
+			if index in self.inflight:
+				Jobmgr.INUSE -= 1
+				self.inflight.discard(index)
+				self._giveBack(index)
+		if requeue:
+			self.sbmQ.put(index)
+		managers = [self] + [mgr for mgr in Jobmgr.MANAGERS[:] if mgr is not self]
+		# stable, the managers with higher priority take the slots first
+		managers.sort(key = lambda mgr: -mgr.priority)
+		for mgr in managers:
+			mgr._dispatch()
+
+	def _where(self, index, nslots):
+		"""
+		Tell which batch of the queue to put a job into
+		@params:
+			`index` : The index of the job
+			`nslots`: The number of workers
+		@returns:
+			The batch number
+		"""
+		if self.ranks:
+			return self.ranks[index]
+		# say nslots = 40
+		# where = 0 if job.index = [0, 19]
+		# where = 1 if job.index = [20, 39]
+		# ...
+		return int(2*index/nslots)
+
+	def _end(self, index = None):
+		"""
+		Count a job that will not change any more, and stop the workers if all jobs end.
+		@params:
+			`index`: The index of the job, reported to `config['onend']`. 
+				`None` for a job never started.
+		"""
+		if index is not None and self.config.get('onend'):
+			self.config['onend'](index)
+		with self.lock:
+			self.nended += 1
+			if self.nended >= len(self.jobs):
+				self.stop = True
+		if self.stop:
+			self.wakeup.set()
+
+	def _initBar(self):
+		"""
+		Distribute the jobs to the cells of the progressbar, and count the status of jobs in each cell,
+		so that the progressbar can be updated incrementally.
 		"""
-		pbar    = '['
-		barjobs = []
 		joblen  = len(self.jobs)
-		status = [job.status for job in self.jobs]
+		barjobs = []
 		# distribute the jobs to bars
 		if joblen <= Jobmgr.PBAR_SIZE:
 			n, m = divmod(Jobmgr.PBAR_SIZE, joblen)
@@ -198,48 +589,85 @@ class Jobmgr(object):
 				barjobs.append([jobx + s for s in range(step)])
 				jobx += step
 
-		ncompleted = sum(1 for s in status if s & 0b1000000)
-		nrunning   = sum(1 for s in status if s == Job.STATUS_RUNNING or s == Job.STATUS_SUBMITTED)
+		# job index => cells
+		self.jobcells   = [[] for _ in range(joblen)]
+		# status => count of jobs in each cell
+		self.cellcounts = []
+		for cell, bj in enumerate(barjobs):
+			counts = {}
+			for j in bj:
+				self.jobcells[j].append(cell)
+				counts[self.jobs[j].status] = counts.get(self.jobs[j].status, 0) + 1
+			self.cellcounts.append(counts)
+		self.cellmarks   = [Jobmgr._cellMark(counts) for counts in self.cellcounts]
+		# the status of each job last seen by the progressbar
+		self.jobstatus   = [job.status for job in self.jobs]
+		# status => count of jobs
+		self.statuscount = {}
+		for status in self.jobstatus:
+			self.statuscount[status] = self.statuscount.get(status, 0) + 1
+		# last time the progressbar was rendered
+		self.pbartime    = 0
 
-		job = self.jobs[jobidx]
-		for bj in barjobs:
-			if jobidx in bj:
-				pbar += Jobmgr.PBAR_MARKS[job.status]
-			else:
-				bjstatus  = [status[i] for i in bj]
-				if Job.STATUS_BUILTFAILED in bjstatus:
-					s = Job.STATUS_BUILTFAILED
-				elif Job.STATUS_SUBMITFAILED in bjstatus:
-					s = Job.STATUS_SUBMITFAILED
-				elif Job.STATUS_ENDFAILED in bjstatus:
-					s = Job.STATUS_ENDFAILED
-				elif Job.STATUS_DONEFAILED in bjstatus:
-					s = Job.STATUS_DONEFAILED
-				elif Job.STATUS_BUILDING in bjstatus:
-					s = Job.STATUS_BUILDING
-				elif Job.STATUS_BUILT in bjstatus:
-					s = Job.STATUS_BUILT
-				elif Job.STATUS_SUBMITTING in bjstatus:
-					s = Job.STATUS_SUBMITTING
-				elif Job.STATUS_SUBMITTED in bjstatus:
-					s = Job.STATUS_SUBMITTED
-				elif Job.STATUS_RETRYING in bjstatus:
-					s = Job.STATUS_RETRYING
-				elif Job.STATUS_RUNNING in bjstatus:
-					s = Job.STATUS_RUNNING
-				elif Job.STATUS_DONE in bjstatus:
-					s = Job.STATUS_DONE
-				elif Job.STATUS_DONECACHED in bjstatus:
-					s = Job.STATUS_DONECACHED
-				elif Job.STATUS_KILLING in bjstatus:
-					s = Job.STATUS_KILLING
-				elif Job.STATUS_KILLED in bjstatus:
-					s = Job.STATUS_KILLED
-				else:
-					s = Job.STATUS_INITIATED
-				pbar += Jobmgr.PBAR_MARKS[s]
+	@staticmethod
+	def _cellMark(counts):
+		"""
+		Get the mark of a cell of the progressbar
+		@params:
+			`counts`: The counts of job status in the cell
+		@returns:
+			The mark of the status with the highest priority in the cell
+		"""
+		for status in Jobmgr.PBAR_ORDER:
+			if counts.get(status):
+				return Jobmgr.PBAR_MARKS[status]
+		return Jobmgr.PBAR_MARKS[Job.STATUS_INITIATED]
+
+	def _syncBar(self, jobidx):
+		"""
+		Update the counts of the progressbar if the status of the job changed
+		@params:
+			`jobidx`: The job index.
+		"""
+		old = self.jobstatus[jobidx]
+		new = self.jobs[jobidx].status
+		if old == new:
+			return
+		self.jobstatus[jobidx]  = new
+		self.statuscount[old]  -= 1
+		self.statuscount[new]   = self.statuscount.get(new, 0) + 1
+		for cell in self.jobcells[jobidx]:
+			counts       = self.cellcounts[cell]
+			counts[old] -= 1
+			counts[new]  = counts.get(new, 0) + 1
+			self.cellmarks[cell] = Jobmgr._cellMark(counts)
+
+	def progressbar(self, jobidx, force = False):
+		"""
+		Generate progressbar.
+		The progressbar is rendered at most `Jobmgr.PBAR_FREQ` times per second, 
+		unless it's forced or all jobs are completed.
+		@params:
+			`jobidx`: The job index.
+			`force` : Render the progressbar anyway.
+		"""
+		joblen = len(self.jobs)
+		job    = self.jobs[jobidx]
+		with self.lock:
+			self._syncBar(jobidx)
+			ncompleted = sum(count for status, count in self.statuscount.items() if status & 0b1000000)
+			now = time()
+			if not force and ncompleted < joblen and Jobmgr.PBAR_FREQ and \
+				now - self.pbartime < 1.0 / Jobmgr.PBAR_FREQ:
+				return
+			self.pbartime = now
+			nrunning = self.statuscount.get(Job.STATUS_RUNNING, 0) + \
+				self.statuscount.get(Job.STATUS_SUBMITTED, 0)
+			cells = self.cellmarks[:]
+			for cell in self.jobcells[jobidx]:
+				cells[cell] = Jobmgr.PBAR_MARKS[self.jobstatus[jobidx]]
 
-		pbar += '] Done: {:5.1f}% | Running: {}'.format(
+		pbar = '[' + ''.join(cells) + '] Done: {:5.1f}% | Running: {}'.format(
 			100.0 * float(ncompleted) / float(joblen), 
 			str(nrunning).ljust(len(str(joblen)))
 		)
@@ -261,6 +689,7 @@ class Jobmgr(object):
 			`ex`: The exception raised by workers
 		"""
 		self.stop = True
+		self.wakeup.set()
 		if isinstance(ex, JobBuildingException):
 			message = 'Job building failed, quitting pipeline ...'
 		elif isinstance(ex, JobSubmissionException):
@@ -274,11 +703,23 @@ class Jobmgr(object):
 		if message:
 			self.logger.warning(message, extra = {'pbar': 'next', 'proc': self.config['proc']})
 		
-		# kill running jobs
-		rjobs = [
-			job.index for job in self.jobs 
-			if job.status in (Job.STATUS_RUNNING, Job.STATUS_SUBMITTED, Job.STATUS_SUBMITTING)
-		]
+		self.killJobs()
+			
+		failedjobs = [job for job in self.jobs if job.status & 0b1]
+		if not failedjobs:
+			failedjobs = [random.choice(self.jobs)]
+		failedjobs[0].showError(len(failedjobs))
+
+		if ex and not isinstance(ex, (JobFailException, JobBuildingException, JobSubmissionException, KeyboardInterrupt)):
+			raise ex
+		exit(1)
+
+	def killJobs(self):
+		"""
+		Kill the running jobs
+		"""
+		with Jobmgr.SBMLOCK:
+			rjobs = sorted(self.inflight)
 		killQ = PQueue(batch_len = len(self.jobs))
 		for rjob in rjobs:
 			killQ.put(rjob)
@@ -288,15 +729,17 @@ class Jobmgr(object):
 			initializer = self.killWorker,
 			initargs    = killQ
 		).join()
-			
-		failedjobs = [job for job in self.jobs if job.status & 0b1]
-		if not failedjobs:
-			failedjobs = [random.choice(self.jobs)]
-		failedjobs[0].showError(len(failedjobs))
 
-		if ex and not isinstance(ex, (JobFailException, JobBuildingException, JobSubmissionException, KeyboardInterrupt)):
-			raise ex
-		exit(1)
+	@staticmethod
+	def killAll():
+		"""
+		Stop all running job managers and kill their running jobs.
+		Used when processes are running concurrently and one of them fails.
+		"""
+		for mgr in Jobmgr.MANAGERS[:]:
+			mgr.stop = True
+			mgr.wakeup.set()
+			mgr.killJobs()
 
 	def killWorker(self, rq):
 		"""
@@ -310,18 +753,63 @@ class Jobmgr(object):
 			job.status = Job.STATUS_KILLING
 			self.progressbar(i)
 			job.kill()
-			self.progressbar(i)
+			self.progressbar(i, force = True)
 			rq.task_done()
 
-	def canSubmit(self):
+	def canSubmit(self, index = None):
 		"""
 		Tell if jobs can be submitted.
+		Should be called with `Jobmgr.SBMLOCK` acquired.
+		@params:
+			`index`: The index of the job to submit, to check if the resources it requests are available
 		@return:
 			`True` if they can else `False`
 		"""
-		with Jobmgr.SBMLOCK:
-			return sum(
-				1 for job in self.jobs
-				if job.status in (Job.STATUS_RUNNING, Job.STATUS_SUBMITTED, Job.STATUS_SUBMITTING)
-			) < self.config['forks']
+		if Jobmgr.SLOTS and Jobmgr.INUSE >= Jobmgr.SLOTS:
+			return False
+		if len(self.inflight) >= self.config['forks']:
+			return False
+		if index is None:
+			return True
+		request = self._request(index)
+		return all(
+			Jobmgr.RESINUSE[key] + request[key] <= total
+			for key, total in Jobmgr.RESOURCES.items() if total
+		)
+
+	def _request(self, index):
+		"""
+		Get the resources requested by a job against the budget.
+		A job requesting more than the budget takes the whole budget, so that it runs alone instead of never.
+		@params:
+			`index`: The index of the job
+		@returns:
+			The resources requested
+		"""
+		resources = self.jobs[index].resources
+		return {
+			key: min(max(resources.get(key, 0), 0), total) if total else 0
+			for key, total in Jobmgr.RESOURCES.items()
+		}
+
+	def _take(self, index):
+		"""
+		Take the resources requested by a job from the budget.
+		Should be called with `Jobmgr.SBMLOCK` acquired.
+		@params:
+			`index`: The index of the job
+		"""
+		request = self.taken[index] = self._request(index)
+		for key, val in request.items():
+			Jobmgr.RESINUSE[key] += val
+
+	def _giveBack(self, index):
+		"""
+		Give the resources taken by a job back to the budget.
+		Should be called with `Jobmgr.SBMLOCK` acquired.
+		@params:
+			`index`: The index of the job
+		"""
+		for key, val in self.taken.pop(index, {}).items():
+			Jobmgr.RESINUSE[key] -= val
 
@@ -5,14 +5,20 @@ import sys
 import json
 import copy as pycopy
 from time import time
+from hashlib import md5
 from collections import OrderedDict
-from os import path, makedirs, remove
+from threading import Condition
+from os import path, makedirs, remove, listdir, rename
 from multiprocessing import cpu_count
 import filelock
 from . import logger, utils, template
 from .job import Job
 from .jobmgr import Jobmgr
+from .utils.filehash import HashCache
+from .utils.sigstore import SigStore, FileSigs
+from .utils.sharedcache import SharedCache
 from .aggr import Aggr
+from .proctree import ProcTree
 from .channel import Channel
 from .exception import ProcTagError, ProcAttributeError, ProcInputError, ProcOutputError, ProcScriptError, ProcRunCmdError
 
@@ -78,10 +84,11 @@ class Proc (object):
 		@config:
 			id, input, output, ppldir, forks, cache, acache, rc, echo, runner, script, depends, tag, desc, dirsig
 			exdir, exhow, exow, errhow, errntry, lang, beforeCmd, afterCmd, workdir, args, aggr
-			callfront, callback, expect, expart, template, tplenvs, resume, nthread
+			callfront, callback, expect, expart, template, tplenvs, resume, nthread, stream, resources, chunk, sighash, sharedcache
 		@props
 			input, output, rc, echo, script, depends, beforeCmd, afterCmd, workdir, expect
-			expart, template, channel, jobs, ncjobids, size, sets, procvars, suffix, logs
+			expart, resources, chunk, template, channel, jobs, ncjobids, size, sets, procvars, suffix, logs
+			ended, finished, streaming
 		"""
 		# Don't go through __getattr__ and __setattr__
 		# To get a prop  : proc.echo   --> proc.props['echo']
@@ -94,6 +101,8 @@ class Proc (object):
 		self.__dict__['config']   = {}
 		# computed props
 		self.__dict__['props']    = {}
+		# used to notify the processes depending on this one when jobs end (stream mode)
+		self.__dict__['endcond']  = Condition()
 
 		self.config['id']         = utils.varname() if id is None else id
 
@@ -127,6 +136,12 @@ class Proc (object):
 		# Do cleanup for cached jobs?
 		self.config['acache']     = False
 
+		# Submit the jobs in chunks, each submitted to the runner as one job running the jobs in it one by one
+		# Could also be: {'size': 100, 'forks': 4}, running 4 jobs of a chunk at the same time
+		self.config['chunk']      = 1
+		# The computed chunk
+		self.props['chunk']       = {}
+
 		# The output channel of the process
 		self.props['channel']     = Channel.create()
 
@@ -138,8 +153,18 @@ class Proc (object):
 		# The description of the job
 		self.config['desc']       = desc
 
+		# The jobs ended, for the processes depending on this one in stream mode
+		# None if jobs are not started
+		self.props['ended']       = None
+		# Whether the process finished successfully, None if it's not finished
+		self.props['finished']    = None
+
 		# Whether expand directory to check signature
 		self.config['dirsig']     = True
+		# Whether to use the content hash instead of the modified time of the files for the signature
+		self.config['sighash']    = False
+		# The directory of the result cache shared by the pipelines, not used if empty
+		self.config['sharedcache'] = ''
 
 		# Whether to echo the stdout and stderr of the jobs to the screen
 		# Could also be:
@@ -211,6 +236,13 @@ class Proc (object):
 
 		self.props['origin']      = self.config['id']
 
+		# The resources requested by each job, values could be templates rendered with the job data
+		# i.e. {'cores': '{{i.nthreads}}', 'mem': '4G'}
+		# mem in MB or with a unit (K, M, G, T)
+		self.config['resources']  = {'cores': 1, 'mem': 0}
+		# The computed resources (templates)
+		self.props['resources']   = {}
+
 		# The output that user specified
 		self.config['output']     = ''
 		# The computed output
@@ -261,6 +293,11 @@ class Proc (object):
 		# The tag of the job
 		self.config['tag']        = tag
 
+		# Start a job as soon as the corresponding job of the dependent process is done
+		self.config['stream']     = False
+		# The input keys to fill in stream mode, and the number of jobs fed. None if not in stream mode
+		self.props['streaming']   = None
+
 		# The template engine (name)
 		self.config['template']   = ''
 		# The template class
@@ -426,7 +463,7 @@ class Proc (object):
 		for key in self.props.keys():
 			if key in ['depends', 'jobs', 'ncjobids']:
 				props[key] = []
-			elif key in ['procvars', 'logs']:
+			elif key in ['procvars', 'logs', 'resources']:
 				props[key] = {}
 			elif key == 'size':
 				props[key] = 0
@@ -436,6 +473,8 @@ class Proc (object):
 				props[key] = ''
 			elif key == 'channel':
 				props[key] = Channel.create()
+			elif key in ['ended', 'finished', 'streaming']:
+				props[key] = None
 			elif key == 'sets':
 				props[key] = self.props[key][:]
 			#elif isinstance(props[key], Box):
@@ -493,6 +532,23 @@ class Proc (object):
 		#self.props['suffix'] = utils.uid(path.realpath(sys.argv[0]) + ':' + self.id)
 		return self.suffix
 
+	def _estimate (self):
+		"""
+		Estimate the time of the process by the runtimes of its jobs in last run
+		@returns:
+			The estimated time in seconds, `None` if unknown
+		"""
+		workdir = self.props['workdir'] or (self.config['workdir'] if 'workdir' in self.sets else \
+			path.join(self.ppldir, "PyPPL.%s.%s.%s" % (self.id, self.tag, self._suffix())))
+		if not path.isdir(workdir):
+			return None
+		runtimes = [Job.lastRuntime(path.join(workdir, jobdir)) for jobdir in listdir(workdir) if jobdir.isdigit()]
+		runtimes = [runtime for runtime in runtimes if runtime is not None]
+		if not runtimes:
+			return None
+		# jobs run in forks
+		return max(max(runtimes), sum(runtimes) / float(min(self.forks, len(runtimes))))
+
 	# self.resume != 'skip'
 	def _tidyBeforeRun (self):
 		"""
@@ -507,7 +563,8 @@ class Proc (object):
 			self._buildProcVars()
 			self._buildOutput()
 			self._buildScript()
-			if self.resume not in ['skip+', 'resume']:
+			# in stream mode, input data are available after jobs run
+			if self.resume not in ['skip+', 'resume'] and not self.streaming:
 				self._saveSettings()
 			self._buildJobs ()
 			self.props['timer'] = time()
@@ -603,36 +660,47 @@ class Proc (object):
 		@params:
 			`config`: The configuration
 		"""
-		self._readConfig (profile, profiles)
-
-		if self.runner == 'dry':
-			self.config['cache'] = False
+		with self.endcond:
+			self.props['ended']    = None
+			self.props['finished'] = None
+		self.props['streaming'] = None
+		finished = False
+		try:
+			self._readConfig (profile, profiles)
 
-		if self.resume == 'skip':
-			logger.logger.info("Pipeline will resume from future processes.", extra = {
-				'loglevel': 'skipped'
-			})
-		elif self.resume == 'skip+':
-			self._tidyBeforeRun()
-			logger.logger.info("Data loaded, pipeline will resume from future processes.", extra = {
-				'loglevel': 'skipped'
-			})
-			try:
-				self._tidyAfterRun ()
-			finally:
-				self.lock.release()
-		else: # '', resume, resume+
-			self._tidyBeforeRun ()
+			if self.runner == 'dry':
+				self.config['cache'] = False
 
-			try:
-				self._runCmd('preCmd')
-				if self.resume: # resume or resume+
-					logger.logger.info("Previous processes skipped.", extra = {'loglevel': 'resumed'})
-				self._runJobs()
-				self._runCmd('postCmd')
-				self._tidyAfterRun ()
-			finally:
-				self.lock.release()
+			if self.resume == 'skip':
+				logger.logger.info("Pipeline will resume from future processes.", extra = {
+					'loglevel': 'skipped'
+				})
+			elif self.resume == 'skip+':
+				self._tidyBeforeRun()
+				logger.logger.info("Data loaded, pipeline will resume from future processes.", extra = {
+					'loglevel': 'skipped'
+				})
+				try:
+					self._tidyAfterRun ()
+				finally:
+					self.lock.release()
+			else: # '', resume, resume+
+				self._tidyBeforeRun ()
+
+				try:
+					self._runCmd('preCmd')
+					if self.resume: # resume or resume+
+						logger.logger.info("Previous processes skipped.", extra = {'loglevel': 'resumed'})
+					self._runJobs()
+					self._runCmd('postCmd')
+					self._tidyAfterRun ()
+				finally:
+					self.lock.release()
+			finished = True
+		finally:
+			with self.endcond:
+				self.props['finished'] = finished
+				self.endcond.notify_all()
 
 	def _buildProps (self):
 		"""
@@ -731,6 +799,17 @@ class Proc (object):
 			expart = utils.alwaysList(self.config['expart'])
 			self.props['expart'] = [self.template(e, **self.tplenvs) for e in expart]
 
+			# chunk
+			chunk = self.config['chunk'] if isinstance(self.config['chunk'], dict) else {'size': self.config['chunk']}
+			self.props['chunk'] = {'size': int(chunk.get('size', 1)), 'forks': int(chunk.get('forks', 1))}
+
+			# resources
+			resources = {'cores': 1, 'mem': 0}
+			resources.update(self.config['resources'])
+			self.props['resources'] = {
+				key: self.template(str(val), **self.tplenvs) for key, val in resources.items()
+			}
+
 			logger.logger.debug('Properties set explictly: %s', self.sets, extra = {'proc': self.id})
 		except Exception: # pragma: no cover
 			if self.lock.is_locked:
@@ -779,7 +858,7 @@ class Proc (object):
 		def dump(key, data):
 			"""Dump data"""
 			ret = ['[%s]' % key]
-			if key in ['jobs', 'ncjobids', 'logs', 'lock']:
+			if key in ['jobs', 'ncjobids', 'logs', 'lock', 'ended']:
 				return ''
 			elif key == 'input':
 				for k in sorted(data.keys()):
@@ -797,7 +876,7 @@ class Proc (object):
 				ret.append('procs: %s' % pickData([p.name() for p in data]))
 			elif key == 'template':
 				ret.append('name: %s' % pickData(data.__name__))
-			elif key in ['args', 'procvars', 'echo'] or key.endswith('Runner'):
+			elif key in ['args', 'procvars', 'echo', 'resources', 'chunk'] or key.endswith('Runner'):
 				for k in sorted(data.keys()):
 					v = val[k]
 					ret.append('%s: %s' % (pickKey(k), pickData(v)))
@@ -865,6 +944,9 @@ class Proc (object):
 					self.props['input'][inname]['data'].append(data)
 			self.props['jobs'] = [None] * self.size
 		else:
+			# wait for the dependent processes in stream mode before their channels are used,
+			# as they may finish (channels built) while waiting, if the jobs cannot be streamed
+			streamable = self.stream and self.depends and self._waitDepends()
 			indata = self.config['input']
 			if not indata:
 				indata = {}
@@ -889,6 +971,22 @@ class Proc (object):
 					pinkeys.append(k)
 					pintypes.append(t)
 
+			if streamable:
+				# stream mode, data will be filled when the jobs of the dependent process end
+				dep = self.depends[0]
+				self.props['size'] = dep.size
+				self.props['jobs'] = [None] * self.size
+				self.props['streaming'] = {'keys': [], 'fed': 0}
+				for inkey, intype in zip(pinkeys, pintypes):
+					if not inkey:
+						continue
+					self.props['streaming']['keys'].append(inkey)
+					self.props['input'][inkey] = {
+						'type': intype,
+						'data': [[] if intype in Proc.IN_FILESTYPE else ''] * self.size
+					}
+				return
+
 			invals = Channel.create()
 			for inkey in inkeys:
 				inval = indata[inkey]
@@ -917,6 +1015,75 @@ class Proc (object):
 					logger.logger.warning('No data found for input key "%s", use empty strings/lists instead.', inkey)
 					self.props['input'][inkey]['data'] = [[] if pintypes[i] in Proc.IN_FILESTYPE else ''] * self.size
 
+	def _waitDepends (self):
+		"""
+		Wait for the processes this one depends on in stream mode, 
+		as the process may be started before they finish.
+		The jobs can be streamed if this process has only one dependent process, 
+		input data are from it, its jobs are running (not skipped), and it has no callback, 
+		which may change its output channel after it finishes.
+		@returns:
+			`True` if the jobs can be streamed, otherwise `False` 
+			(all dependent processes finished, i.e. they were run before this one).
+		"""
+		streamable = len(self.depends) == 1 \
+			and not isinstance(self.config['input'], dict) \
+			and not self.depends[0].callback \
+			and self.depends[0].resume in ['', 'resume', 'resume+']
+		for dep in self.depends:
+			with dep.endcond:
+				while dep.finished is None and (not streamable or dep.ended is None):
+					dep.endcond.wait()
+				if dep is self.depends[0]:
+					# no need to stream if it has finished
+					streamable = streamable and dep.finished is None
+			if dep.finished is False:
+				raise ProcInputError(dep.name(), 'Dependent process failed')
+		return streamable
+
+	def _streamJobs (self, timeout):
+		"""
+		Get the jobs ready to run in stream mode (the corresponding jobs of the dependent process end), 
+		and fill their input data.
+		@params:
+			`timeout`: How long to wait for the jobs of the dependent process to end
+		@returns:
+			The indices of the jobs ready, `None` if no more jobs will be ready.
+		"""
+		dep = self.depends[0]
+		fed = self.streaming['fed']
+		with dep.endcond:
+			if len(dep.ended) <= fed and dep.finished is None:
+				dep.endcond.wait(timeout)
+			indices  = dep.ended[fed:]
+			finished = dep.finished
+
+		if not indices:
+			return None if finished is not None else []
+
+		for index in indices:
+			outdata = list(dep.jobs[index].data.o.values())
+			for i, inkey in enumerate(self.streaming['keys']):
+				if i < len(outdata):
+					self.input[inkey]['data'][index] = outdata[i]
+		self.streaming['fed'] += len(indices)
+		return indices
+
+	def _jobEnded (self, index):
+		"""
+		Record an ended job, so that the corresponding job of the processes 
+		depending on this one can be started in stream mode.
+		Failed jobs are not recorded unless errors are ignored.
+		@params:
+			`index`: The index of the job
+		"""
+		job = self.jobs[index]
+		if job.status not in (Job.STATUS_DONE, Job.STATUS_DONECACHED) and self.errhow != 'ignore':
+			return
+		with self.endcond:
+			self.ended.append(index)
+			self.endcond.notify_all()
+
 	def _buildProcVars (self):
 		"""
 		Build proc attribute values for template rendering,
@@ -926,7 +1093,7 @@ class Proc (object):
 		if self.runner != 'local':
 			show.append('runner')
 		hide    = ['desc', 'id', 'sets', 'tag', 'suffix', 'workdir', 'aggr', 'input', 'output', 'depends', 'script']
-		nokeys  = ['tplenvs', 'input', 'output', 'depends', 'lock', 'jobs']
+		nokeys  = ['tplenvs', 'input', 'output', 'depends', 'lock', 'jobs', 'ended', 'streaming']
 		allkeys = [key for key in set(self.props.keys()) | set(self.config.keys())]
 		pvkeys  = [
 			key for key in allkeys \
@@ -1083,6 +1250,7 @@ class Proc (object):
 			'errntry'   : self.errntry,
 			'errhow'    : self.errhow,
 			'expect'    : self.expect,
+			'resources' : self.resources,
 			'exhow'     : self.exhow,
 			'exow'      : self.exow,
 			'expart'    : self.expart,
@@ -1091,10 +1259,19 @@ class Proc (object):
 			'rcs'       : self.rc,
 			'cache'     : self.cache,
 			'dirsig'    : self.dirsig,
+			# content hashes of the files are cached in ppldir, shared by the processes
+			'hashes'    : HashCache.get(path.join(self.ppldir, 'PyPPL.hashes.db')) if self.sighash else None,
+			# signatures of all jobs in one file, instead of job.cache of each job
+			'sigstore'  : SigStore(path.join(self.workdir, 'proc.cache')) if self.cache else None,
+			# outputs of the jobs shared by the pipelines by the content of the jobs
+			'sharedcache': SharedCache(self.sharedcache) \
+				if self.cache and self.sharedcache and self.runner != 'dry' else None,
 			'proc'      : self.id,
 			'tag'       : self.tag,
 			'suffix'    : self.suffix
 		}
+		# signatures of the input/output files shared by the jobs to check the cache
+		config['filesigs'] = FileSigs(self.dirsig, config['hashes']) if self.cache else None
 		for i in range(self.size):
 			self.jobs[i] = Job(i, config)
 
@@ -1171,16 +1348,163 @@ class Proc (object):
 		if c.p.wait() != 0:
 			raise ProcRunCmdError(cmdstr, key)
 
+	def _fingerprint (self):
+		"""
+		Calculate the fingerprint of the process from the script template, the input data,
+		the signatures of the input files, the output templates, the template environments and the properties.
+		@returns:
+			The fingerprint, `None` if the process cannot be cached as a whole
+			(no cache, no jobs, stream mode, dry run or the outputs of cached jobs to be exported)
+		"""
+		if not self.jobs or not self.jobs[0].config.get('filesigs') or self.streaming \
+			or self.runner == 'dry' or self.acache:
+			return None
+
+		def flatData(data):
+			"""Flatten data"""
+			if isinstance(data, dict):
+				return {str(k):flatData(v) for k,v in data.items()}
+			elif isinstance(data, (list, tuple)):
+				return [flatData(v) for v in data]
+			elif isinstance(data, template.Template):
+				return data.source
+			elif callable(data):
+				return utils.funcsig(data)
+			return data
+
+		infiles = set()
+		for val in self.input.values():
+			if val['type'] in Proc.IN_FILETYPE:
+				infiles.update(val['data'])
+			elif val['type'] in Proc.IN_FILESTYPE:
+				for data in val['data']:
+					infiles.update(data)
+		infiles.discard('')
+		filesigs = self.jobs[0].config['filesigs']
+		filesigs.prefetch(infiles)
+		# the run-specific properties
+		procvars = {key: val for key, val in self.procvars['proc'].items() if key not in ('resume', 'timer')}
+		return md5(json.dumps({
+			'script'  : flatData(self.script),
+			'input'   : flatData(self.input),
+			'infiles' : {infile: filesigs.get(infile) for infile in infiles},
+			'output'  : flatData(self.output),
+			# not in procvars, but used to render the templates
+			'tplenvs' : flatData(self.tplenvs),
+			'procvars': flatData(procvars),
+			'args'    : flatData(self.procvars['args'])
+		}, sort_keys = True, default = repr).encode('utf-8')).hexdigest()
+
+	def _isCached (self, fingerprint):
+		"""
+		Tell whether the process is cached as a whole: the fingerprint is the same as the one saved
+		in `<workdir>/proc.fingerprint` by last run, and the output files still have the signatures saved then.
+		If so, the output data of the jobs are restored and the jobs are marked as cached,
+		without building them. Otherwise the jobs are built and checked for the cache one by one.
+		@params:
+			`fingerprint`: The fingerprint of the process
+		@returns:
+			`True` if the process is cached otherwise `False`
+		"""
+		fpfile = path.join(self.workdir, 'proc.fingerprint')
+		if not fingerprint or not path.isfile(fpfile):
+			return False
+		try:
+			with open(fpfile) as ffp:
+				saved = utils.jsonLoads(ffp.read())
+			if saved['fingerprint'] != fingerprint or len(saved['outputs']) != self.size:
+				return False
+			outsigs = saved['outsigs']
+			outfiles = [
+				data for output in saved['outputs'] for _, outtype, data in output
+				if outtype in Proc.OUT_FILETYPE + Proc.OUT_DIRTYPE
+			]
+		except (ValueError, KeyError, TypeError):
+			return False
+		filesigs = self.jobs[0].config['filesigs']
+		filesigs.prefetch(outfiles)
+		# output files removed or modified after last run
+		if not all(outfile in outsigs and filesigs.get(outfile) == outsigs[outfile] for outfile in outfiles):
+			return False
+
+		for job in self.jobs:
+			for key, outtype, data in saved['outputs'][job.index]:
+				job.output[key]    = {'type': outtype, 'data': data}
+				job.data['o'][key] = data
+			job.status = Job.STATUS_DONECACHED
+		logger.logger.info('Process cached by fingerprint, jobs skipped.', extra = {
+			'loglevel': 'cached',
+			'proc'    : self.id
+		})
+		return True
+
+	def _saveFingerprint (self, fingerprint):
+		"""
+		Save the fingerprint, the output data of the jobs and the signatures of the output files to `<workdir>/proc.fingerprint`,
+		if all jobs are done or cached.
+		@params:
+			`fingerprint`: The fingerprint of the process
+		"""
+		if not fingerprint or any(
+			job.status not in (Job.STATUS_DONE, Job.STATUS_DONECACHED) for job in self.jobs):
+			return
+		outfiles = [
+			val['data'] for job in self.jobs for val in job.output.values()
+			if val['type'] in Proc.OUT_FILETYPE + Proc.OUT_DIRTYPE
+		]
+		# the shared signatures may be calculated before the jobs ran
+		filesigs = self.jobs[0].config['filesigs']
+		filesigs = FileSigs(filesigs.dirsig, filesigs.hashes)
+		filesigs.prefetch(outfiles)
+		fpfile = path.join(self.workdir, 'proc.fingerprint')
+		with open(fpfile + '.tmp', 'w') as ffp:
+			ffp.write(json.dumps({
+				'fingerprint': fingerprint,
+				'outputs'    : [
+					[[key, val['type'], val['data']] for key, val in job.output.items()]
+					for job in self.jobs
+				],
+				'outsigs'    : {outfile: filesigs.get(outfile) for outfile in outfiles}
+			}))
+		rename(fpfile + '.tmp', fpfile)
+
 	def _runJobs (self):
 		"""
 		Submit and run the jobs
 		"""
-		Jobmgr(self.jobs, {
-			'nthread' : self.nthread,
-			'forks': min(self.forks, self.size),
-			'proc' : self.id,
-			'lock' : self.lock._lock_file
-		})
+		with self.endcond:
+			self.props['ended'] = []
+			self.endcond.notify_all()
+		fingerprint = self._fingerprint()
+		fpfile      = path.join(self.workdir, 'proc.fingerprint')
+		try:
+			if self._isCached(fingerprint):
+				for job in self.jobs:
+					self._jobEnded(job.index)
+			else:
+				# the jobs will be changed, the fingerprint is saved again once they all succeed
+				if path.isfile(fpfile):
+					remove(fpfile)
+				# check the files of the jobs in bulk before building them,
+				# not for stream mode, as the input files may be still being generated.
+				if self.jobs and self.jobs[0].config.get('sigstore') and not self.streaming:
+					self.jobs[0].config['filesigs'].prefetch(self.jobs[0].config['sigstore'].files())
+				Jobmgr(self.jobs, {
+					'nthread' : self.nthread,
+					'forks': min(self.forks, self.size),
+					'proc' : self.id,
+					'lock' : self.lock._lock_file,
+					'onend': self._jobEnded,
+					'feed' : self._streamJobs if self.streaming else None,
+					'priority': ProcTree.NODES[self].critical if self in ProcTree.NODES else 0,
+					'chunk': self.chunk if self.chunk['size'] > 1 else None
+				})
+				self._saveFingerprint(fingerprint)
+		finally:
+			if self.streaming:
+				self._saveSettings()
+			if self.jobs and self.jobs[0].config.get('sigstore'):
+				self.jobs[0].config['sigstore'].close()
 
 		self.props['channel'] = Channel.create([
 			tuple(job.data.o.values())
@@ -20,7 +20,10 @@ class ProcNode(object):
 		self.prev    = [] # prev nodes
 		self.next    = [] # next nodes
 		self.ran     = False
+		self.done    = False
 		self.start   = False
+		# estimated remaining critical path length (seconds), including the process itself
+		self.critical = 0
 		self.defs    = traceback.format_stack()[:-4]
 
 	def sameIdTag(self, proc):
@@ -115,7 +118,9 @@ class ProcTree(object):
 			node.prev   = []
 			node.next   = []
 			node.ran    = False
+			node.done   = False
 			node.start  = False
+			node.critical = 0
 	
 	def __init__(self):
 		"""
@@ -281,6 +286,39 @@ class ProcTree(object):
 						yield p
 						ret.add(pstr)
 
+	def setCritical(self, estimate):
+		"""
+		Estimate the remaining critical path length of the processes reachable from the start processes:
+		the time of the process plus the longest one of the processes depending on it.
+		@params:
+			`estimate`: A function to estimate the time of a process, returning `None` if unknown.
+				The unknown ones are estimated as the average of the known ones (`1` if none is known).
+		"""
+		nodes = []
+		todo  = [ProcTree.NODES[s] for s in self.getStarts()]
+		while todo:
+			node = todo.pop()
+			if node in nodes:
+				continue
+			nodes.append(node)
+			todo.extend(node.next)
+
+		times   = {node: estimate(node.proc) for node in nodes}
+		known   = [t for t in times.values() if t is not None]
+		default = sum(known) / float(len(known)) if known else 1.0
+
+		critical = {}
+		def getCritical(node):
+			"""Get the critical path length from a node"""
+			if node not in critical:
+				time = times.get(node)
+				critical[node] = (default if time is None else time) + \
+					max([getCritical(nn) for nn in node.next] or [0])
+			return critical[node]
+
+		for node in nodes:
+			node.critical = getCritical(node)
+
 	@classmethod
 	def getNextToRun(cls):
 		"""
@@ -301,6 +339,47 @@ class ProcTree(object):
 				#ret.append(node.proc)
 		return None
 
+	@classmethod
+	def getReadyToRun(cls, limit = None):
+		"""
+		Get the processes ready to run concurrently: not started yet, 
+		and all processes they depend on have done.
+		A process in stream mode (`proc.stream`) depending on one process 
+		is ready once that process starts.
+		The processes on the longer critical paths (see `setCritical`) come first.
+		The processes returned are marked as started (`ran`).
+		@params:
+			`limit`: Get at most `limit` processes. Default: `None` (no limit)
+		@returns:
+			The processes ready to run
+		"""
+		ready = []
+		for node in ProcTree.NODES.values():
+			if node.ran: continue
+			if not node.start and not node.prev: continue
+			if node.start or all([p.done for p in node.prev]) or \
+				(node.proc.stream and len(node.prev) == 1 and node.prev[0].ran):
+				ready.append(node)
+		# stable, the order of definition is kept if no critical paths estimated
+		ready.sort(key = lambda node: -node.critical)
+		ret = []
+		for node in ready[:limit]:
+			node.ran = True
+			ret.append(node.proc)
+		# processes in stream mode may be ready once the ones they depend on start
+		if ret and (limit is None or len(ret) < limit):
+			ret.extend(cls.getReadyToRun(None if limit is None else limit - len(ret)))
+		return ret
+
+	@staticmethod
+	def setDone(proc):
+		"""
+		Mark a process as done, so that processes depending on it can be run.
+		@params:
+			`proc`: The `Proc` instance
+		"""
+		ProcTree.NODES[proc].done = True
+
 	def unranProcs(self):
 		"""
 		Get the unran processes.
@@ -3,19 +3,32 @@ The base runner class
 """
 import sys
 import atexit
-from os import path
-from time import sleep
-from subprocess import list2cmdline
+from os import path, devnull
+from time import sleep, time
+from threading import Thread
+from subprocess import list2cmdline, CalledProcessError
 from multiprocessing import Lock
-from pyppl.utils import safefs, cmd, ps
+from pyppl.utils import safefs, cmd, ps, box
 
 class Runner (object):
 	"""
 	The base runner class
+
+	@static variables:
+		`INTERVAL` : How long the result of a batch status query is cached
+		`POLL`     : The bounds (seconds) of the interval to poll a running job, 
+			and how many times it grows each time the job is found still running.
+			Could be overridden by `<runner>Runner.poll.min/max/backoff` of `runnerOpts`
+		`FLUSHLOCK`: The lock to flush the stdout/stderr
+		`QUERIES`  : The cached batch status queries (command => (time, ids of alive jobs))
+		`QUERYLOCK`: The lock for the batch status queries
 	"""
 	
 	INTERVAL  = 1
+	POLL      = {'min': .5, 'max': 30, 'backoff': 1.5}
 	FLUSHLOCK = Lock()
+	QUERIES   = {}
+	QUERYLOCK = Lock()
 	
 	def __init__ (self, job):
 		"""
@@ -26,6 +39,29 @@ class Runner (object):
 		self.script  = safefs.SafeFs._chmodX(job.script)
 		self.job     = job
 		self.cmd2run = list2cmdline(self.script)
+		# max number of jobs to submit at once as an array job, 0 to submit them one by one
+		self.array   = 0
+		# called with the job index when the job exits, if the runner is able to tell it
+		self.onexit  = None
+		# the name used to register the runner: RunnerSge => sge
+		name = self.__class__.__name__
+		name = name[6:].lower() if name.startswith('Runner') else name
+		conf = job.config.get('runnerOpts', {}).get(name + 'Runner', {})
+		self.poll    = {key: float(conf.get('poll.' + key, val)) for key, val in self.POLL.items()}
+
+	def nextPoll(self, interval = None):
+		"""
+		Tell when to poll the job next time.
+		Jobs are polled shortly after submission, so that short jobs are detected promptly,
+		then less and less frequently while they are running.
+		@params:
+			`interval`: The last interval, `None` if the job was just submitted
+		@returns:
+			The interval in seconds
+		"""
+		if interval is None:
+			return self.poll['min']
+		return max(self.poll['min'], min(interval * self.poll['backoff'], self.poll['max']))
 
 	def kill(self):
 		"""
@@ -34,6 +70,31 @@ class Runner (object):
 		if self.job.pid:
 			ps.killtree(int(self.job.pid), killme = True, sig = 9)
 
+	def reserve(self):
+		"""
+		Take what the runner needs to submit the job (i.e. a slot on a server) without waiting.
+		Called by the job manager before the job is dispatched for submission.
+		@returns:
+			`True` if taken, `False` if the job has to wait.
+		"""
+		return True
+
+	def release(self):
+		"""
+		Tell the runner that the job is no longer running (done, failed or to retry),
+		so that what it has taken for the job (i.e. a slot on a server) can be given back.
+		"""
+		pass
+
+	def lend(self, runner):
+		"""
+		Lend what is taken for the job to another runner of it (i.e. the one submitting the chunk led by the job),
+		which is given back when this runner is released.
+		@params:
+			`runner`: The other runner
+		"""
+		pass
+
 	def submit (self):
 		"""
 		Try to submit the job
@@ -46,6 +107,44 @@ class Runner (object):
 		c.rc = 0
 		return c
 
+	@staticmethod
+	def submitArray (runners):
+		"""
+		Submit the jobs at once as an array job.
+		Runners without array job support submit them one by one.
+		@params:
+			`runners`: The runners of the jobs to submit
+		@returns:
+			The result of the submission, with `rc` and `cmd`
+		"""
+		for runner in runners:
+			r = runner.submit()
+			if r.rc != 0:
+				break
+		return r
+
+	@staticmethod
+	def _arrayTasks (spec):
+		"""
+		Expand the task ids of an array job reported by the scheduler
+		@params:
+			`spec`: The task ids, i.e. `1-10:2` or `1,3,5` (sge), `[1-3,5%2]` (slurm)
+		@returns:
+			The list of task ids
+		"""
+		ret = []
+		for part in spec.strip('[]').split('%')[0].split(','):
+			step = '1'
+			if ':' in part:
+				part, step = part.split(':', 1)
+			if '-' in part:
+				start, end = part.split('-', 1)
+				if start.isdigit() and end.isdigit() and step.isdigit():
+					ret.extend(str(task) for task in range(int(start), int(end) + 1, int(step) or 1))
+			elif part.isdigit():
+				ret.append(part)
+		return ret
+
 	def isRunning (self):
 		"""
 		Try to tell whether the job is still running.
@@ -56,6 +155,69 @@ class Runner (object):
 			return False
 		return ps.exists(int(self.job.pid))
 
+	def _queryCmd (self):
+		"""
+		The command to query the status of all jobs at once
+		@returns:
+			The command list, `None` if batch query is not supported.
+		"""
+		return None
+
+	def _parseQuery (self, output):
+		"""
+		Parse the output of the batch status query
+		@params:
+			`output`: The stdout of the query command
+		@returns:
+			The ids of the alive jobs
+		"""
+		return set() # pragma: no cover
+
+	def queryRunning (self):
+		"""
+		Get the ids of all alive jobs with one batch status query.
+		The result is shared by the jobs with the same query command, and cached for `INTERVAL` seconds,
+		so that the scheduler is queried once per interval, instead of once per job.
+		@returns:
+			The ids of the alive jobs, `None` if batch query is not supported or failed.
+		"""
+		cmdlist = self._queryCmd()
+		if not cmdlist:
+			return None
+		key = list2cmdline(cmdlist)
+		with Runner.QUERYLOCK:
+			queried = Runner.QUERIES.get(key)
+			if queried and time() - queried[0] < self.INTERVAL:
+				return queried[1]
+			try:
+				r = cmd.run(cmdlist)
+			except (OSError, CalledProcessError):
+				return None
+			if r.rc != 0:
+				return None
+			alive = self._parseQuery(r.stdout)
+			Runner.QUERIES[key] = (time(), alive)
+			return alive
+
+	def _updateQuery (self, alive):
+		"""
+		Update the cached batch status query with the job submitted or killed by us,
+		so that the cache does not have to be invalidated.
+		@params:
+			`alive`: Whether the job is alive
+		"""
+		cmdlist = self._queryCmd()
+		if not cmdlist or not self.job.pid:
+			return
+		with Runner.QUERYLOCK:
+			queried = Runner.QUERIES.get(list2cmdline(cmdlist))
+			if not queried:
+				return
+			if alive:
+				queried[1].add(str(self.job.pid))
+			else:
+				queried[1].discard(str(self.job.pid))
+
 class _LocalSubmitter(object):
 	
 	def __init__(self, script):
@@ -108,6 +270,97 @@ class _LocalSubmitter(object):
 		with open(self.rcfile, 'w') as frc:
 			frc.write(str(self.proc.rc))
 
+class _LocalSupervisor(object):
+	"""
+	Spawn the job scripts from the PyPPL process, instead of starting a python interpreter (`_LocalSubmitter`) for each job.
+	The script is run by a shell that writes the rc file when the script exits, 
+	so that the rc file is written even if the PyPPL process quits while the job is running.
+	Each job is waited for by a thread blocked until the job exits, which tells whom is waiting for it.
+	The pid, stdout and stderr files are written the same way as `_LocalSubmitter` does.
+
+	@static variables:
+		`WRAPPER`: The shell command to run the script (`$@`) and write the rc file (`$0`)
+	"""
+	WRAPPER = '"$@"; printf %s $? > "$0"'
+
+	@staticmethod
+	def spawn(runner):
+		"""
+		Spawn the script of a job and supervise it.
+		@params:
+			`runner`: The runner of the job
+		@returns:
+			The `utils.cmd.Cmd` instance if spawned
+			else a `Box` object with the exception in the stderr file and rc as 0 (the job will fail with rc 88)
+		"""
+		job    = runner.job
+		script = runner.script[-1] if isinstance(runner.script, list) else runner.script
+		while True:
+			outfd  = open(job.outfile, 'w')
+			errfd  = open(job.errfile, 'w')
+			nullfd = open(devnull)
+			try:
+				c = cmd.Cmd(
+					['/bin/sh', '-c', _LocalSupervisor.WRAPPER, job.rcfile] + safefs.SafeFs._chmodX(path.abspath(script)),
+					stdin = nullfd, stdout = outfd, stderr = errfd
+				)
+				break
+			except Exception:
+				from traceback import format_exc
+				ex = format_exc()
+				if 'Text file busy' in str(ex):
+					sleep(.1)
+					continue
+				errfd.write(str(ex))
+				errfd.close()
+				c     = box.Box()
+				c.cmd = script
+				c.rc  = 0
+				_LocalSupervisor._end(runner, 88)
+				return c
+			finally:
+				# the process has its own copies
+				outfd.close()
+				errfd.close()
+				nullfd.close()
+
+		with open(job.pidfile, 'w') as fpid:
+			fpid.write(str(c.pid))
+		c.rc = 0
+		waiter = Thread(target = _LocalSupervisor._wait, args = (c.p, runner))
+		waiter.daemon = True
+		waiter.start()
+		return c
+
+	@staticmethod
+	def _wait(proc, runner):
+		"""
+		Wait for a job to exit, and end it
+		@params:
+			`proc`  : The process of the job
+			`runner`: The runner of the job
+		"""
+		_LocalSupervisor._end(runner, proc.wait())
+
+	@staticmethod
+	def _end(runner, rc):
+		"""
+		Write the rc file of a job if it is not written by the shell (i.e. killed), and tell whom is waiting for it
+		@params:
+			`runner`: The runner of the job
+			`rc`    : The return code
+		"""
+		try:
+			with open(runner.job.rcfile) as frc:
+				written = bool(frc.read().strip())
+		except (IOError, OSError):
+			written = False
+		if not written:
+			with open(runner.job.rcfile, 'w') as frc:
+				frc.write(str(rc))
+		if runner.onexit:
+			runner.onexit(runner.job.index)
+
 if __name__ == '__main__': # pragma: no cover
 	# work as local submitter
 	submitter = _LocalSubmitter(sys.argv[1])
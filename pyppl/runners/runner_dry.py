@@ -1,7 +1,7 @@
 """
 Dry runner for PyPPL
 """
-from .runner import Runner
+from .runner import Runner, _LocalSupervisor
 from ..proc import Proc
 
 class RunnerDry (Runner):
@@ -33,4 +33,11 @@ class RunnerDry (Runner):
 
 		with open (self.script, 'w') as f:
 			f.write ('\n'.join(drysrc) + '\n')
-		
+
+	def submit(self):
+		"""
+		Submit the job, the script is spawned and supervised by the PyPPL process.
+		@returns:
+			The `utils.cmd.Cmd` instance
+		"""
+		return _LocalSupervisor.spawn(self)
@@ -1,7 +1,7 @@
 """
 Local runner
 """
-from .runner import Runner
+from .runner import Runner, _LocalSupervisor
 
 class RunnerLocal (Runner):
 	"""
@@ -32,3 +32,11 @@ class RunnerLocal (Runner):
 		
 		with open (self.script, 'w') as f:
 			f.write ('\n'.join(localsrc) + '\n')
+
+	def submit(self):
+		"""
+		Submit the job, the script is spawned and supervised by the PyPPL process.
+		@returns:
+			The `utils.cmd.Cmd` instance
+		"""
+		return _LocalSupervisor.spawn(self)
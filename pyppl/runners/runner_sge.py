@@ -4,6 +4,8 @@ SGE runner for PyPPL
 
 import re
 import copy
+from os import path
+from getpass import getuser
 from subprocess import CalledProcessError, list2cmdline
 from .runner import Runner
 from ..utils import cmd, box
@@ -14,6 +16,7 @@ class RunnerSge (Runner):
 	"""
 	
 	INTERVAL = 5
+	POLL     = {'min': 2, 'max': 300, 'backoff': 2}
 
 	def __init__ (self, job):
 		"""
@@ -91,6 +94,11 @@ class RunnerSge (Runner):
 				src += ' ' + str(v)
 			sgesrc.append(src)
 
+		self.jobname    = jobname
+		# the directives shared by all jobs of the process, used by array jobs
+		self.directives = [src for src in sgesrc[1:] if not src.startswith(('#$ -N ', '#$ -o ', '#$ -e '))]
+		self.array      = int(conf.get('array', 0))
+
 		sgesrc.append ('')
 		sgesrc.append ('trap "status=\\$?; echo \\$status >\'%s\'; exit \\$status" 1 2 3 6 7 8 9 10 11 12 15 16 17 EXIT' % self.job.rcfile)
 		
@@ -122,6 +130,58 @@ class RunnerSge (Runner):
 				r.rc = 1
 			else:
 				self.job.pid = m.group(1)
+				self._updateQuery(True)
+			return r
+
+		except (OSError, CalledProcessError) as ex:
+			r        = box.Box()
+			r.stderr = str(ex)
+			r.rc     = 1
+			r.cmd    = list2cmdline(cmdlist)
+			return r
+
+	@staticmethod
+	def submitArray(runners):
+		"""
+		Submit the jobs at once as an array job.
+		Task `i` of the array job runs the script of the `i`th job, whose pid will be `<jobid>.<i>`
+		@params:
+			`runners`: The runners of the jobs to submit
+		@returns:
+			The `utils.cmd.Cmd` instance if succeed 
+			else a `Box` object with stderr as the exception and rc as 1
+		"""
+		first  = runners[0]
+		script = path.join(path.dirname(first.job.dir), 'job.array.%s.sge' % (first.job.index + 1))
+		sgesrc = [
+			'#!/usr/bin/env bash',
+			'#$ -N %s' % first.jobname,
+			'#$ -t 1-%s' % len(runners),
+			'#$ -o /dev/null',
+			'#$ -e /dev/null',
+		] + first.directives + ['', 'case $SGE_TASK_ID in']
+		for i, runner in enumerate(runners):
+			sgesrc.append('\t%s) bash %s >%s 2>%s;;' % (
+				i + 1, 
+				list2cmdline([runner.script]), 
+				list2cmdline([runner.job.outfile]), 
+				list2cmdline([runner.job.errfile])
+			))
+		sgesrc.append('esac')
+		with open(script, 'w') as f:
+			f.write('\n'.join(sgesrc) + '\n')
+
+		cmdlist = [first.commands['qsub'], script]
+		try:
+			r = cmd.run(cmdlist)
+			# Your job-array 6556149.1-3:1 ("pSort.notag.3omQ6NdZ.1") has been submitted
+			m = re.search(r'\s(\d+)[\s.]', r.stdout)
+			if not m:
+				r.rc = 1
+			else:
+				for i, runner in enumerate(runners):
+					runner.job.pid = '%s.%s' % (m.group(1), i + 1)
+					runner._updateQuery(True)
 			return r
 
 		except (OSError, CalledProcessError) as ex:
@@ -138,6 +198,7 @@ class RunnerSge (Runner):
 		cmdlist = [self.commands['qdel'], '--force', str(self.job.pid)]
 		try:
 			cmd.run(cmdlist)
+			self._updateQuery(False)
 		except (OSError, CalledProcessError): # pragma: no cover
 			pass
 
@@ -149,9 +210,49 @@ class RunnerSge (Runner):
 		"""
 		if not self.job.pid:
 			return False
+		alive = self.queryRunning()
+		if alive is not None:
+			return str(self.job.pid) in alive
+		# batch query failed, try to query the job itself
 		cmdlist = [self.commands['qstat'], '-j', str(self.job.pid)]
 		try:
 			r = cmd.run(cmdlist)
 			return r.rc == 0
 		except (OSError, CalledProcessError):
 			return False
+
+	def _queryCmd(self):
+		"""
+		The command to query the status of all jobs at once
+		@returns:
+			The command list
+		"""
+		return [self.commands['qstat'], '-u', getuser()]
+
+	def _parseQuery(self, output):
+		"""
+		Parse the output of the batch status query
+		@params:
+			`output`: The stdout of the query command
+		@returns:
+			The ids of the alive jobs
+		"""
+		# job-ID  prior   name       user         state submit/start at     queue   slots ja-task-ID
+		# -----------------------------------------------------------------------------------------
+		# 6556149 0.50500 pSort.nota user         r     05/01/2019 10:00:00 all.q@node  1
+		# 6556150 0.50500 pSort.nota user         r     05/01/2019 10:00:00 all.q@node  1 1
+		# 6556150 0.50500 pSort.nota user         qw    05/01/2019 10:00:00             1 2-10:1
+		ret = set()
+		for line in output.splitlines():
+			parts = line.split()
+			if not parts or not parts[0].isdigit():
+				continue
+			ret.add(parts[0])
+			# queue is empty for pending jobs
+			rest = parts[7:]
+			if rest and not rest[0].isdigit():
+				rest = rest[1:]
+			# slots and ja-task-ID
+			if len(rest) > 1:
+				ret.update(parts[0] + '.' + task for task in Runner._arrayTasks(rest[1]))
+		return ret
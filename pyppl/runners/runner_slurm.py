@@ -3,6 +3,8 @@ Slurm runner for PyPPL
 """
 import re
 import copy
+from os import path
+from getpass import getuser
 from subprocess import CalledProcessError, list2cmdline
 from .runner import Runner
 from ..utils import cmd, box
@@ -13,6 +15,7 @@ class RunnerSlurm (Runner):
 	"""
 	
 	INTERVAL = 5
+	POLL     = {'min': 2, 'max': 300, 'backoff': 2}
 	
 	def __init__ (self, job):
 		"""
@@ -78,6 +81,11 @@ class RunnerSlurm (Runner):
 				src += ' ' + str(v)
 			slurmsrc.append(src)
 
+		self.jobname    = jobname
+		# the directives shared by all jobs of the process, used by array jobs
+		self.directives = [src for src in slurmsrc[1:] if not src.startswith(('#SBATCH -J ', '#SBATCH -o ', '#SBATCH -e '))]
+		self.array      = int(conf.get('array', 0))
+
 		slurmsrc.append ('')
 		slurmsrc.append ('trap "status=\\$?; echo \\$status >\'%s\'; exit \\$status" 1 2 3 6 7 8 9 10 11 12 15 16 17 EXIT' % self.job.rcfile)
 		
@@ -109,6 +117,58 @@ class RunnerSlurm (Runner):
 				r.rc = 1
 			else:
 				self.job.pid = m.group(1)
+				self._updateQuery(True)
+			return r
+
+		except (OSError, CalledProcessError) as ex:
+			r        = box.Box()
+			r.stderr = str(ex)
+			r.rc     = 1
+			r.cmd    = list2cmdline(cmdlist)
+			return r
+
+	@staticmethod
+	def submitArray(runners):
+		"""
+		Submit the jobs at once as an array job.
+		Task `i` of the array job runs the script of the `i`th job, whose pid will be `<jobid>_<i>`
+		@params:
+			`runners`: The runners of the jobs to submit
+		@returns:
+			The `utils.cmd.Cmd` instance if succeed 
+			else a `Box` object with stderr as the exception and rc as 1
+		"""
+		first    = runners[0]
+		script   = path.join(path.dirname(first.job.dir), 'job.array.%s.slurm' % (first.job.index + 1))
+		slurmsrc = [
+			'#!/usr/bin/env bash',
+			'#SBATCH -J %s' % first.jobname,
+			'#SBATCH --array=1-%s' % len(runners),
+			'#SBATCH -o /dev/null',
+			'#SBATCH -e /dev/null',
+		] + first.directives + ['', 'case $SLURM_ARRAY_TASK_ID in']
+		for i, runner in enumerate(runners):
+			slurmsrc.append('\t%s) bash %s >%s 2>%s;;' % (
+				i + 1, 
+				list2cmdline([runner.script]), 
+				list2cmdline([runner.job.outfile]), 
+				list2cmdline([runner.job.errfile])
+			))
+		slurmsrc.append('esac')
+		with open(script, 'w') as f:
+			f.write('\n'.join(slurmsrc) + '\n')
+
+		cmdlist = [first.commands['sbatch'], script]
+		try:
+			r = cmd.run(cmdlist)
+			# Submitted batch job 1823334668
+			m = re.search(r'\s(\d+)$', r.stdout.strip())
+			if not m:
+				r.rc = 1
+			else:
+				for i, runner in enumerate(runners):
+					runner.job.pid = '%s_%s' % (m.group(1), i + 1)
+					runner._updateQuery(True)
 			return r
 
 		except (OSError, CalledProcessError) as ex:
@@ -125,6 +185,7 @@ class RunnerSlurm (Runner):
 		cmdlist = [self.commands['scancel'], str(self.job.pid)]
 		try:
 			cmd.run(cmdlist)
+			self._updateQuery(False)
 		except (OSError, CalledProcessError): # pragma: no cover
 			pass
 
@@ -136,9 +197,43 @@ class RunnerSlurm (Runner):
 		"""
 		if not self.job.pid:
 			return False
+		alive = self.queryRunning()
+		if alive is not None:
+			return str(self.job.pid) in alive
+		# batch query failed, try to query the job itself
 		cmdlist = [self.commands['squeue'], '-j', str(self.job.pid)]
 		try:
 			r = cmd.run(cmdlist)
 			return r.rc == 0
 		except (OSError, CalledProcessError):
 			return False
+
+	def _queryCmd(self):
+		"""
+		The command to query the status of all jobs at once
+		@returns:
+			The command list
+		"""
+		return [self.commands['squeue'], '-h', '-o', '%i', '-u', getuser()]
+
+	def _parseQuery(self, output):
+		"""
+		Parse the output of the batch status query
+		@params:
+			`output`: The stdout of the query command
+		@returns:
+			The ids of the alive jobs
+		"""
+		# 1823334668
+		# 1823334669_1
+		# 1823334669_[2-10%4]
+		ret = set()
+		for line in output.splitlines():
+			parts = line.split()
+			if not parts:
+				continue
+			ret.add(parts[0])
+			jobid, _, tasks = parts[0].partition('_')
+			if tasks.startswith('['):
+				ret.update(jobid + '_' + task for task in Runner._arrayTasks(tasks))
+		return ret
@@ -2,9 +2,13 @@
 The ssh runner
 """
 import sys
-from os import path, getcwd
+from os import path, getcwd, makedirs, devnull, remove
+from time import time, sleep
+from getpass import getuser
+from hashlib import md5
+from tempfile import gettempdir
 from subprocess import list2cmdline
-from threading import Lock
+from threading import Lock, Condition
 from .runner import Runner
 from ..utils import cmd, ps
 from ..exception import RunnerSshError
@@ -12,9 +16,32 @@ from ..exception import RunnerSshError
 class RunnerSsh(Runner):
 	"""
 	The ssh runner
+	Commands to a server share one persistent connection (the master, see `ControlMaster` in `man ssh_config`),
+	so that the jobs do not have to connect to the server for each submission, status check and kill.
+	A job is sent to the least-loaded live server when it is submitted, 
+	and waits if all the servers are full (see `slots` of `sshRunner`).
+
+	@static variables:
+		`LIVE_SERVERS`: The indices of the alive servers
+		`LOCK`        : The lock to check the alive servers and to assign the jobs to the servers
+		`FREED`       : The condition to wait for a free slot on the servers
+		`MASTERS`     : The connections (ssh command => (time checked, `True` if the master is connected else `False`))
+		`MASTERLOCKS` : The locks to connect the masters, one for each connection
+		`MASTERCHECK` : How long (seconds) a master is trusted without checking whether it is still alive
+		`CTRLDIR`     : The directory of the control sockets
+		`ASSIGNED`    : The number of the jobs in flight on each server (server => number of jobs)
+		`LOADS`       : The free cores of the servers queried (server => (time, free cores))
 	"""
 	LIVE_SERVERS = None
 	LOCK         = Lock()
+	FREED        = Condition(LOCK)
+	MASTERS      = {}
+	MASTERLOCKS  = {}
+	MASTERCHECK  = 60
+	CTRLDIR      = path.join(gettempdir(), 'PyPPL.ssh.' + getuser())
+	ASSIGNED     = {}
+	LOADS        = {}
+	POLL         = {'min': 1, 'max': 60, 'backoff': 1.5}
 	
 	@staticmethod
 	def isServerAlive(server, key = None, timeout = 3):
@@ -80,31 +107,268 @@ class RunnerSsh(Runner):
 		if not RunnerSsh.LIVE_SERVERS:
 			raise RunnerSshError('No server is alive.')
 
-		sid    = RunnerSsh.LIVE_SERVERS[job.index % len(RunnerSsh.LIVE_SERVERS)]
-		server = servers[sid]
-		key    = keys[sid] if keys else None
+		self.conf      = conf
+		self.servers   = servers
+		self.keys      = keys
+		# max number of jobs in flight on each server, 0 for no limit
+		slots          = conf.get('slots', 0)
+		self.slots     = slots if isinstance(slots, list) else [slots] * len(servers)
+		# prefer the servers with more free cores
+		self.checkLoad = conf.get('checkLoad', False)
+		# how long the master connection persists after the last command, falsy to disable it
+		self.persist   = conf.get('controlPersist', 600)
+		self.ctrlpath  = None
+		self.cmd2run   = "cd %s; %s" % (getcwd(), self.cmd2run)
+		# the server is decided when the job is submitted, use the one in turn for now
+		self.sid       = None
+		# the index of the server whose slot is taken by the job
+		self.taken     = None
+		# the runner the slot is lent to
+		self.lent      = None
+		self._useServer(RunnerSsh.LIVE_SERVERS[job.index % len(RunnerSsh.LIVE_SERVERS)])
 
-		self.cmd2run = "cd %s; %s" % (getcwd(), self.cmd2run)
-		sshsrc       = [
+	def _useServer(self, sid):
+		"""
+		Use a server to run the job
+		@params:
+			`sid`: The index of the server
+		"""
+		if sid == self.sid:
+			return
+		self.sid      = sid
+		self.server   = self.servers[sid]
+		self.sshcmd   = self._sshcmd(sid)
+		self.ctrlpath = self._ctrlpath(sid)
+		sshsrc      = [
 			'#!/usr/bin/env bash',
-			'# run on server: {}'.format(server),
+			'# run on server: {}'.format(self.server),
 			''
 		]
-		if 'preScript' in conf:
-			sshsrc.append (conf['preScript'])
+		if 'preScript' in self.conf:
+			sshsrc.append (self.conf['preScript'])
 		
 		sshsrc.append(self.cmd2run)
 		
-		if 'postScript' in conf:
-			sshsrc.append (conf['postScript'])
+		if 'postScript' in self.conf:
+			sshsrc.append (self.conf['postScript'])
 
 		with open (self.script, 'w') as f:
 			f.write ('\n'.join(sshsrc) + '\n')
 
-		self.sshcmd = ['ssh', '-t', server]
-		if key:
-			self.sshcmd.append('-i')
-			self.sshcmd.append(key)
+	def _ctrlpath(self, sid):
+		"""
+		Get the path of the control socket of the master for a server.
+		The path is decided by us instead of ssh (`%C`), so that we can tell whether the master is gone.
+		@params:
+			`sid`: The index of the server
+		@returns:
+			The path, `None` if the master is not used.
+		"""
+		if not self.persist:
+			return None
+		ident = list2cmdline([
+			self.conf.get('ssh', 'ssh'), self.servers[sid], self.keys[sid] if self.keys and self.keys[sid] else ''
+		])
+		return path.join(RunnerSsh.CTRLDIR, md5(ident.encode('utf-8')).hexdigest())
+
+	def _sshcmd(self, sid):
+		"""
+		Get the ssh command to run commands on a server
+		@params:
+			`sid`: The index of the server
+		@returns:
+			The ssh command list
+		"""
+		sshcmd = [self.conf.get('ssh', 'ssh'), '-t', self.servers[sid]]
+		if self.keys and self.keys[sid]:
+			sshcmd.append('-i')
+			sshcmd.append(self.keys[sid])
+
+		if self.persist:
+			# commands use the master if it is connected, otherwise connect to the server by themselves
+			sshcmd.append('-o')
+			sshcmd.append('ControlPath=' + self._ctrlpath(sid))
+		return sshcmd
+
+	def _freeCores(self, sid):
+		"""
+		Get the number of free cores of a server (number of cores - 1-minute load average),
+		cached for `INTERVAL` seconds.
+		@params:
+			`sid`: The index of the server
+		@returns:
+			The number of free cores, `0` if failed to query.
+		"""
+		server  = self.servers[sid]
+		queried = RunnerSsh.LOADS.get(server)
+		if queried and time() - queried[0] < self.INTERVAL:
+			return queried[1]
+		sshcmd = self._sshcmd(sid)
+		self._connect(sid)
+		free   = 0
+		try:
+			c = cmd.run(sshcmd + ['nproc; cat /proc/loadavg'])
+			if c.rc == 0:
+				ncores, load = c.stdout.split()[:2]
+				free = int(ncores) - float(load)
+		except (OSError, ValueError):
+			pass
+		RunnerSsh.LOADS[server] = (time(), free)
+		return free
+
+	def _select(self):
+		"""
+		Select the least-loaded live server that has free slots.
+		Servers are tried in turn starting from the one for the job index, to break the ties.
+		Should be called with `RunnerSsh.LOCK` acquired.
+		@returns:
+			The index of the server, `None` if all the servers are full.
+		"""
+		nlive  = len(RunnerSsh.LIVE_SERVERS)
+		start  = self.job.index % nlive
+		best   = None
+		bestld = None
+		for i in range(nlive):
+			sid   = RunnerSsh.LIVE_SERVERS[(start + i) % nlive]
+			njobs = RunnerSsh.ASSIGNED.get(self.servers[sid], 0)
+			if self.slots[sid] and njobs >= self.slots[sid]:
+				continue
+			load = njobs
+			if self.checkLoad:
+				queried = RunnerSsh.LOADS.get(self.servers[sid])
+				load   -= queried[1] if queried else 0
+			if bestld is None or load < bestld:
+				best, bestld = sid, load
+		return best
+
+	def _take(self, sid):
+		"""
+		Take a slot on a server for the job.
+		Should be called with `RunnerSsh.LOCK` acquired.
+		@params:
+			`sid`: The index of the server
+		"""
+		self.taken = sid
+		server     = self.servers[sid]
+		RunnerSsh.ASSIGNED[server] = RunnerSsh.ASSIGNED.get(server, 0) + 1
+
+	def reserve(self):
+		"""
+		Take a slot on the least-loaded live server for the job without waiting.
+		The free cores of the servers last queried are used if `checkLoad` is set.
+		@returns:
+			`True` if a slot is taken, `False` if all the servers are full.
+		"""
+		with RunnerSsh.LOCK:
+			if self.taken is None:
+				sid = self._select()
+				if sid is None:
+					return False
+				self._take(sid)
+		return True
+
+	def _assign(self):
+		"""
+		Assign the job to the server reserved, or to the least-loaded live server,
+		wait until a server has a free slot.
+		"""
+		if self.checkLoad:
+			# query the load out of the lock, for the following jobs to be assigned
+			for sid in RunnerSsh.LIVE_SERVERS:
+				self._freeCores(sid)
+		with RunnerSsh.LOCK:
+			while self.taken is None:
+				sid = self._select()
+				if sid is not None:
+					self._take(sid)
+				else:
+					# woken up when a job on the servers is released
+					RunnerSsh.FREED.wait()
+			sid = self.taken
+		self._useServer(sid)
+
+	def _release(self):
+		"""
+		Release the slot taken by the job on the server, and wake up the jobs waiting for a slot.
+		Should be called with `RunnerSsh.LOCK` acquired.
+		"""
+		if self.taken is None:
+			return
+		RunnerSsh.ASSIGNED[self.servers[self.taken]] -= 1
+		self.taken = None
+		RunnerSsh.FREED.notify_all()
+
+	def release(self):
+		"""
+		Release the slot taken by the job on the server, or lent to another runner.
+		"""
+		with RunnerSsh.LOCK:
+			self._release()
+			if self.lent:
+				self.lent._release()
+				self.lent = None
+
+	def lend(self, runner):
+		"""
+		Lend the slot taken by the job to another runner of it (i.e. the one submitting the chunk led by the job),
+		so that it runs on the same server without taking another slot, and the job is checked or killed there.
+		@params:
+			`runner`: The other runner
+		"""
+		self._assign()
+		with RunnerSsh.LOCK:
+			runner.taken, self.taken = self.taken, None
+			self.lent = runner
+		runner._useServer(runner.taken)
+
+	def _connect(self, sid = None):
+		"""
+		Connect the master for the server if it is not connected, which is shared by the jobs on the server.
+		A master may be gone (closed after `controlPersist` seconds idle, or died),
+		so it is checked again before it is reused, and connected again if it is gone.
+		@params:
+			`sid`: The index of the server, default: the one of the job
+		@returns:
+			`True` if the master is connected else `False`
+		"""
+		if not self.persist:
+			return False
+		if sid is None:
+			sshcmd, ctrlpath = self.sshcmd, self.ctrlpath
+		else:
+			sshcmd, ctrlpath = self._sshcmd(sid), self._ctrlpath(sid)
+		key = list2cmdline(sshcmd)
+		with RunnerSsh.LOCK:
+			lock = RunnerSsh.MASTERLOCKS.setdefault(key, Lock())
+		with lock:
+			checked = RunnerSsh.MASTERS.get(key)
+			if checked and time() - checked[0] < RunnerSsh.MASTERCHECK:
+				# the socket is removed when the master exits normally
+				if not checked[1] or path.exists(ctrlpath):
+					return checked[1]
+			try:
+				makedirs(RunnerSsh.CTRLDIR, 0o700)
+			except OSError:
+				pass
+			# the master goes to background (-f) once connected, 
+			# don't let it hold the pipes, which makes us wait for it.
+			with open(devnull, 'r+') as fnull:
+				try:
+					c = cmd.run(sshcmd + ['-O', 'check'], stdin = fnull, stdout = fnull, stderr = fnull)
+					if c.rc != 0:
+						# the socket left by a dead master
+						if path.exists(ctrlpath):
+							remove(ctrlpath)
+						c = cmd.run(sshcmd + [
+							'-o', 'ControlMaster=yes', 
+							'-o', 'ControlPersist=%s' % self.persist,
+							'-o', 'BatchMode=yes',
+							'-f', '-N'
+						], stdin = fnull, stdout = fnull, stderr = fnull)
+					RunnerSsh.MASTERS[key] = (time(), c.rc == 0)
+				except OSError:
+					RunnerSsh.MASTERS[key] = (time(), False)
+			return RunnerSsh.MASTERS[key][1]
 
 	def submit(self):
 		"""
@@ -113,10 +377,13 @@ class RunnerSsh(Runner):
 			The `utils.cmd.Cmd` instance if succeed 
 			else a `Box` object with stderr as the exception and rc as 1
 		"""
+		self._assign()
+		self._connect()
 		cmdlist = ['ls', self.script]
 		cmdlist = list2cmdline(cmdlist)
 		c = cmd.run(self.sshcmd + [cmdlist])
 		if c.rc != 0:
+			self.release()
 			c.stderr += 'Probably the server ({}) is not using the same file system as the local machine.\n'.format(self.sshcmd)
 			return c
 		
@@ -132,6 +399,7 @@ class RunnerSsh(Runner):
 		"""
 		Kill the job
 		"""
+		self._connect()
 		cmdlist = 'ps -o pid,ppid'
 		pidlist = cmd.run(self.sshcmd + [cmdlist]).stdout.splitlines()
 		pidlist = [line.strip().split() for line in pidlist]
@@ -146,6 +414,7 @@ class RunnerSsh(Runner):
 		killcmd = ['kill', '-9'] + list(reversed(allchildren))
 		killcmd = list2cmdline(killcmd)
 		cmd.run(self.sshcmd + [killcmd])
+		self.release()
 
 	def isRunning(self):
 		"""
@@ -155,6 +424,7 @@ class RunnerSsh(Runner):
 		"""
 		if not self.job.pid:
 			return False
+		self._connect()
 		cmdlist = ['kill', '-0', str(self.job.pid)]
 		cmdlist = list2cmdline(cmdlist)
 		return cmd.run(self.sshcmd + [cmdlist]).rc == 0
@@ -275,6 +275,28 @@ def formatSecs (seconds):
 	h, m = divmod(m, 60)
 	return "%02d:%02d:%02d.%03.0f" % (h, m, s, 1000*(s-int(s)))
 
+def parseMem (mem):
+	"""
+	Parse a memory size
+	@params:
+		`mem`: the memory size, a number in MB or a string with a unit (K, M, G or T), i.e. "4G"
+	@examples:
+		```python
+		parseMem(512)     # 512
+		parseMem("4G")    # 4096
+		parseMem("1.5gb") # 1536
+		```
+	@returns:
+		The memory size in MB
+	"""
+	if isinstance(mem, (int, float)):
+		return int(mem)
+	units = {'K': 1.0/1024.0, 'M': 1, 'G': 1024, 'T': 1024*1024}
+	match = re.match(r'^\s*(\d+(?:\.\d*)?)\s*([KMGT]?)B?\s*$', str(mem), re.I)
+	if not match:
+		raise ValueError('Cannot parse memory size: {!r}'.format(mem))
+	return int(float(match.group(1)) * units[match.group(2).upper() or 'M'])
+
 def alwaysList (data):
 	"""
 	Convert a string or a list with element
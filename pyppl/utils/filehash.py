@@ -0,0 +1,165 @@
+"""
+Content hashes of files for PyPPL
+The hashes are cached persistently by the identity and the state of the files:
+`(device, inode, size, mtime in ns)`, so that a file is only hashed again if it's changed.
+"""
+import os
+import hashlib
+from threading import Lock
+try:
+	import sqlite3
+except ImportError: # pragma: no cover
+	sqlite3 = None
+
+try:
+	_hasher = hashlib.blake2b
+except AttributeError: # pragma: no cover
+	_hasher = hashlib.md5
+
+# size of the blocks to read to hash a file
+BLOCKSIZE = 1024 * 1024
+
+def _statkey(filestat):
+	"""
+	Get the key of a file to cache its hash
+	@params:
+		`filestat`: The result of `os.stat`
+	@returns:
+		`(device, inode, size, mtime in ns)`
+	"""
+	mtime = getattr(filestat, 'st_mtime_ns', None)
+	if mtime is None: # pragma: no cover
+		mtime = int(filestat.st_mtime * 1000000000)
+	return filestat.st_dev, filestat.st_ino, filestat.st_size, mtime
+
+class HashCache(object):
+	"""
+	The persistent cache of the content hashes.
+	The hashes are saved in an sqlite database if available, otherwise only kept in memory.
+
+	@static variables:
+		`CACHES`: The caches by database file, so that one database is opened once
+		`LOCK`  : The lock to get the caches
+	"""
+
+	CACHES = {}
+	LOCK   = Lock()
+
+	@staticmethod
+	def get(dbfile):
+		"""
+		Get the cache saved in a database file
+		@params:
+			`dbfile`: The database file
+		@returns:
+			The cache
+		"""
+		dbfile = os.path.realpath(dbfile)
+		with HashCache.LOCK:
+			if dbfile not in HashCache.CACHES:
+				HashCache.CACHES[dbfile] = HashCache(dbfile)
+			return HashCache.CACHES[dbfile]
+
+	def __init__(self, dbfile = None):
+		"""
+		Constructor
+		@params:
+			`dbfile`: The database file, `None` to keep the hashes in memory only
+		"""
+		self.lock   = Lock()
+		# the hashes looked up in this session
+		self.hashes = {}
+		self.db     = None
+		if dbfile and sqlite3:
+			try:
+				dbdir = os.path.dirname(dbfile)
+				if dbdir and not os.path.isdir(dbdir):
+					os.makedirs(dbdir)
+				self.db = sqlite3.connect(dbfile, timeout = 60, check_same_thread = False)
+				self.db.execute(
+					'CREATE TABLE IF NOT EXISTS hashes (dev INTEGER, ino INTEGER, size INTEGER, '
+					'mtime INTEGER, hash TEXT, PRIMARY KEY (dev, ino, size, mtime))'
+				)
+				self.db.commit()
+			except (sqlite3.Error, OSError): # pragma: no cover
+				self.db = None
+
+	def _lookup(self, key):
+		"""
+		Look up the hash of a file in the cache
+		@params:
+			`key`: The key of the file
+		@returns:
+			The hash, `None` if not cached
+		"""
+		with self.lock:
+			if key in self.hashes:
+				return self.hashes[key]
+			if not self.db:
+				return None
+			try:
+				row = self.db.execute(
+					'SELECT hash FROM hashes WHERE dev = ? AND ino = ? AND size = ? AND mtime = ?', key
+				).fetchone()
+			except sqlite3.Error: # pragma: no cover
+				return None
+			if row:
+				self.hashes[key] = str(row[0])
+			return self.hashes.get(key)
+
+	def _save(self, key, digest):
+		"""
+		Save the hash of a file to the cache
+		@params:
+			`key`   : The key of the file
+			`digest`: The hash
+		"""
+		with self.lock:
+			self.hashes[key] = digest
+			if not self.db:
+				return
+			try:
+				self.db.execute('INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?)', key + (digest, ))
+				self.db.commit()
+			except sqlite3.Error: # pragma: no cover
+				pass
+
+	def filehash(self, filepath):
+		"""
+		Get the content hash of a file, directories are hashed recursively by the names and the hashes
+		of the files in them.
+		@params:
+			`filepath`: The path of the file or directory (links are followed)
+		@returns:
+			The hash, `None` if the file does not exist.
+		"""
+		try:
+			filestat = os.stat(filepath)
+		except OSError:
+			return None
+		if os.path.isdir(filepath):
+			hasher = _hasher()
+			for name in sorted(os.listdir(filepath)):
+				digest = self.filehash(os.path.join(filepath, name))
+				hasher.update(('%s:%s\n' % (name, digest)).encode('utf-8'))
+			return hasher.hexdigest()
+
+		key    = _statkey(filestat)
+		digest = self._lookup(key)
+		if digest is not None:
+			return digest
+		hasher = _hasher()
+		try:
+			with open(filepath, 'rb') as fhash:
+				for block in iter(lambda: fhash.read(BLOCKSIZE), b''):
+					hasher.update(block)
+		except (IOError, OSError):
+			return None
+		digest = hasher.hexdigest()
+		# don't cache it if the file was changed while being hashed
+		try:
+			if key == _statkey(os.stat(filepath)):
+				self._save(key, digest)
+		except OSError: # pragma: no cover
+			pass
+		return digest
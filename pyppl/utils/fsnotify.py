@@ -0,0 +1,196 @@
+"""
+File system notification for PyPPL
+Directories are watched by inotify (Linux) through ctypes, so that no extra dependency is needed.
+Directories on network file systems (i.e. NFS) are not watched, as the changes made by other hosts
+are not notified there. The callers should fall back to polling when a directory cannot be watched.
+"""
+import os
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+from threading import Thread, Lock
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO    = 0x00000080
+IN_Q_OVERFLOW  = 0x00004000
+IN_IGNORED     = 0x00008000
+IN_NONBLOCK    = 0o4000
+IN_CLOEXEC     = 0o2000000
+# wd, mask, cookie, len
+EVENT_HEADER   = struct.Struct('iIII')
+# file systems that the changes made by other hosts are not notified
+NETFS = (
+	'nfs', 'nfs4', 'cifs', 'smbfs', 'smb3', 'afs', 'lustre', 'gpfs', 'beegfs',
+	'glusterfs', 'ceph', 'panfs', '9p', 'fuse.sshfs', 'fuse.glusterfs', 'fuse.ceph'
+)
+
+def _libc():
+	"""
+	Load the libc with inotify support
+	@returns:
+		The libc, `None` if inotify is not available.
+	"""
+	try:
+		libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno = True)
+	except (OSError, TypeError): # pragma: no cover
+		return None
+	if not all(hasattr(libc, func) for func in ('inotify_init1', 'inotify_add_watch', 'inotify_rm_watch')):
+		return None # pragma: no cover
+	return libc
+
+def mounts():
+	"""
+	Get the mount points and their file system types
+	@returns:
+		The list of `(mount point, file system type)`, the longest mount points first.
+	"""
+	ret = []
+	try:
+		with open('/proc/mounts') as fmounts:
+			for line in fmounts:
+				parts = line.split()
+				if len(parts) < 3:
+					continue
+				# spaces are escaped as \040
+				ret.append((parts[1].replace('\\040', ' '), parts[2]))
+	except (IOError, OSError): # pragma: no cover
+		pass
+	return sorted(ret, key = lambda mount: -len(mount[0]))
+
+def fstype(dirpath, mountlist = None):
+	"""
+	Get the file system type of a directory
+	@params:
+		`dirpath`  : The directory
+		`mountlist`: The mount points from `mounts()`, will be read if not given.
+	@returns:
+		The file system type, `None` if unknown.
+	"""
+	dirpath = os.path.realpath(dirpath)
+	for mount, fstp in (mounts() if mountlist is None else mountlist):
+		if dirpath == mount or dirpath.startswith(mount.rstrip('/') + '/'):
+			return fstp
+	return None
+
+class Watcher(object):
+	"""
+	Watch the directories for the files written in them.
+	The callback of a directory is called with the name of the file closed after writing or moved in,
+	or with `None` if some events may have been lost (queue overflowed).
+
+	@static variables:
+		`SHARED`: The watcher shared by the job managers, `False` if it cannot be created.
+		`LOCK`  : The lock to create the shared watcher
+	"""
+
+	SHARED = None
+	LOCK   = Lock()
+
+	@staticmethod
+	def shared():
+		"""
+		Get the shared watcher
+		@returns:
+			The watcher, `None` if inotify is not available.
+		"""
+		with Watcher.LOCK:
+			if Watcher.SHARED is None:
+				try:
+					Watcher.SHARED = Watcher()
+				except OSError:
+					Watcher.SHARED = False
+			return Watcher.SHARED or None
+
+	def __init__(self):
+		"""
+		Constructor
+		"""
+		self.libc = _libc()
+		if not self.libc:
+			raise OSError(errno.ENOSYS, 'inotify is not available.')
+		self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+		if self.fd < 0:
+			err = ctypes.get_errno()
+			raise OSError(err, os.strerror(err))
+		self.mounts  = mounts()
+		self.lock    = Lock()
+		# wd => (directory, callback)
+		self.watches = {}
+		# directory => wd
+		self.wds     = {}
+		thread = Thread(target = self._loop)
+		thread.daemon = True
+		thread.start()
+
+	def watch(self, dirpath, callback):
+		"""
+		Watch a directory
+		@params:
+			`dirpath` : The directory
+			`callback`: The callback, called with the name of the file written
+		@returns:
+			`True` if the directory is watched, `False` if it cannot be (i.e. on NFS)
+		"""
+		if fstype(dirpath, self.mounts) in NETFS:
+			return False
+		dirpath = os.path.realpath(dirpath)
+		with self.lock:
+			wd = self.libc.inotify_add_watch(
+				self.fd, dirpath.encode('utf-8'), IN_CLOSE_WRITE | IN_MOVED_TO)
+			if wd < 0:
+				# ENOSPC: max_user_watches reached
+				return False
+			self.watches[wd]  = (dirpath, callback)
+			self.wds[dirpath] = wd
+		return True
+
+	def unwatch(self, dirpath):
+		"""
+		Stop watching a directory
+		@params:
+			`dirpath`: The directory
+		"""
+		dirpath = os.path.realpath(dirpath)
+		with self.lock:
+			wd = self.wds.pop(dirpath, None)
+			if wd is None:
+				return
+			del self.watches[wd]
+			self.libc.inotify_rm_watch(self.fd, wd)
+
+	def _loop(self):
+		"""
+		Read the events and call the callbacks
+		"""
+		while True:
+			try:
+				select.select([self.fd], [], [])
+				data = os.read(self.fd, 65536)
+			except (OSError, IOError, select.error) as ex:
+				if getattr(ex, 'errno', ex.args[0]) in (errno.EAGAIN, errno.EINTR):
+					continue
+				return # pragma: no cover
+			calls  = []
+			offset = 0
+			while offset + EVENT_HEADER.size <= len(data):
+				wd, mask, _, namelen = EVENT_HEADER.unpack_from(data, offset)
+				name    = data[offset + EVENT_HEADER.size: offset + EVENT_HEADER.size + namelen]
+				offset += EVENT_HEADER.size + namelen
+				with self.lock:
+					if mask & IN_Q_OVERFLOW:
+						calls.extend((watch[1], None) for watch in self.watches.values())
+						continue
+					if mask & IN_IGNORED:
+						# directory removed
+						watch = self.watches.pop(wd, None)
+						if watch:
+							self.wds.pop(watch[0], None)
+						continue
+					watch = self.watches.get(wd)
+				if watch:
+					name = name.rstrip(b'\0')
+					calls.append((watch[1], name if isinstance(name, str) else name.decode('utf-8', 'replace')))
+			for callback, name in calls:
+				callback(name)
@@ -1,15 +1,78 @@
 """
 ps utility for PyPPL
+The process information is read from `/proc` if available, so that no process is forked to get it.
+Otherwise the `ps` command is used.
 """
 import errno
 import signal
 import os
 import subprocess
+from time import time, sleep
 from .cmd import Cmd
 
+# whether process information is available from /proc
+PROCFS = os.path.isfile('/proc/self/stat')
+# how long the process table from /proc can be reused by killtree, 
+# so that killing thousands of jobs doesn't scan /proc for each of them
+TABLE_CACHE = .1
+# (time, [[pid, ppid], ...])
+_TABLE = (0, None)
+# how long killtree waits for the processes killed to exit (or become zombies)
+KILL_WAIT = 1
+
+def _stat(pid):
+	"""
+	Get the state and parent pid of a process from `/proc/<pid>/stat`
+	@params:
+		`pid`: The pid
+	@returns:
+		`(state, ppid)`, `None` if the process doesn't exist.
+	"""
+	try:
+		with open('/proc/%s/stat' % pid) as fstat:
+			stat = fstat.read()
+	except (IOError, OSError):
+		return None
+	# 53464 (sleep) Z 53460 ...
+	# process name could have spaces and parentheses
+	fields = stat[stat.rfind(')') + 2:].split()
+	if len(fields) < 2:
+		return None
+	return fields[0], fields[1]
+
+def _table(maxage = 0):
+	"""
+	Get the pids and parent pids of all processes
+	@params:
+		`maxage`: Reuse the process table if it was read within `maxage` seconds
+	@returns:
+		The list of `[pid, ppid]`
+	"""
+	global _TABLE
+	if PROCFS:
+		now = time()
+		if _TABLE[1] is not None and now - _TABLE[0] < maxage:
+			return _TABLE[1]
+		pidlist = []
+		for pid in os.listdir('/proc'):
+			if not pid.isdigit():
+				continue
+			stat = _stat(pid)
+			if stat:
+				pidlist.append([pid, stat[1]])
+		_TABLE = (now, pidlist)
+		return pidlist
+
+	# --no-heading, --ppid not supported in osx
+	# cids = Cmd(['ps', '--no-heading', '-o', 'pid', '--ppid', pid]).run()
+	pidlist = Cmd(['ps', '-o', 'pid,ppid']).run().stdout.splitlines()
+	pidlist = [line.strip().split() for line in pidlist]
+	return [p for p in pidlist if len(p) == 2 and p[0].isdigit() and p[1].isdigit()]
+
 def exists(pid):
 	"""
 	Check whether pid exists in the current process table.
+	Zombie processes (exited but not reaped) are treated as not existing.
 	From https://github.com/kennethreitz/delegator.py/blob/master/delegator.py
 	"""
 	if pid == 0:
@@ -36,12 +99,14 @@ def exists(pid):
 			# here. If we do let's be explicit in considering this
 			# an error.
 			raise err
-	else:
-		# if process has been killed
-		# PID TTY          TIME CMD
-		# 53464 pts/9    00:00:00 sleep <defunct>
-		r = Cmd(['kill', '-0', str(pid)]).run()
-		return r.rc == 0
+	if not PROCFS: # pragma: no cover
+		return True
+	# if process has been killed
+	# PID TTY          TIME CMD
+	# 53464 pts/9    00:00:00 sleep <defunct>
+	# don't reap it (waitpid) here, the return code belongs to whom started it.
+	stat = _stat(pid)
+	return stat is not None and stat[0] not in ('Z', 'X', 'x')
 
 def kill(pids, sig = signal.SIGKILL):
 	"""
@@ -49,54 +114,71 @@ def kill(pids, sig = signal.SIGKILL):
 	"""
 	if not isinstance(pids, list):
 		pids = [pids]
-	try:
-		for pid in pids:
+	for pid in pids:
+		try:
 			os.kill(int(pid), sig)
-	except OSError: # pragma: no cover
-		Cmd(['kill', '-' + str(sig)] + [str(pid) for pid in pids]).run()
+		except OSError as err:
+			if err.errno != errno.ESRCH: # pragma: no cover
+				Cmd(['kill', '-' + str(sig), str(pid)]).run()
 
 def child(pid, pidlist = None):
 	"""
 	Direct children
 	"""
 	ret = []
-	if pidlist:
-		for pidline in pidlist:
-			if pidline[1] != str(pid):
-				continue
-			ret.append(pidline[0])
-		return ret
-
-	try:
-		# --no-heading, --ppid not supported in osx
-		# cids = Cmd(['ps', '--no-heading', '-o', 'pid', '--ppid', pid]).run()
-		pidlist = Cmd(['ps', '-o', 'pid,ppid']).run().stdout.splitlines()
-		pidlist = [line.strip().split() for line in pidlist]
-		pidlist = [p for p in pidlist if len(p) == 2 and p[0].isdigit() and p[1].isdigit()]
-		return child(pid, pidlist)
-	except subprocess.CalledProcessError: # pragma: no cover
-		return []
+	if pidlist is None:
+		try:
+			pidlist = _table()
+		except subprocess.CalledProcessError: # pragma: no cover
+			return []
+	for pidline in pidlist:
+		if pidline[1] != str(pid):
+			continue
+		ret.append(pidline[0])
+	return ret
 
-def children(pid):
+def children(pid, pidlist = None):
 	"""
 	Find the children of a mother process
 	"""
-	pidlist = Cmd(['ps', '-o', 'pid,ppid']).run().stdout.splitlines()
-	pidlist = [line.strip().split() for line in pidlist]
-	pidlist = [p for p in pidlist if len(p) == 2 and p[0].isdigit() and p[1].isdigit()]
-	cids = child(pid, pidlist)
-	ret  = cids
+	if pidlist is None:
+		pidlist = _table()
+	# ppid => pids
+	pidmap = {}
+	for cid, ppid in pidlist:
+		pidmap.setdefault(ppid, []).append(cid)
+	cids = pidmap.get(str(pid), [])
+	ret  = cids[:]
 	while cids:
-		cids2 = sum([child(c, pidlist) for c in cids], [])
-		ret.extend(cids2)
-		cids = cids2
+		cids = sum([pidmap.get(c, []) for c in cids], [])
+		ret.extend(cids)
 	return ret
 
-def killtree(ppid, killme = True, sig = signal.SIGKILL):
+def killtree(ppid, killme = True, sig = signal.SIGKILL, timeout = None):
 	"""
-	Kill process and its children
+	Kill process and its children.
+	Parents are killed before their children, so that they cannot start new children 
+	(i.e. the next job of a chunk) while the tree is being killed.
+	Then wait for them to exit, as a process being torn down still shows up as alive.
+	@params:
+		`ppid`   : The pid of the process
+		`killme` : Whether to kill the process itself or only its children
+		`sig`    : The signal to send
+		`timeout`: How long to wait for them to exit, `KILL_WAIT` if not given, 0 not to wait.
 	"""
-	cids = list(reversed(children(ppid)))
+	cids = children(ppid, _table(TABLE_CACHE))
 	if killme:
-		cids.append(ppid)
+		cids.insert(0, ppid)
 	kill(cids, sig)
+	# without /proc, the zombies are not told from the alive processes
+	if not PROCFS:
+		return
+	timeout  = KILL_WAIT if timeout is None else timeout
+	deadline = time() + timeout
+	interval = .001
+	cids     = [int(cid) for cid in cids]
+	while cids and time() < deadline:
+		cids = [cid for cid in cids if exists(cid)]
+		if cids:
+			sleep(interval)
+			interval = min(interval * 2, .1)
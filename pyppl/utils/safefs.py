@@ -3,12 +3,32 @@ safefs utility for PyPPL
 """
 import tempfile
 
-from stat import S_IEXEC
-from os import path, remove as osremove, readlink, symlink, getcwd, makedirs, walk, stat, chmod, chdir
+from stat import S_IEXEC, S_ISDIR
+from os import path, remove as osremove, readlink, symlink, getcwd, makedirs, stat, chmod, chdir, sep
+from threading import Thread
 from shutil import rmtree, move as shmove, copyfileobj, copytree, copyfile
 from multiprocessing import Lock
 import filelock
 
+try:
+	from os import scandir
+except ImportError: # pragma: no cover
+	try:
+		from scandir import scandir
+	except ImportError:
+		from os import listdir
+		class _DirEntry(object):
+			"""A minimal `os.DirEntry` for python2 without scandir"""
+			def __init__(self, dirpath, name):
+				self.name = name
+				self.path = path.join(dirpath, name)
+			def stat(self):
+				"""Get the status of the entry, links followed"""
+				return stat(self.path)
+		def scandir(dirpath):
+			"""List the entries of a directory"""
+			return [_DirEntry(dirpath, name) for name in listdir(dirpath)]
+
 try:
 	ChmodError = (OSError, PermissionError, UnicodeDecodeError)
 except NameError:
@@ -44,11 +64,17 @@ class SafeFs(object):
 		`FILES_SAME_REAL2`     : File1 links to file2, which a regular file
 
 		`LOCK`: A global lock ensures the locks are locked at the same time
+
+		`DIRMTIMES` : The modified time of the directories memorized (realpath => mtime)
+		`DIRTHREADS`: The number of threads to get the modified time of the subdirectories of a directory
 	"""
 
 	TMPDIR = tempfile.gettempdir()
 	LOCK   = Lock()
 
+	DIRMTIMES  = {}
+	DIRTHREADS = 4
+
 	# file types
 	FILETYPE_UNKNOWN   = -1
 	FILETYPE_NOENT     = 0
@@ -445,34 +471,124 @@ class SafeFs(object):
 		except OSError: # pragma: no cover
 			return False
 
+	@staticmethod
+	def _scandir(dirpath):
+		"""
+		List a directory with the status of the entries
+		@params:
+			`dirpath`: The directory
+		@returns:
+			The list of `(path, stat)`, links are followed, `stat` is `None` for dead links.
+		"""
+		ret = []
+		try:
+			entries = scandir(dirpath)
+		except OSError:
+			return ret
+		try:
+			for entry in entries:
+				try:
+					ret.append((entry.path, entry.stat()))
+				except OSError:
+					ret.append((entry.path, None))
+		finally:
+			if hasattr(entries, 'close'):
+				entries.close()
+		return ret
+
 	@staticmethod
 	def _dirmtime(filepath):
 		"""
-		Get the modified time of a directory recursively
+		Get the modified time of a directory recursively.
+		Each entry is visited once (with one `stat` call), directories linked more than once are only visited once.
+		The subdirectories at the top level are visited by `SafeFs.DIRTHREADS` threads.
+		The result is memorized until it's forgot by `SafeFs._dirmtimeForget`.
 		@params:
 			`filepath`: The file path
 		@return`:
 			The most recent modified time
 		"""
-		# assert self.filetype1 in [SafeFs.FILETYPE_DIR, SafeFs.FILETYPE_DIRLINK]:
-		mtime = 0
-		for root, dirs, files in walk(filepath):
-			m = path.getmtime (root) if path.exists(root) else 0
-			mtime = max(m, mtime)
-			for dr in dirs:
-				m = SafeFs._dirmtime (path.join (root, dr))
-				mtime = max(m, mtime)
-			for f in files:
-				m = path.getmtime (path.join (root, f)) if path.exists(path.join(root, f)) else 0
-				mtime = max(m, mtime)
+		realpath = path.realpath(filepath)
+		if realpath in SafeFs.DIRMTIMES:
+			return SafeFs.DIRMTIMES[realpath]
+		try:
+			dirstat = stat(filepath)
+		except OSError:
+			return 0
+		# (device, inode) of the directories visited
+		visited = set([(dirstat.st_dev, dirstat.st_ino)])
+
+		def walkdirs(dirs):
+			"""Get the most recent modified time of the directories and everything in them"""
+			mtime = 0
+			while dirs:
+				dirpath, substat = dirs.pop()
+				key = (substat.st_dev, substat.st_ino)
+				if key in visited:
+					continue
+				visited.add(key)
+				mtime = max(mtime, substat.st_mtime)
+				for entpath, entstat in SafeFs._scandir(dirpath):
+					if entstat is None:
+						continue
+					if S_ISDIR(entstat.st_mode):
+						dirs.append((entpath, entstat))
+					else:
+						mtime = max(mtime, entstat.st_mtime)
+			return mtime
+
+		mtime   = dirstat.st_mtime
+		subdirs = []
+		for entpath, entstat in SafeFs._scandir(filepath):
+			if entstat is None:
+				continue
+			if S_ISDIR(entstat.st_mode):
+				subdirs.append((entpath, entstat))
+			else:
+				mtime = max(mtime, entstat.st_mtime)
+
+		nthreads = min(SafeFs.DIRTHREADS, len(subdirs))
+		if nthreads > 1:
+			mtimes  = [0] * nthreads
+			def worker(i):
+				"""Walk the i-th part of the subdirectories"""
+				mtimes[i] = walkdirs(subdirs[i::nthreads])
+			threads = [Thread(target = worker, args = (i, )) for i in range(nthreads)]
+			for thread in threads:
+				thread.start()
+			for thread in threads:
+				thread.join()
+			mtime = max([mtime] + mtimes)
+		else:
+			mtime = max(mtime, walkdirs(subdirs))
+		SafeFs.DIRMTIMES[realpath] = mtime
 		return mtime
 
 	@staticmethod
-	def _filesig(filepath, dirsig = True, filetype = None):
+	def _dirmtimeForget(dirpath = None):
+		"""
+		Forget the modified time memorized of a directory (i.e. it will be changed) and the directories in it,
+		and the directories containing it.
+		@params:
+			`dirpath`: The directory, `None` to forget all.
+		"""
+		if dirpath is None:
+			SafeFs.DIRMTIMES.clear()
+			return
+		dirpath = path.realpath(dirpath).rstrip(sep) + sep
+		for memo in list(SafeFs.DIRMTIMES):
+			memodir = memo.rstrip(sep) + sep
+			if memodir.startswith(dirpath) or dirpath.startswith(memodir):
+				SafeFs.DIRMTIMES.pop(memo, None)
+
+	@staticmethod
+	def _filesig(filepath, dirsig = True, filetype = None, hashes = None):
 		"""
 		Generate a signature for a file
 		@params:
 			`dirsig`: Whether expand the directory? Default: True
+			`hashes`: The `filehash.HashCache` to use the content hash instead of the modified time. 
+				Directories are only hashed if `dirsig` is `True`. Default: None
 		@returns:
 			The signature
 		"""
@@ -482,7 +598,11 @@ class SafeFs(object):
 			return False
 		
 		filetype = filetype or SafeFs._filetype(filepath)
-		if dirsig and filetype in [SafeFs.FILETYPE_DIR, SafeFs.FILETYPE_DIRLINK]:
+		isdir    = filetype in [SafeFs.FILETYPE_DIR, SafeFs.FILETYPE_DIRLINK]
+		if hashes is not None and (dirsig or not isdir):
+			digest = hashes.filehash(filepath)
+			return [filepath, digest] if digest else False
+		if dirsig and isdir:
 			mtime = SafeFs._dirmtime(filepath)
 		else:
 			mtime = path.getmtime(filepath)
@@ -753,18 +873,19 @@ class SafeFs(object):
 		self._unlock()
 		return r
 
-	def filesig(self, dirsig = True):
+	def filesig(self, dirsig = True, hashes = None):
 		"""
 		Generate a signature for a file
 		@params:
 			`dirsig`: Whether expand the directory? Default: True
+			`hashes`: The `filehash.HashCache` to use the content hash instead of the modified time. Default: None
 		@returns:
 			The signature
 		"""
 		self._lock(lock1 = 'real')
 		ret = None
 		try:
-			ret = SafeFs._filesig(self.file1, filetype = self.filetype1, dirsig = dirsig)
+			ret = SafeFs._filesig(self.file1, filetype = self.filetype1, dirsig = dirsig, hashes = hashes)
 		finally:
 			self._unlock()
 		return ret
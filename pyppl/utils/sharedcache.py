@@ -0,0 +1,189 @@
+"""
+Shared result cache for PyPPL
+The output files of the finished jobs are stored in a directory shared by the pipelines,
+by the key of the jobs (the hash of the script rendered and the content of the input files, see `Job.sharedKey`),
+so that a job with the same key in any pipeline can take the output files instead of running again.
+The files are copied to the cache and made read-only there, so that the cache is never changed
+by the job that stored them. They are hard-linked (read-only as well) to the jobs taking them if possible
+(on the same device), otherwise copied, so that they have to be removed, instead of being edited in place,
+to be changed. In case they are made writable and edited anyway, the content hashes of the files are
+saved with the entry and checked before the files are taken, and a changed entry is dropped.
+"""
+import os
+import json
+import stat
+from shutil import copy2, rmtree
+from tempfile import mkdtemp
+from .filehash import HashCache
+
+def _linkOrCopy(src, dst):
+	"""
+	Hard-link a file, copy it if it cannot be linked (i.e. on different devices)
+	@params:
+		`src`: The source file, links are followed
+		`dst`: The destination
+	"""
+	src = os.path.realpath(src)
+	try:
+		os.link(src, dst)
+	except OSError:
+		copy2(src, dst)
+
+def _copyReadonly(src, dst):
+	"""
+	Copy a file and make the copy read-only
+	@params:
+		`src`: The source file, links are followed
+		`dst`: The destination
+	"""
+	copy2(os.path.realpath(src), dst)
+	os.chmod(dst, stat.S_IMODE(os.stat(dst).st_mode) & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+
+def _copyTree(src, dst, copyfile = _linkOrCopy):
+	"""
+	Copy a file or directory recursively
+	@params:
+		`src`     : The source file or directory
+		`dst`     : The destination
+		`copyfile`: The function to copy the files, `_linkOrCopy` or `_copyReadonly`
+	"""
+	if not os.path.isdir(src):
+		copyfile(src, dst)
+		return
+	os.makedirs(dst)
+	for name in os.listdir(src):
+		_copyTree(os.path.join(src, name), os.path.join(dst, name), copyfile)
+
+class SharedCache(object):
+	"""
+	The shared result cache.
+	An entry is a directory `<cachedir>/<key[:2]>/<key>/` with the output files named by the indices
+	of them in the outputs of the job, and `outputs.json` with their paths relative to the output directory
+	(`outputs`) and their content hashes (`hashes`).
+	"""
+
+	def __init__(self, cachedir):
+		"""
+		Constructor
+		@params:
+			`cachedir`: The cache directory
+		"""
+		self.cachedir = os.path.abspath(cachedir)
+		if not os.path.isdir(self.cachedir):
+			os.makedirs(self.cachedir)
+		# the content hashes of the input files and the files in the cache, shared by the pipelines as well
+		self.hashes = HashCache.get(os.path.join(self.cachedir, 'hashes.db'))
+
+	def entry(self, key):
+		"""
+		Get the directory of an entry
+		@params:
+			`key`: The key of the job
+		@returns:
+			The directory
+		"""
+		return os.path.join(self.cachedir, key[:2], key)
+
+	def fetch(self, key, outdir, outfiles):
+		"""
+		Take the output files from the cache, hard-linked if possible.
+		The entry is dropped if the files in it have been changed.
+		@params:
+			`key`     : The key of the job
+			`outdir`  : The output directory of the job
+			`outfiles`: The output files of the job
+		@returns:
+			`True` if all the output files are in the cache and taken, otherwise `False`
+		"""
+		entry = self.entry(key)
+		try:
+			with open(os.path.join(entry, 'outputs.json')) as fout:
+				cached = json.load(fout)
+		except (IOError, OSError, ValueError):
+			return False
+		relpaths = [os.path.relpath(outfile, outdir) for outfile in outfiles]
+		if not isinstance(cached, dict) or cached.get('outputs') != relpaths:
+			return False
+		# the hashes are cached by the state of the files, so they are only calculated again if changed
+		if cached.get('hashes') != self._hashEntry(entry, len(outfiles)):
+			self._drop(entry)
+			return False
+		try:
+			for i, outfile in enumerate(outfiles):
+				if os.path.lexists(outfile):
+					if os.path.isdir(outfile) and not os.path.islink(outfile):
+						rmtree(outfile)
+					else:
+						os.remove(outfile)
+				elif not os.path.isdir(os.path.dirname(outfile)):
+					os.makedirs(os.path.dirname(outfile))
+				_copyTree(os.path.join(entry, str(i)), outfile)
+		except (IOError, OSError):
+			return False
+		return True
+
+	def store(self, key, outdir, outfiles):
+		"""
+		Store the output files to the cache, nothing is done if the entry exists.
+		The files are copied and made read-only.
+		@params:
+			`key`     : The key of the job
+			`outdir`  : The output directory of the job
+			`outfiles`: The output files of the job
+		@returns:
+			`True` if the files are stored, otherwise `False`
+		"""
+		entry = self.entry(key)
+		if os.path.isdir(entry):
+			return False
+		# stored in a temporary directory and renamed, so that others never see a partial entry
+		tmpdir = None
+		try:
+			try:
+				os.makedirs(os.path.dirname(entry))
+			except OSError:
+				pass
+			tmpdir = mkdtemp(prefix = key + '.', suffix = '.tmp', dir = os.path.dirname(entry))
+			# readable by the others sharing the cache
+			os.chmod(tmpdir, 0o755)
+			for i, outfile in enumerate(outfiles):
+				_copyTree(outfile, os.path.join(tmpdir, str(i)), _copyReadonly)
+			with open(os.path.join(tmpdir, 'outputs.json'), 'w') as fout:
+				json.dump({
+					'outputs': [os.path.relpath(outfile, outdir) for outfile in outfiles],
+					# the files keep their inodes when renamed, so the hashes cached here are reused by fetch
+					'hashes' : self._hashEntry(tmpdir, len(outfiles))
+				}, fout)
+			os.rename(tmpdir, entry)
+		except (IOError, OSError):
+			# i.e. stored by others at the same time
+			if tmpdir:
+				rmtree(tmpdir, ignore_errors = True)
+			return False
+		return True
+
+	def _hashEntry(self, entry, nfiles):
+		"""
+		Get the content hashes of the files in an entry
+		@params:
+			`entry` : The directory of the entry
+			`nfiles`: The number of the output files
+		@returns:
+			The hashes
+		"""
+		return [self.hashes.filehash(os.path.join(entry, str(i))) for i in range(nfiles)]
+
+	def _drop(self, entry):
+		"""
+		Drop an entry, which can be stored again
+		@params:
+			`entry`: The directory of the entry
+		"""
+		# renamed first, so that others never see a partial entry
+		tmpdir = entry + '.%s.drop' % os.getpid()
+		try:
+			os.rename(entry, tmpdir)
+		except OSError:
+			# i.e. dropped by others
+			return
+		rmtree(tmpdir, ignore_errors = True)
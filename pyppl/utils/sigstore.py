@@ -0,0 +1,189 @@
+"""
+The signature store of the jobs of a process for PyPPL
+All the signatures are kept in one append-only file instead of one file per job, so that checking
+the cache of a process with a lot of jobs doesn't have to open a lot of small files.
+Each line of the file is a JSON object (`{"index": 0, "sig": {...}}`), a later line of a job overrides
+the earlier ones. Lines partially written (i.e. the pipeline is killed) are ignored.
+The signatures of the files used by the jobs are calculated once for all the jobs (see `FileSigs`).
+"""
+import json
+from os import path, rename
+from threading import Lock
+from . import jsonLoads, Queue, QueueEmpty
+from .safefs import SafeFs
+from .taskmgr import ThreadPool
+
+class SigStore(object):
+	"""
+	The signature store
+
+	@static variables:
+		`COMPACT`: Rewrite the file when loading if the lines overridden are more than this ratio of all the lines
+	"""
+
+	COMPACT = .5
+
+	def __init__(self, sigfile):
+		"""
+		Constructor, the signatures are loaded at once
+		@params:
+			`sigfile`: The file to store the signatures
+		"""
+		self.sigfile = sigfile
+		self.lock    = Lock()
+		# job index => signature
+		self.sigs    = {}
+		# the file handle to append
+		self.handle  = None
+		# whether the last line is complete, otherwise a new line has to be started to append
+		self.sealed  = True
+		nlines = 0
+		if path.isfile(sigfile):
+			with open(sigfile) as fsig:
+				for line in fsig:
+					self.sealed = line.endswith('\n')
+					try:
+						item = jsonLoads(line)
+						self.sigs[int(item['index'])] = item['sig']
+					except (ValueError, KeyError, TypeError):
+						continue
+					nlines += 1
+		if nlines and nlines - len(self.sigs) > nlines * SigStore.COMPACT:
+			self._compact()
+
+	def _compact(self):
+		"""
+		Rewrite the file with the latest signature of each job
+		"""
+		tmpfile = self.sigfile + '.tmp'
+		with open(tmpfile, 'w') as fsig:
+			for index in sorted(self.sigs):
+				fsig.write(json.dumps({'index': index, 'sig': self.sigs[index]}) + '\n')
+		rename(tmpfile, self.sigfile)
+		self.sealed = True
+
+	def get(self, index):
+		"""
+		Get the signature of a job
+		@params:
+			`index`: The index of the job
+		@returns:
+			The signature, `None` if it's not stored
+		"""
+		return self.sigs.get(index)
+
+	def set(self, index, sig):
+		"""
+		Store the signature of a job, the line is written at once
+		@params:
+			`index`: The index of the job
+			`sig`  : The signature
+		"""
+		line = json.dumps({'index': index, 'sig': sig}) + '\n'
+		with self.lock:
+			# the same as loaded from the file
+			self.sigs[index] = jsonLoads(line)['sig']
+			if not self.handle:
+				self.handle = open(self.sigfile, 'a')
+				if not self.sealed:
+					self.handle.write('\n')
+					self.sealed = True
+			self.handle.write(line)
+			self.handle.flush()
+
+	def files(self):
+		"""
+		Get the input and output files in the signatures stored
+		@returns:
+			The set of the paths of the files
+		"""
+		ret = set()
+		for sig in self.sigs.values():
+			try:
+				for infile in sig['i']['file'].values():
+					ret.add(infile[0])
+				for infiles in sig['i']['files'].values():
+					ret.update(infile[0] for infile in infiles)
+				for outfile in list(sig['o']['file'].values()) + list(sig['o']['dir'].values()):
+					ret.add(outfile[0])
+			except (KeyError, TypeError, IndexError, AttributeError):
+				continue
+		ret.discard('')
+		return ret
+
+	def close(self):
+		"""
+		Close the file
+		"""
+		with self.lock:
+			if self.handle:
+				self.handle.close()
+				self.handle = None
+
+class FileSigs(object):
+	"""
+	The signatures of the files shared by the jobs of a process.
+	The signature of a file is calculated once, no matter how many jobs use it.
+	The files in the signatures stored last time can be calculated in bulk before the jobs are built
+	(see `prefetch`), so that checking the cache of the jobs doesn't wait for the file system file by file.
+
+	@static variables:
+		`NTHREAD`: The number of threads to calculate the signatures in bulk
+	"""
+
+	NTHREAD = 16
+
+	def __init__(self, dirsig = True, hashes = None):
+		"""
+		Constructor
+		@params:
+			`dirsig`: Whether expand the directories, see `SafeFs._filesig`
+			`hashes`: The `filehash.HashCache` to use the content hashes instead of the modified time
+		"""
+		self.dirsig = dirsig
+		self.hashes = hashes
+		self.lock   = Lock()
+		# file path => signature
+		self.sigs   = {}
+
+	def get(self, filepath):
+		"""
+		Get the signature of a file
+		@params:
+			`filepath`: The path of the file
+		@returns:
+			The signature, `False` if the file does not exist.
+		"""
+		with self.lock:
+			if filepath in self.sigs:
+				sig = self.sigs[filepath]
+				return sig[:] if sig else sig
+		sig = SafeFs._filesig(filepath, dirsig = self.dirsig, hashes = self.hashes)
+		with self.lock:
+			self.sigs[filepath] = sig
+		return sig[:] if sig else sig
+
+	def prefetch(self, filepaths, nthread = None):
+		"""
+		Calculate the signatures of the files in bulk
+		@params:
+			`filepaths`: The paths of the files
+			`nthread`  : The number of threads, `FileSigs.NTHREAD` if not given.
+		"""
+		queue = Queue()
+		for filepath in filepaths:
+			queue.put(filepath)
+		nthread = min(nthread or FileSigs.NTHREAD, queue.qsize())
+		if not nthread:
+			return
+
+		def worker():
+			"""Calculate the signatures of the files in the queue"""
+			while True:
+				try:
+					filepath = queue.get_nowait()
+				except QueueEmpty:
+					return
+				self.get(filepath)
+
+		ThreadPool(nthread, initializer = worker).join()
@@ -31,11 +31,20 @@ class ThreadPool(object):
 	"""
 
 	def __init__(self, nthread, initializer = None, initargs = None):
+		"""
+		Constructor
+		@params:
+			`nthread`    : Number of threads
+			`initializer`: The target of the threads, could be a list of targets for each thread
+			`initargs`   : The arguments for the targets, could be a list of arguments for each thread
+		"""
 		self.threads = []
 		if not isinstance(initargs, list):
 			initargs = [(initargs, ) if initargs else ()] * nthread
+		if not isinstance(initializer, list):
+			initializer = [initializer] * nthread
 		for i in range(nthread):
-			thread = ThreadEx(target = initializer, args = initargs[i])
+			thread = ThreadEx(target = initializer[i], args = initargs[i])
 			thread.start()
 			self.threads.append(thread)
 
@@ -111,4 +120,15 @@ class PQueue(PriorityQueue):
 		ret  = divmod(item, self.batch_len)
 		return (ret[1], ret[0])
 
-
+	def peek(self):
+		"""
+		Get the next item of the queue without removing it
+		@returns:
+			The next item, `None` if the queue is empty
+		"""
+		with self.mutex:
+			if not self.queue:
+				return None
+			item = self.queue[0]
+		ret = divmod(item, self.batch_len)
+		return (ret[1], ret[0])
@@ -1,8 +1,8 @@
 import helpers, testly, sys, json
 
-from time import time
+from time import time, sleep
 from glob import glob
-from os import path, symlink, makedirs, utime, remove
+from os import path, symlink, makedirs, utime, remove, lstat, listdir, readlink, stat, access, W_OK
 from tempfile import gettempdir
 from collections import OrderedDict
 from shutil import rmtree
@@ -10,9 +10,11 @@ from copy import deepcopy
 from liquid import LiquidRenderError
 from pyppl.job import Job
 from pyppl.jobmgr import Jobmgr
-from pyppl.runners import RunnerLocal
+from pyppl.runners import RunnerLocal, RunnerSsh
 from pyppl.exception import JobInputParseError, JobOutputParseError
 from pyppl.template import TemplateLiquid
+from pyppl.utils.sigstore import SigStore
+from pyppl.utils.sharedcache import SharedCache
 from pyppl import logger, utils
 
 class TestJob(testly.TestCase):
@@ -37,6 +39,11 @@ class TestJob(testly.TestCase):
 	def testInit(self, index, config):
 		job  = Job(index, config)
 		self.assertIsInstance(job, Job)
+		# compact, the data are created when used
+		self.assertFalse(hasattr(job, '__dict__'))
+		self.assertIsNone(job._data)
+		self.assertIsNone(job._input)
+		self.assertIsNone(job._output)
 		self.assertDictEqual(job.config, config)
 		self.assertEqual(job.dir, path.join(config['workdir'], str(index + 1)))
 		self.assertEqual(job.indir, path.join(job.dir, 'input'))
@@ -354,6 +361,78 @@ class TestJob(testly.TestCase):
 			self.assertDictEqual(job.input, jobinput)
 			self.assertDictEqual(job.data['i'], indata)
 	
+	def dataProvider_testPrepInputIncremental(self):
+		config = {'proc': 'pPrepInputIncremental', 'procsize': 1}
+		config['workdir'] = path.join(self.testdir, 'pPrepInputIncremental')
+		fileinc1 = path.join(self.testdir, 'pPrepInputIncremental1', 'a.txt')
+		fileinc2 = path.join(self.testdir, 'pPrepInputIncremental2', 'a.txt')
+		fileinc3 = path.join(self.testdir, 'pPrepInputIncremental3', 'b.txt')
+		for f in [fileinc1, fileinc2, fileinc3]:
+			makedirs(path.dirname(f))
+			helpers.writeFile(f)
+		config['input'] = OrderedDict([
+			('a', {'type': 'file', 'data': [fileinc1]}),
+			('b', {'type': 'files', 'data': [[fileinc2, fileinc1, fileinc3]]}),
+		])
+		# a.txt now links to fileinc2, [1]a.txt and b.txt removed
+		input2 = OrderedDict([
+			('a', {'type': 'file', 'data': [fileinc2]}),
+			('b', {'type': 'files', 'data': [[fileinc2]]}),
+		])
+		yield config, input2, {'a.txt': fileinc2}
+
+	def testPrepInputIncremental(self, config, input2, links):
+		job = Job(0, config)
+		if path.isdir(job.indir):
+			rmtree(job.indir)
+		with helpers.log2str():
+			job._prepInput()
+		self.assertEqual(job.data['i']['b'], [
+			path.join(job.indir, '[1]a.txt'), path.join(job.indir, 'a.txt'), path.join(job.indir, 'b.txt')])
+		# a file left in the input directory
+		helpers.writeFile(path.join(job.indir, 'c.txt'))
+		lstats = {fn: lstat(path.join(job.indir, fn)).st_ino for fn in listdir(job.indir)}
+		# nothing changed, links kept
+		job = Job(0, config)
+		with helpers.log2str():
+			job._prepInput()
+		self.assertEqual(sorted(listdir(job.indir)), ['[1]a.txt', 'a.txt', 'b.txt'])
+		for fn in listdir(job.indir):
+			self.assertEqual(lstat(path.join(job.indir, fn)).st_ino, lstats[fn])
+		# input changed
+		job = Job(0, dict(config, input = input2))
+		with helpers.log2str():
+			job._prepInput()
+		self.assertEqual({fn: readlink(path.join(job.indir, fn)) for fn in listdir(job.indir)}, links)
+		self.assertEqual(job.data['i']['b'], [path.join(job.indir, 'a.txt')])
+
+	def dataProvider_testLinkInfile(self):
+		config = {'proc': 'pLinkInfile', 'procsize': 1}
+		config['workdir'] = path.join(self.testdir, 'pLinkInfile')
+		files = []
+		for i in range(4):
+			files.append(path.join(self.testdir, 'pLinkInfile%s' % i, 'reads.fq'))
+		# literally named as a renamed one
+		files.append(path.join(self.testdir, 'pLinkInfile4', '[1]reads.fq'))
+		for f in files:
+			makedirs(path.dirname(f))
+			helpers.writeFile(f)
+		# a link to the first one, regarded as the same file
+		files.append(path.join(self.testdir, 'pLinkInfile5', 'reads.fq'))
+		makedirs(path.dirname(files[-1]))
+		symlink(files[0], files[-1])
+		config['input'] = {'a': {'type': 'files', 'data': [[files[4]] + files[:4] + [files[0], files[5], files[2]]]}}
+		yield config, ['[1]reads.fq', 'reads.fq', '[2]reads.fq', '[3]reads.fq', '[4]reads.fq', 'reads.fq', 'reads.fq', '[3]reads.fq']
+
+	def testLinkInfile(self, config, names):
+		job = Job(0, config)
+		with helpers.log2str():
+			job._prepInput()
+		self.assertEqual(job.data['i']['a'], [path.join(job.indir, name) for name in names])
+		self.assertEqual(sorted(listdir(job.indir)), sorted(set(names)))
+		for infile, orgfile in zip(job.data['i']['a'], config['input']['a']['data'][0]):
+			self.assertTrue(path.samefile(infile, orgfile))
+
 	def dataProvider_testPrepOutput(self):
 		config = {}
 		config['workdir'] = path.join(self.testdir, 'pPrepOutput')
@@ -442,6 +521,45 @@ class TestJob(testly.TestCase):
 			self.assertTrue(path.isfile(job.script))
 			helpers.assertInFile(self, scriptout, job.script)
 
+	def dataProvider_testPrepResources(self):
+		config = {'procsize': 1, 'proc': 'pPrepResources', 'input': {}, 'output': {}}
+		config['workdir'] = path.join(self.testdir, 'pPrepResources')
+		yield 0, config, {}, {}
+		yield 0, config, {'cores': TemplateLiquid('1'), 'mem': TemplateLiquid('0')}, {'cores': 1, 'mem': 0}
+		yield 1, config, {'cores': TemplateLiquid('{{job.index + 1}}'), 'mem': TemplateLiquid('{{job.index}}G')}, {'cores': 2, 'mem': 1024}
+
+	def testPrepResources(self, index, config, resources, outres):
+		config['resources'] = resources
+		job = Job(index, config)
+		job._prepResources()
+		self.assertDictEqual(job.resources, outres)
+
+	def dataProvider_testLastRuntime(self):
+		workdir = path.join(self.testdir, 'pLastRuntime')
+		jobdir1 = path.join(workdir, '1')
+		makedirs(jobdir1)
+		yield jobdir1, None
+
+		jobdir2 = path.join(workdir, '2')
+		makedirs(jobdir2)
+		helpers.writeFile(path.join(jobdir2, 'job.pid'), '1')
+		yield jobdir2, None
+
+		jobdir3 = path.join(workdir, '3')
+		makedirs(jobdir3)
+		helpers.writeFile(path.join(jobdir3, 'job.pid'), '1')
+		helpers.writeFile(path.join(jobdir3, 'job.rc'), '0')
+		t = time()
+		utime(path.join(jobdir3, 'job.pid'), (t - 10, t - 10))
+		utime(path.join(jobdir3, 'job.rc'), (t, t))
+		yield jobdir3, 10
+
+	def testLastRuntime(self, jobdir, runtime):
+		if runtime is None:
+			self.assertIsNone(Job.lastRuntime(jobdir))
+		else:
+			self.assertAlmostEqual(Job.lastRuntime(jobdir), runtime, places = 2)
+
 	def dataProvider_testReportItem(self):
 		config = {'proc': 'pReportItem', 'procsize': 128}
 		config['workdir'] = path.join(self.testdir, 'pReportItem')
@@ -1227,6 +1345,35 @@ class TestJob(testly.TestCase):
 		else:
 			self.assertDictEqual(helpers.readFile(job.cachefile, json.loads), outsig)
 	
+	def dataProvider_testCacheSigstore(self):
+		for i, legacy in enumerate([False, True]):
+			workdir = path.join(self.testdir, 'pCacheSigstore%s' % i, 'workdir')
+			config  = {'input': {}, 'output': {}, 'cache': True, 'procsize': 1, 'dirsig': False}
+			config['workdir'] = workdir
+			config['script']  = TemplateLiquid('')
+			config['proc']    = 'pCacheSigstore%s' % i
+			yield config, legacy
+
+	def testCacheSigstore(self, config, legacy):
+		sigfile = path.join(config['workdir'], 'proc.cache')
+		job = Job(0, dict(config, sigstore = None if legacy else SigStore(sigfile)))
+		makedirs(job.dir)
+		job._prepScript()
+		job.cache()
+		if job.config['sigstore']:
+			job.config['sigstore'].close()
+		self.assertEqual(path.isfile(job.cachefile), legacy)
+		self.assertEqual(path.isfile(sigfile), not legacy)
+		# loaded by the next run, jobs cached by earlier versions are found by job.cache
+		job2 = Job(0, dict(config, sigstore = SigStore(sigfile)))
+		job2._prepScript()
+		with helpers.log2str(levels = 'all'):
+			self.assertTrue(job2.isTrulyCached())
+		# the signature checked is stored without being calculated again, only if it's not stored
+		job2.cache()
+		job2.config['sigstore'].close()
+		self.assertEqual(len(helpers.readFile(sigfile).splitlines()), 1)
+
 	def dataProvider_testIsTrulyCached(self):
 		# no cache file
 		config = {'input': {}, 'output': {}, 'cache': True, 'procsize': 1, 'dirsig': False}
@@ -2013,7 +2160,67 @@ class TestJob(testly.TestCase):
 		if ret:
 			self.assertEqual(job.rc, 0)
 			#self.assertTrue(job.isTrulyCached())
-			
+
+	def dataProvider_testIsSharedCached(self):
+		testdir = path.join(self.testdir, 'pIsSharedCached')
+		infile1 = path.join(testdir, 'in1', 'a.txt')
+		infile2 = path.join(testdir, 'in2', 'a.txt')
+		infile3 = path.join(testdir, 'in3', 'a.txt')
+		for infile, content in [(infile1, 'a'), (infile2, 'a'), (infile3, 'b')]:
+			makedirs(path.dirname(infile))
+			helpers.writeFile(infile, content)
+		config = {'cache': True, 'dirsig': False, 'procsize': 1, 'proc': 'pIsSharedCached'}
+		config['script']      = TemplateLiquid('cat {{i.a}} > {{o.b}}')
+		config['expect']      = TemplateLiquid('')
+		config['output']      = OrderedDict([('b', ('file', TemplateLiquid('a.out')))])
+		config['sharedcache'] = SharedCache(path.join(testdir, 'shared'))
+		# done by another pipeline (workdir)
+		config1 = dict(config, workdir = path.join(testdir, 'workdir1'), input = {'a': {'type': 'file', 'data': [infile1]}})
+		# the same content in a different file
+		yield config1, dict(config, workdir = path.join(testdir, 'workdir2'), input = {'a': {'type': 'file', 'data': [infile2]}}), True
+		# different content
+		yield config1, dict(config, workdir = path.join(testdir, 'workdir3'), input = {'a': {'type': 'file', 'data': [infile3]}}), False
+		# shared cache not used
+		yield config1, dict(config, workdir = path.join(testdir, 'workdir4'), input = {'a': {'type': 'file', 'data': [infile2]}}, sharedcache = None), False
+
+	def testIsSharedCached(self, config1, config2, ret):
+		job1 = Job(0, config1)
+		if not path.isdir(job1.dir):
+			makedirs(job1.dir)
+		job1._prepInput()
+		job1._prepOutput()
+		job1._prepScript()
+		helpers.writeFile(job1.output['b']['data'], 'a')
+		job1.cacheShared()
+		job2 = Job(0, config2)
+		makedirs(job2.dir)
+		job2._prepInput()
+		job2._prepOutput()
+		job2._prepScript()
+		with helpers.log2str(levels = 'all'):
+			self.assertEqual(job2.isSharedCached(), ret)
+		if ret:
+			self.assertEqual(job2.rc, 0)
+			self.assertEqual(helpers.readFile(job2.output['b']['data']), 'a')
+			# copied to the cache, read-only there and for the jobs taking it
+			entry = config1['sharedcache'].entry(job1._shkey)
+			self.assertEqual(stat(job1.output['b']['data']).st_nlink, 1)
+			self.assertTrue(access(job1.output['b']['data'], W_OK))
+			self.assertFalse(stat(path.join(entry, '0')).st_mode & 0o222)
+			self.assertFalse(stat(job2.output['b']['data']).st_mode & 0o222)
+			# not stored again by the cached jobs
+			rmtree(entry)
+			job2.status = Job.STATUS_DONECACHED
+			with helpers.log2str():
+				job2.done(export = False)
+			self.assertFalse(path.exists(entry))
+			job2.status = Job.STATUS_DONE
+			with helpers.log2str():
+				job2.done(export = False)
+			self.assertTrue(path.isdir(entry))
+		else:
+			self.assertFalse(path.exists(job2.output['b']['data']))
+
 	def dataProvider_testDone(self):
 		# other: overwrite
 		config = {'input': {}, 'exdir': None, 'cache': True, 'dirsig': False}
@@ -2136,6 +2343,72 @@ class TestJob(testly.TestCase):
 		for l in logs:
 			self.assertIn(l, err.getvalue())
 
+	def dataProvider_testSubmitChunk(self):
+		for i, (njobs, forks) in enumerate([(1, 1), (5, 1), (5, 2), (4, 8)]):
+			config = {'input': {}, 'exdir': None, 'cache': True, 'dirsig': False}
+			config['workdir']  = path.join(self.testdir, 'pSubmitChunk%s' % i, 'workdir')
+			config['proc']     = 'pSubmitChunk%s' % i
+			config['procsize'] = njobs
+			config['script']   = TemplateLiquid('echo {{job.index}}')
+			config['expect']   = TemplateLiquid('')
+			config['output']   = {}
+			config['runner']   = RunnerLocal
+			yield [Job(j, config) for j in range(njobs)], forks
+
+	def testSubmitChunk(self, jobs, forks):
+		with helpers.log2str(levels = 'all'):
+			for job in jobs:
+				job.build()
+			r = Job.submitChunk(jobs, forks)
+		self.assertTrue(r)
+		self.assertEqual(path.isfile(path.join(jobs[0].dir, 'job.chunk')), len(jobs) > 1)
+		t0 = time()
+		while not all(path.isfile(job.rcfile) for job in jobs) and time() - t0 < 10:
+			sleep(.1)
+		for job in jobs:
+			self.assertEqual(job.pid, jobs[0].pid)
+			self.assertEqual(job.rc, 0)
+			self.assertEqual(helpers.readFile(job.outfile).strip(), str(job.index))
+
+	def dataProvider_testSubmitChunkSsh(self):
+		config = {'input': {}, 'exdir': None, 'cache': True, 'dirsig': False}
+		config['workdir']  = path.join(self.testdir, 'pSubmitChunkSsh', 'workdir')
+		config['proc']     = 'pSubmitChunkSsh'
+		config['procsize'] = 3
+		config['script']   = TemplateLiquid('echo {{job.index}}')
+		config['expect']   = TemplateLiquid('')
+		config['output']   = {}
+		config['runner']   = RunnerSsh
+		config['runnerOpts'] = {'sshRunner': {
+			'servers'   : ['server1', 'server2'],
+			'checkAlive': False,
+			'slots'     : 1,
+			'ssh'       : path.join(path.dirname(path.abspath(__file__)), 'mocks', 'ssh'),
+		}}
+		yield [Job(j, config) for j in range(3)],
+
+	def testSubmitChunkSsh(self, jobs):
+		RunnerSsh.LIVE_SERVERS = None
+		RunnerSsh.ASSIGNED.clear()
+		with helpers.log2str(levels = 'all'):
+			for job in jobs:
+				job.build()
+			# as the job manager does when dispatching the chunk
+			self.assertTrue(jobs[0].runner.reserve())
+			server = jobs[0].runner.servers[jobs[0].runner.taken]
+			self.assertTrue(Job.submitChunk(jobs, 2))
+		# the chunk runs on the slot reserved by the first job
+		self.assertEqual(RunnerSsh.ASSIGNED, {server: 1})
+		self.assertEqual(jobs[0].runner.server, server)
+		t0 = time()
+		while not all(path.isfile(job.rcfile) for job in jobs) and time() - t0 < 10:
+			sleep(.1)
+		for job in jobs:
+			self.assertEqual(job.rc, 0)
+			self.assertEqual(helpers.readFile(job.outfile).strip(), str(job.index))
+		jobs[0].runner.release()
+		self.assertEqual(RunnerSsh.ASSIGNED, {server: 0})
+
 	def dataProvider_testPoll(self):
 		class RunnerLocalNoRun(RunnerLocal):
 			def run(self):
@@ -2197,6 +2470,35 @@ class TestJob(testly.TestCase):
 		job.poll()
 		self.assertEqual(job.status, status)
 
+	def dataProvider_testCheckRunning(self):
+		config = {'input': {}, 'exdir': None, 'cache': True, 'dirsig': False}
+		config['workdir']  = path.join(self.testdir, 'pCheckRunning', 'workdir')
+		config['proc']     = 'pCheckRunning'
+		config['procsize'] = 2
+		config['script']   = TemplateLiquid('')
+		config['expect']   = TemplateLiquid('')
+		config['output']   = {}
+		config['rcs']      = [0]
+		config['echo']     = {'jobs': []}
+		config['runner']   = RunnerLocal
+		job = Job(0, config)
+		makedirs(job.dir)
+		helpers.writeFile(job.errfile)
+		helpers.writeFile(job.outfile)
+		yield job, True
+
+		job1 = Job(1, config)
+		makedirs(job1.dir)
+		helpers.writeFile(job1.errfile)
+		helpers.writeFile(job1.outfile)
+		helpers.writeFile(job1.rcfile, '1')
+		yield job1, False, Job.STATUS_INITIATED
+
+	def testCheckRunning(self, job, ret, status = Job.STATUS_RUNNING):
+		self.assertEqual(job.checkRunning(), ret)
+		# job not finished by checkRunning
+		self.assertEqual(job.status, status)
+
 	def dataProvider_testFlush(self):
 		config = {'input': {}, 'exdir': None, 'cache': True, 'dirsig': False}
 		config['workdir']  = path.join(self.testdir, 'pFlush', 'workdir')
@@ -3,8 +3,9 @@ from os import path, makedirs
 from shutil import rmtree
 from tempfile import gettempdir
 
-from pyppl import Proc
+from pyppl import Proc, Box, Job, logger
 from pyppl.jobmgr import Jobmgr
+from pyppl.utils.taskmgr import Lock
 
 # just high-level tests
 class TestJobmgr(testly.TestCase):
@@ -72,6 +73,144 @@ class TestJobmgr(testly.TestCase):
 		'''
 		p3.run()
 
+	def testJm5(self):
+		p4 = Proc()
+		p4.script  = 'echo 123'
+		p4.forks   = 2
+		p4.nthread = 2
+		p4.input   = {'a': list(range(5))}
+		p4.run()
+		# all submission slots are released
+		self.assertEqual(Jobmgr.INUSE, 0)
+
+	def testJmChunkRetry(self):
+		p6 = Proc()
+		p6.forks   = 2
+		p6.nthread = 2
+		p6.input   = {'a': [0, 1]}
+		p6.output  = 'b:file:out.txt'
+		p6.chunk   = {'size': 2, 'forks': 2}
+		p6.errhow  = 'retry'
+		p6.errntry = 3
+		p6.args.dir = path.join(self.testdir, 'testJmChunkRetry')
+		p6.ppldir  = p6.args.dir
+		makedirs(p6.args.dir)
+		# job #2 fails at the first try, while the chunk is still running job #1
+		p6.script  = '''
+		if [ {{i.a}} -eq 0 ]; then sleep 1; touch {{args.dir}}/chunk.end; echo 0 > {{o.b}}; exit 0; fi
+		if [ ! -e {{args.dir}}/tried ]; then touch {{args.dir}}/tried; exit 1; fi
+		if [ -e {{args.dir}}/chunk.end ]; then echo after > {{o.b}}; else echo before > {{o.b}}; fi
+		'''
+		p6.run()
+		# retried once the chunk exited
+		self.assertEqual(helpers.readFile(p6.jobs[1].output['b']['data']).strip(), 'after')
+
+	def testJmKillSsh(self):
+		from threading import Timer
+		from pyppl.runners import RunnerSsh
+		p7 = Proc()
+		p7.ppldir  = path.join(self.testdir, 'testJmKillSsh')
+		p7.forks   = 8
+		p7.nthread = 4
+		p7.input   = {'a': list(range(8))}
+		p7.script  = 'sleep 5'
+		p7.runner  = 'ssh'
+		p7.sshRunner = {
+			'servers': ['server1', 'server2'], 
+			'slots'  : 2, 
+			'ssh'    : path.join(path.dirname(path.abspath(__file__)), 'mocks', 'ssh')
+		}
+		RunnerSsh.LIVE_SERVERS = None
+		RunnerSsh.ASSIGNED.clear()
+		Timer(1, Jobmgr.killAll).start()
+		with helpers.log2str():
+			try:
+				p7.run()
+			except SystemExit:
+				pass
+		# the server slots of the jobs killed are given back
+		self.assertEqual(RunnerSsh.ASSIGNED, {'server1': 0, 'server2': 0})
+		self.assertEqual(Jobmgr.INUSE, 0)
+		RunnerSsh.LIVE_SERVERS = None
+
+	def testJmResources(self):
+		p5 = Proc()
+		# not cached as a whole by last run, whose jobs are not built
+		p5.ppldir    = path.join(self.testdir, 'testJmResources')
+		p5.script    = 'echo 123'
+		p5.forks     = 5
+		p5.nthread   = 2
+		p5.input     = {'a': [1, 2, 3, 4]}
+		p5.resources = {'cores': '{{i.a}}', 'mem': '1G'}
+		oRESOURCES = Jobmgr.RESOURCES
+		Jobmgr.RESOURCES = {'cores': 3, 'mem': 0}
+		p5.run()
+		Jobmgr.RESOURCES = oRESOURCES
+		self.assertEqual([job.resources for job in p5.jobs], [
+			{'cores': 1, 'mem': 1024}, 
+			{'cores': 2, 'mem': 1024}, 
+			{'cores': 3, 'mem': 1024}, 
+			{'cores': 4, 'mem': 1024}
+		])
+		# all resources are given back
+		self.assertEqual(Jobmgr.RESINUSE, {'cores': 0, 'mem': 0})
+
+	def testCanSubmit(self):
+		oRESOURCES, oSLOTS = Jobmgr.RESOURCES, Jobmgr.SLOTS
+		Jobmgr.RESOURCES, Jobmgr.SLOTS = {'cores': 4, 'mem': 1024}, 0
+		jm = Jobmgr.__new__(Jobmgr)
+		jm.jobs = [
+			Box(index = 0, resources = {'cores': 2, 'mem': 512}),
+			Box(index = 1, resources = {'cores': 3, 'mem': 0}),
+			Box(index = 2, resources = {'cores': 1, 'mem': 512}),
+			Box(index = 3, resources = {'cores': 8, 'mem': 0}),
+		]
+		jm.config   = {'forks': 3}
+		jm.inflight = set()
+		jm.taken    = {}
+		self.assertTrue(jm.canSubmit(0))
+		jm._take(0)
+		self.assertEqual(Jobmgr.RESINUSE, {'cores': 2, 'mem': 512})
+		# not enough cores
+		self.assertFalse(jm.canSubmit(1))
+		self.assertTrue(jm.canSubmit(2))
+		jm._take(2)
+		# not enough memory, though cores are enough
+		jm.jobs[2].resources = {'cores': 1, 'mem': 1}
+		self.assertFalse(jm.canSubmit(2))
+		jm._giveBack(0)
+		jm._giveBack(2)
+		self.assertEqual(Jobmgr.RESINUSE, {'cores': 0, 'mem': 0})
+		# more than the budget: takes the whole budget
+		self.assertTrue(jm.canSubmit(3))
+		self.assertEqual(jm._request(3), {'cores': 4, 'mem': 0})
+		Jobmgr.RESOURCES, Jobmgr.SLOTS = oRESOURCES, oSLOTS
+
+	def testProgressbar(self):
+		oPBAR_SIZE, oPBAR_FREQ = Jobmgr.PBAR_SIZE, Jobmgr.PBAR_FREQ
+		Jobmgr.PBAR_SIZE, Jobmgr.PBAR_FREQ = 5, 1
+		jm = Jobmgr.__new__(Jobmgr)
+		jm.jobs   = [Box(index = i, status = Job.STATUS_INITIATED) for i in range(9)]
+		jm.config = {'proc': 'pProgressbar'}
+		jm.lock   = Lock()
+		jm._initBar()
+		self.assertEqual(jm.jobcells, [[0], [0], [1], [1], [2], [2], [3], [3], [4]])
+		with helpers.log2str(levels = 'all') as (out, err):
+			jm.logger = logger.logger
+			jm.jobs[1].status = Job.STATUS_RUNNING
+			jm.progressbar(1)
+			jm.jobs[0].status = Job.STATUS_DONE
+			# throttled
+			jm.progressbar(0)
+			jm.jobs[8].status = Job.STATUS_ENDFAILED
+			jm.progressbar(8, force = True)
+		stderr = err.getvalue()
+		self.assertIn('[>    ] Done:   0.0% | Running: 1', stderr)
+		self.assertNotIn('Done:  11.1%', stderr)
+		self.assertIn('[>   X] Done:  22.2% | Running: 1', stderr)
+		self.assertEqual(jm.statuscount[Job.STATUS_INITIATED], 6)
+		Jobmgr.PBAR_SIZE, Jobmgr.PBAR_FREQ = oPBAR_SIZE, oPBAR_FREQ
+
 	
 if __name__ == '__main__':
 	testly.main(verbosity=2)
@@ -1,7 +1,7 @@
 import helpers, testly, json, sys
 import copy as pycopy
 
-from os import path, makedirs
+from os import path, makedirs, remove, utime
 from shutil import rmtree
 from tempfile import gettempdir
 from collections import OrderedDict
@@ -27,10 +27,13 @@ class TestProc(testly.TestCase):
 		yield 'notag', 'No description', None, {
 			# 'brings': {},
 			'channel': [],
+			'chunk': {},
 			'depends': [],
 			'echo': {},
+			'ended': None,
 			'expart': [],
 			'expect': None,
+			'finished': None,
 			'input': {},
 			'jobs': [],
 			'lock': None,
@@ -40,11 +43,13 @@ class TestProc(testly.TestCase):
 			'origin': 'p',
 			'procvars': {},
 			'rc': [0],
+			'resources': {},
 			'runner': 'local',
 			'script': None,
 			'sets': [],
 			'timer': None,
 			'size': 0,
+			'streaming': None,
 			'suffix': '',
 			'template': None,
 			'workdir': ''
@@ -57,10 +62,13 @@ class TestProc(testly.TestCase):
 			'cache': True,
 			'callback': None,
 			'callfront': None,
+			'chunk': 1,
 			'acache': False,
 			'depends': [],
 			'desc': 'No description',
 			'dirsig': True,
+			'sighash': False,
+			'sharedcache': '',
 			'echo': False,
 			'errhow': 'terminate',
 			'errntry': 3,
@@ -78,9 +86,11 @@ class TestProc(testly.TestCase):
 			'output': '',
 			'ppldir': path.realpath('./workdir'),
 			'rc': 0,
+			'resources': {'cores': 1, 'mem': 0},
 			'resume': '',
 			'runner': 'local',
 			'script': '',
+			'stream': False,
 			'tag': 'notag',
 			'template': '',
 			'tplenvs': Box(),
@@ -90,10 +100,13 @@ class TestProc(testly.TestCase):
 		yield 'atag', 'A different description', 'someId', {
 			# 'brings': {},
 			'channel': [],
+			'chunk': {},
 			'depends': [],
 			'echo': {},
+			'ended': None,
 			'expart': [],
 			'expect': None,
+			'finished': None,
 			'input': {},
 			'jobs': [],
 			'logs': {},
@@ -103,12 +116,14 @@ class TestProc(testly.TestCase):
 			'output': OrderedDict(),
 			'procvars': {},
 			'rc': [0],
+			'resources': {},
 			'lock': None,
 			'origin': 'someId',
 			'runner': 'local',
 			'script': None,
 			'sets': [],
 			'size': 0,
+			'streaming': None,
 			'suffix': '',
 			'template': None,
 			'timer': None,
@@ -122,10 +137,13 @@ class TestProc(testly.TestCase):
 			'cache': True,
 			'callback': None,
 			'callfront': None,
+			'chunk': 1,
 			'acache': False,
 			'depends': [],
 			'desc': 'A different description',
 			'dirsig': True,
+			'sighash': False,
+			'sharedcache': '',
 			'echo': False,
 			'errhow': 'terminate',
 			'errntry': 3,
@@ -143,9 +161,11 @@ class TestProc(testly.TestCase):
 			'output': '',
 			'ppldir': path.realpath('./workdir'),
 			'rc': 0,
+			'resources': {'cores': 1, 'mem': 0},
 			'resume': '',
 			'runner': 'local',
 			'script': '',
+			'stream': False,
 			'tag': 'atag',
 			'template': '',
 			'tplenvs': Box(),
@@ -168,7 +188,7 @@ class TestProc(testly.TestCase):
 			del config2['desc']
 			del config2['id']
 			p2 = Proc(tag, desc, id = config['id'], **config2)
-			props['sets'] = list(sorted(['runner', 'echo', 'depends', 'expect', 'callfront', 'script', 'cache', 'nthread', 'beforeCmd', 'template', 'rc', 'input', 'forks', 'acache', 'workdir', 'resume', 'exhow', 'args', 'exow', 'dirsig', 'ppldir', 'errhow', 'lang', 'tplenvs', 'exdir', 'expart', 'afterCmd', 'callback', 'aggr', 'output', 'errntry']))
+			props['sets'] = list(sorted(['runner', 'echo', 'depends', 'expect', 'callfront', 'script', 'cache', 'nthread', 'beforeCmd', 'template', 'rc', 'input', 'forks', 'acache', 'workdir', 'resume', 'exhow', 'args', 'exow', 'dirsig', 'ppldir', 'errhow', 'lang', 'tplenvs', 'exdir', 'expart', 'afterCmd', 'callback', 'aggr', 'output', 'errntry', 'stream', 'resources', 'chunk', 'sighash', 'sharedcache']))
 			p2.props['sets'] = list(sorted(p2.sets))
 			self.assertDictEqual(p2.props, props)
 			self.assertDictEqual(p2.config, config)
@@ -262,10 +282,13 @@ class TestProc(testly.TestCase):
 		yield pCopy, None, 'DESCRIPTION', None, {
 			# 'brings': {},
 			'channel': [],
+			'chunk': {},
 			'depends': [],
 			'echo': {},
+			'ended': None,
 			'expart': [],
 			'expect': None,
+			'finished': None,
 			'lock': None,
 			'origin': 'pCopy',
 			'input': {},
@@ -275,10 +298,12 @@ class TestProc(testly.TestCase):
 			'output': OrderedDict(),
 			'procvars': {},
 			'rc': [0],
+			'resources': {},
 			'runner': 'local',
 			'script': None,
 			'sets': ['workdir'],
 			'size': 0,
+			'streaming': None,
 			'suffix': '',
 			'template': None,
 			'timer': None,
@@ -293,10 +318,13 @@ class TestProc(testly.TestCase):
 			'cache': True,
 			'callback': None,
 			'callfront': None,
+			'chunk': 1,
 			'acache': False,
 			'depends': [],
 			'desc': 'No description.',
 			'dirsig': True,
+			'sighash': False,
+			'sharedcache': '',
 			'echo': False,
 			'errhow': 'terminate',
 			'errntry': 3,
@@ -313,9 +341,11 @@ class TestProc(testly.TestCase):
 			'output': '',
 			'ppldir': path.realpath('./workdir'),
 			'rc': 0,
+			'resources': {'cores': 1, 'mem': 0},
 			'resume': '',
 			'runner': 'local',
 			'script': '',
+			'stream': False,
 			'tag': 'notag',
 			'template': '',
 			'tplenvs': Box(),
@@ -323,10 +353,13 @@ class TestProc(testly.TestCase):
 		}, {
 			# 'brings': {},
 			'channel': [],
+			'chunk': {},
 			'depends': [],
 			'echo': {},
+			'ended': None,
 			'expart': [],
 			'expect': None,
+			'finished': None,
 			'lock': None,
 			'origin': 'pCopy',
 			'input': {},
@@ -336,11 +369,13 @@ class TestProc(testly.TestCase):
 			'output': OrderedDict(),
 			'procvars': {},
 			'rc': [0],
+			'resources': {},
 			'runner': 'local',
 			'script': None,
 			'sets': ['workdir'],
 			'timer': None,
 			'size': 0,
+			'streaming': None,
 			'suffix': '',
 			'template': None,
 			'workdir': ''
@@ -353,10 +388,13 @@ class TestProc(testly.TestCase):
 			'cache': True,
 			'callback': None,
 			'callfront': None,
+			'chunk': 1,
 			'acache': False,
 			'depends': [],
 			'desc': 'DESCRIPTION',
 			'dirsig': True,
+			'sighash': False,
+			'sharedcache': '',
 			'echo': False,
 			'errhow': 'terminate',
 			'errntry': 3,
@@ -374,9 +412,11 @@ class TestProc(testly.TestCase):
 			'output': '',
 			'ppldir': path.realpath('./workdir'),
 			'rc': 0,
+			'resources': {'cores': 1, 'mem': 0},
 			'resume': '',
 			'runner': 'local',
 			'script': '',
+			'stream': False,
 			'tag': 'notag',
 			'template': '',
 			'tplenvs': Box(),
@@ -588,6 +628,108 @@ class TestProc(testly.TestCase):
 			for err in errs:
 				self.assertIn(err, stderr)
 				
+	def dataProvider_testStream(self):
+		pStream = Proc()
+		pStream.props['size'] = 3
+		pStream.props['jobs'] = [
+			Box(status = Job.STATUS_DONE, data = Box(o = OrderedDict([('b', 'b%s' % i), ('c', 'c%s' % i)])))
+			for i in range(3)
+		]
+		pStream.jobs[1].status = Job.STATUS_ENDFAILED
+		pStream1 = Proc()
+		pStream1.depends = pStream
+		pStream1.input   = 'x, y'
+		pStream1.stream  = True
+		yield pStream, pStream1, [2, 1, 0], [2, 0], {'x': ['b0', '', 'b2'], 'y': ['c0', '', 'c2']}
+
+		pStream2 = Proc()
+		pStream2.props['size'] = 2
+		pStream2.props['jobs'] = [
+			Box(status = Job.STATUS_ENDFAILED, data = Box(o = OrderedDict([('b', 'b%s' % i)])))
+			for i in range(2)
+		]
+		pStream2.errhow = 'ignore'
+		pStream3 = Proc()
+		pStream3.depends = pStream2
+		pStream3.input   = 'x:file, y:files'
+		pStream3.stream  = True
+		yield pStream2, pStream3, [1], [1], {'x': ['', 'b1'], 'y': [[], []]}
+
+	def testStream(self, dep, p, ended, indices, data):
+		dep.props['ended'] = []
+		for index in ended:
+			dep._jobEnded(index)
+		self.assertEqual(dep.ended, indices)
+		p._buildInput()
+		self.assertEqual(p.size, dep.size)
+		self.assertEqual(p._streamJobs(0), indices)
+		for key, val in data.items():
+			self.assertEqual(p.input[key]['data'], val)
+		self.assertEqual(p.streaming['fed'], len(indices))
+		# no more jobs ended
+		self.assertEqual(p._streamJobs(.1), [])
+		dep.props['finished'] = True
+		self.assertIsNone(p._streamJobs(0))
+		dep.props['finished'] = False
+		self.assertRaises(ProcInputError, p._buildInput)
+
+	def dataProvider_testWaitDepends(self):
+		# jobs running
+		pWaitDepends = Proc()
+		pWaitDepends.props['ended'] = []
+		pWaitDepends1 = Proc()
+		pWaitDepends1.depends = pWaitDepends
+		pWaitDepends1.input   = 'x'
+		yield pWaitDepends, pWaitDepends1, True
+		# finished before (run one after another)
+		pWaitDepends2 = Proc()
+		pWaitDepends2.props['ended']    = [0]
+		pWaitDepends2.props['finished'] = True
+		pWaitDepends3 = Proc()
+		pWaitDepends3.depends = pWaitDepends2
+		pWaitDepends3.input   = 'x'
+		yield pWaitDepends2, pWaitDepends3, False
+		# callback may change the output channel, wait until it finishes
+		pWaitDepends4 = Proc()
+		pWaitDepends4.props['ended'] = []
+		pWaitDepends4.callback = lambda p: None
+		pWaitDepends5 = Proc()
+		pWaitDepends5.depends = pWaitDepends4
+		pWaitDepends5.input   = 'x'
+		yield pWaitDepends4, pWaitDepends5, False, True
+		# failed
+		pWaitDepends6 = Proc()
+		pWaitDepends6.props['ended']    = []
+		pWaitDepends6.props['finished'] = False
+		pWaitDepends7 = Proc()
+		pWaitDepends7.depends = pWaitDepends6
+		pWaitDepends7.input   = 'x'
+		yield pWaitDepends6, pWaitDepends7, ProcInputError
+
+	def testWaitDepends(self, dep, p, ret, wait = False):
+		from threading import Thread
+		if ret is ProcInputError:
+			self.assertRaises(ProcInputError, p._waitDepends)
+			return
+		if not wait:
+			self.assertEqual(p._waitDepends(), ret)
+		p.stream = True
+		thread = Thread(target = p._buildInput)
+		thread.daemon = True
+		thread.start()
+		thread.join(.5)
+		self.assertEqual(thread.is_alive(), wait)
+		if wait:
+			# the channel is built when the process finishes
+			with dep.endcond:
+				dep.props['channel']  = Channel.create([1, 2])
+				dep.props['finished'] = True
+				dep.endcond.notify_all()
+			thread.join(5)
+			self.assertFalse(thread.is_alive())
+			self.assertEqual(p.input['x']['data'], [1, 2])
+		self.assertEqual(p.streaming is not None, ret)
+
 	def dataProvider_testBuildProcVars(self):
 		pBuildProcVars = Proc()
 		pBuildProcVars.ppldir = self.testdir
@@ -1040,6 +1182,70 @@ class TestProc(testly.TestCase):
 			p._tidyBeforeRun()
 			self.assertIsNone(p._runJobs())
 		
+	def dataProvider_testFingerprint(self):
+		pFingerprint = Proc()
+		pFingerprint.ppldir = self.testdir
+		pFingerprint.input  = {'a': [1,2]}
+		pFingerprint.output = 'b:{{i.a}}, c:file:{{i.a}}.txt'
+		yield pFingerprint, True
+		pFingerprint1 = Proc()
+		pFingerprint1.ppldir = self.testdir
+		pFingerprint1.input  = {'a': [1,2]}
+		pFingerprint1.cache  = False
+		yield pFingerprint1, False
+
+	def testFingerprint(self, p, cachable):
+		with helpers.log2str():
+			p._tidyBeforeRun()
+		fingerprint = p._fingerprint()
+		if not cachable:
+			self.assertIsNone(fingerprint)
+			self.assertFalse(p._isCached(fingerprint))
+			return
+		self.assertEqual(p._fingerprint(), fingerprint)
+		self.assertFalse(p._isCached(fingerprint))
+		for job in p.jobs:
+			job._prepInput()
+			job._prepOutput()
+			helpers.writeFile(job.output['c']['data'])
+		# not all jobs done
+		p.jobs[0].status = Job.STATUS_DONE
+		p.jobs[1].status = Job.STATUS_ENDFAILED
+		p._saveFingerprint(fingerprint)
+		self.assertFalse(path.isfile(path.join(p.workdir, 'proc.fingerprint')))
+		p.jobs[1].status = Job.STATUS_DONECACHED
+		p._saveFingerprint(fingerprint)
+		self.assertTrue(path.isfile(path.join(p.workdir, 'proc.fingerprint')))
+
+		# next run
+		p._buildJobs()
+		self.assertFalse(p._isCached('somethingelse'))
+		with helpers.log2str():
+			self.assertTrue(p._isCached(fingerprint))
+		self.assertEqual([job.status for job in p.jobs], [Job.STATUS_DONECACHED] * 2)
+		self.assertEqual(p.jobs[1].data.o.b, '2')
+		self.assertEqual(p.jobs[1].output['c'], {'type': 'file', 'data': path.join(p.jobs[1].outdir, '2.txt')})
+		# output file modified
+		p._buildJobs()
+		outfile = path.join(p.jobs[0].outdir, '1.txt')
+		mtime   = int(path.getmtime(outfile)) + 10
+		utime(outfile, (mtime, mtime))
+		self.assertFalse(p._isCached(fingerprint))
+		self.assertEqual([job.status for job in p.jobs], [Job.STATUS_INITIATED] * 2)
+		# output file removed
+		p._buildJobs()
+		remove(path.join(p.jobs[1].outdir, '2.txt'))
+		self.assertFalse(p._isCached(fingerprint))
+		# template environments changed
+		p.envs.word = 'hello'
+		fingerprint2 = p._fingerprint()
+		self.assertNotEqual(fingerprint2, fingerprint)
+		p.envs.word = lambda: 'world'
+		self.assertNotEqual(p._fingerprint(), fingerprint2)
+		# input data changed
+		p.input['a']['data'][0] = 3
+		self.assertNotEqual(p._fingerprint(), fingerprint)
+
 	def dataProvider_testRun(self):
 		pRun = Proc()
 		pRun.ppldir = self.testdir
@@ -466,6 +466,92 @@ class TestProcTree(testly.TestCase):
 			ProcTree.NODES[hr].ran = True
 		self.assertIs(pt.getNextToRun(), out)
 
+	def dataProvider_testGetReadyToRun(self):
+		proc_testGetReadyToRun0 = Proc()
+		proc_testGetReadyToRun1 = Proc()
+		proc_testGetReadyToRun2 = Proc()
+		proc_testGetReadyToRun3 = Proc()
+		proc_testGetReadyToRun4 = Proc()
+		proc_testGetReadyToRun5 = Proc()
+		proc_testGetReadyToRun2.depends = proc_testGetReadyToRun0, proc_testGetReadyToRun1
+		proc_testGetReadyToRun3.depends = proc_testGetReadyToRun2, proc_testGetReadyToRun4
+		proc_testGetReadyToRun4.depends = proc_testGetReadyToRun2
+		proc_testGetReadyToRun5.depends = proc_testGetReadyToRun1
+		"""
+			proc0
+				\
+		proc1 -> proc2 -> proc3
+			\        \    /
+			  proc5  proc4
+		"""
+		ps = [proc_testGetReadyToRun0, proc_testGetReadyToRun1, proc_testGetReadyToRun2, proc_testGetReadyToRun3, proc_testGetReadyToRun4, proc_testGetReadyToRun5]
+		
+		yield ps, [proc_testGetReadyToRun0, proc_testGetReadyToRun1], [], None, [proc_testGetReadyToRun0, proc_testGetReadyToRun1]
+		yield ps, [proc_testGetReadyToRun0, proc_testGetReadyToRun1], [], 1, [proc_testGetReadyToRun0]
+		# proc0 is still running
+		yield ps, [proc_testGetReadyToRun0, proc_testGetReadyToRun1], [proc_testGetReadyToRun1], None, [proc_testGetReadyToRun0, proc_testGetReadyToRun5]
+		yield ps, [proc_testGetReadyToRun0, proc_testGetReadyToRun1], [proc_testGetReadyToRun0, proc_testGetReadyToRun1], None, [proc_testGetReadyToRun2, proc_testGetReadyToRun5]
+		yield ps, [proc_testGetReadyToRun0, proc_testGetReadyToRun1], [proc_testGetReadyToRun0, proc_testGetReadyToRun1, proc_testGetReadyToRun2, proc_testGetReadyToRun5], None, [proc_testGetReadyToRun4]
+
+		# stream mode: started with the process it depends on
+		proc_testGetReadyToRun6 = Proc()
+		proc_testGetReadyToRun7 = Proc()
+		proc_testGetReadyToRun7.depends = proc_testGetReadyToRun6
+		proc_testGetReadyToRun7.stream  = True
+		yield [proc_testGetReadyToRun6, proc_testGetReadyToRun7], [proc_testGetReadyToRun6], [], None, [proc_testGetReadyToRun6, proc_testGetReadyToRun7]
+
+	def testGetReadyToRun(self, procs, starts, done, limit, outs):
+		for p in procs:
+			ProcTree.register(p)
+		pt = ProcTree()
+		pt.setStarts(starts)
+		for proc in done:
+			ProcTree.NODES[proc].ran = True
+			ProcTree.setDone(proc)
+			self.assertTrue(ProcTree.NODES[proc].done)
+		readys = pt.getReadyToRun(limit)
+		self.assertCountEqual(readys, outs)
+		for proc in readys:
+			self.assertTrue(ProcTree.NODES[proc].ran)
+		# they won't be returned again
+		self.assertNotIn(readys[0], pt.getReadyToRun())
+
+	def dataProvider_testSetCritical(self):
+		proc_testSetCritical0 = Proc()
+		proc_testSetCritical1 = Proc()
+		proc_testSetCritical2 = Proc()
+		proc_testSetCritical3 = Proc()
+		proc_testSetCritical4 = Proc()
+		proc_testSetCritical5 = Proc()
+		proc_testSetCritical2.depends = proc_testSetCritical0, proc_testSetCritical1
+		proc_testSetCritical3.depends = proc_testSetCritical2, proc_testSetCritical4
+		proc_testSetCritical4.depends = proc_testSetCritical2
+		proc_testSetCritical5.depends = proc_testSetCritical1
+		"""
+			proc0
+				\
+		proc1 -> proc2 -> proc3
+			\        \    /
+			  proc5  proc4
+		"""
+		ps = [proc_testSetCritical0, proc_testSetCritical1, proc_testSetCritical2, proc_testSetCritical3, proc_testSetCritical4, proc_testSetCritical5]
+		# proc4 unknown: average of the others (2.2)
+		times = {proc_testSetCritical0: 1, proc_testSetCritical1: 2, proc_testSetCritical2: 3, proc_testSetCritical3: 4, proc_testSetCritical5: 1}
+		yield ps, [proc_testSetCritical0, proc_testSetCritical1], times, [10.2, 11.2, 9.2, 4, 6.2, 1], [proc_testSetCritical1]
+		# nothing known
+		yield ps, [proc_testSetCritical0, proc_testSetCritical1], {}, [4, 4, 3, 1, 2, 1], [proc_testSetCritical0]
+
+	def testSetCritical(self, procs, starts, times, criticals, outs):
+		for p in procs:
+			ProcTree.register(p)
+		pt = ProcTree()
+		pt.setStarts(starts)
+		pt.setCritical(lambda proc: times.get(proc))
+		for proc, critical in zip(procs, criticals):
+			self.assertAlmostEqual(ProcTree.NODES[proc].critical, critical)
+		# the one on the longest critical path first
+		self.assertEqual(pt.getReadyToRun(1), outs)
+
 	def dataProvider_testUnranProcs(self):
 		proc_testUnranProcs0 = Proc()
 		proc_testUnranProcs1 = Proc()
@@ -1,12 +1,13 @@
 import helpers, testly, unittest, sys
 
-from os import path, getcwd, makedirs, remove
+from os import path, getcwd, makedirs, remove, environ
 from shutil import rmtree
 from tempfile import gettempdir
 from hashlib import md5
 from collections import OrderedDict
 from subprocess import list2cmdline
 from pyppl import Job, utils, runners
+from pyppl.runners.runner import _LocalSupervisor
 from pyppl.runners import Runner, RunnerLocal, RunnerDry, RunnerSsh, RunnerSge, RunnerSlurm
 from pyppl.template import TemplateLiquid
 from pyppl.exception import RunnerSshError
@@ -82,6 +83,23 @@ class TestRunner(testly.TestCase):
 		r = Runner(job)
 		self.assertEqual(r.submit().cmd, list2cmdline(cmd))
 
+	def dataProvider_testNextPoll(self):
+		job = createJob(path.join(self.testdir, 'pTestNextPoll'))
+		yield RunnerLocal, job, [.5, .75, 1.125]
+		yield RunnerSge, job, [2, 4, 8, 16, 32, 64, 128, 256, 300, 300]
+
+		job1 = createJob(path.join(self.testdir, 'pTestNextPoll1'), config = {
+			'runnerOpts': {'localRunner': {'poll.min': 1, 'poll.max': 5, 'poll.backoff': 2}}
+		})
+		yield RunnerLocal, job1, [1, 2, 4, 5, 5]
+
+	def testNextPoll(self, runner, job, intervals):
+		r = runner(job)
+		interval = None
+		for expect in intervals:
+			interval = r.nextPoll(interval)
+			self.assertEqual(interval, expect)
+
 	# Covered by job.run
 	# def dataProvider_testRun(self):
 	# 	job = createJob(path.join(self.testdir, 'pTestRun'), config = {
@@ -191,6 +209,53 @@ class TestRunnerLocal(testly.TestCase):
 		with open(r.script, 'r') as f:
 			self.assertEqual(f.read().strip(), content)
 
+	def dataProvider_testSubmit(self):
+		job = createJob(
+			path.join(self.testdir, 'pTestSubmit'), 
+			config = {'_script': '\necho 1\necho 2 >&2\nexit 3'}
+		)
+		yield job, '1', '2', '3'
+
+	def testSubmit(self, job, stdout, stderr, rc):
+		from time import sleep
+		r = RunnerLocal(job)
+		exited = []
+		r.onexit = exited.append
+		c = r.submit()
+		self.assertEqual(c.rc, 0)
+		self.assertEqual(c.cmd, list2cmdline(['/bin/sh', '-c', _LocalSupervisor.WRAPPER, job.rcfile, job.script + '.local']))
+		while not exited:
+			sleep(.1)
+		self.assertEqual(exited, [job.index])
+		self.assertFalse(r.isRunning())
+		self.assertEqual(helpers.readFile(job.pidfile, str), str(c.pid))
+		self.assertEqual(helpers.readFile(job.outfile, str).strip(), stdout)
+		self.assertEqual(helpers.readFile(job.errfile, str).strip(), stderr)
+		self.assertEqual(helpers.readFile(job.rcfile, str), rc)
+
+	def dataProvider_testWrapper(self):
+		job = createJob(
+			path.join(self.testdir, 'pTestWrapper'), 
+			config = {'_script': '\nexit 3'}
+		)
+		yield job, '3'
+
+	def testWrapper(self, job, rc):
+		# the rc file is written by the job shell itself, no supervisor needed
+		utils.cmd.run(['/bin/sh', '-c', _LocalSupervisor.WRAPPER, job.rcfile] + utils.safefs.SafeFs._chmodX(job.script))
+		self.assertEqual(helpers.readFile(job.rcfile, str), rc)
+		r = RunnerLocal(job)
+		exited = []
+		r.onexit = exited.append
+		# don't overwrite it
+		_LocalSupervisor._end(r, -9)
+		self.assertEqual(helpers.readFile(job.rcfile, str), rc)
+		self.assertEqual(exited, [job.index])
+		# killed before the shell writes it
+		open(job.rcfile, 'w').close()
+		_LocalSupervisor._end(r, -9)
+		self.assertEqual(helpers.readFile(job.rcfile, str), '-9')
+
 class TestRunnerDry(testly.TestCase):
 
 	def setUpMeta(self):
@@ -222,7 +287,9 @@ class TestRunnerSsh(testly.TestCase):
 		self.testdir = path.join(gettempdir(), 'PyPPL_unittest', 'TestRunnerSsh')
 		if path.exists(self.testdir):
 			rmtree(self.testdir)
-		makedirs(self.testdir)		
+		makedirs(self.testdir)
+		# the connections made by mocks/ssh
+		environ['PYPPL_MOCK_SSH_CONNS'] = path.join(self.testdir, 'ssh.conns.txt')
 	
 	def dataProvider_testIsServerAlive(self):
 		yield 'noalive', None, False
@@ -394,6 +461,7 @@ class TestRunnerSsh(testly.TestCase):
 	def testSubmit(self, job, cmd, rc = 0):
 		RunnerSsh.INTERVAL = .1
 		RunnerSsh.LIVE_SERVERS = None
+		RunnerSsh.ASSIGNED.clear()
 		if job.config['runnerOpts']['sshRunner']['checkAlive'] and not RunnerSsh.isServerAlive('localhost', timeout = 1):
 			self.assertRaises(RunnerSshError, RunnerSsh, job)
 		else:
@@ -422,6 +490,7 @@ class TestRunnerSsh(testly.TestCase):
 	def testKill(self, job):
 		RunnerSsh.INTERVAL = .1
 		RunnerSsh.LIVE_SERVERS = None
+		RunnerSsh.ASSIGNED.clear()
 		r = RunnerSsh(job)
 		r.sshcmd = [path.join(__here__, 'mocks', 'ssh')]
 		self.assertFalse(r.isRunning())
@@ -430,6 +499,165 @@ class TestRunnerSsh(testly.TestCase):
 		r.kill()
 		self.assertFalse(r.isRunning())
 
+	def dataProvider_testConnect(self):
+		for i, persist in enumerate((600, 0)):
+			job = createJob(
+				path.join(self.testdir, 'pTestConnect'),
+				index  = i,
+				config = {
+					'runnerOpts': {'sshRunner': {
+						'servers'       : ['localhost'],
+						'checkAlive'    : False,
+						'ssh'           : path.join(__here__, 'mocks', 'ssh'),
+						'controlPersist': persist,
+					}},
+					'_script': 'sleep 3'
+				}
+			)
+			yield job, persist, ['localhost master'] if persist else ['localhost direct'] * 5
+
+	def testConnect(self, job, persist, conns):
+		RunnerSsh.LIVE_SERVERS = None
+		RunnerSsh.MASTERS.clear()
+		connfile = environ['PYPPL_MOCK_SSH_CONNS']
+		helpers.writeFile(connfile, '')
+		r = RunnerSsh(job)
+		ctrlpath = r.ctrlpath
+		if ctrlpath and path.exists(ctrlpath):
+			remove(ctrlpath)
+		self.assertEqual(r.persist, persist)
+		self.assertEqual(bool(ctrlpath), bool(persist))
+		self.assertEqual('ControlPath=%s' % ctrlpath in r.sshcmd, bool(persist))
+		self.assertEqual(r._connect(), bool(persist))
+		self.assertEqual(bool(ctrlpath) and path.exists(ctrlpath), bool(persist))
+		# submit (ls and the job), check and kill the job
+		r.job.pid = r.submit().pid
+		self.assertTrue(r.isRunning())
+		r.kill()
+		# connected only once with the master
+		self.assertEqual(helpers.readFile(connfile, str).splitlines(), conns)
+		if ctrlpath and path.exists(ctrlpath):
+			remove(ctrlpath)
+
+	def dataProvider_testReconnect(self):
+		job = createJob(
+			path.join(self.testdir, 'pTestReconnect'),
+			config = {
+				'runnerOpts': {'sshRunner': {
+					'servers'   : ['localhost'],
+					'checkAlive': False,
+					'ssh'       : path.join(__here__, 'mocks', 'ssh'),
+				}},
+			}
+		)
+		# the master closed after controlPersist seconds idle: socket removed
+		yield job, False
+		# the master died: socket left
+		yield job, True
+
+	def testReconnect(self, job, died):
+		RunnerSsh.LIVE_SERVERS = None
+		RunnerSsh.MASTERS.clear()
+		connfile = environ['PYPPL_MOCK_SSH_CONNS']
+		helpers.writeFile(connfile, '')
+		r = RunnerSsh(job)
+		if path.exists(r.ctrlpath):
+			remove(r.ctrlpath)
+		self.assertTrue(r._connect())
+		if died:
+			helpers.writeFile(r.ctrlpath, 'dead')
+			# not checked until MASTERCHECK seconds later
+			masterCheck, RunnerSsh.MASTERCHECK = RunnerSsh.MASTERCHECK, 0
+		else:
+			remove(r.ctrlpath)
+		try:
+			r.job.pid = 1
+			self.assertTrue(r.isRunning())
+			self.assertTrue(r.isRunning())
+		finally:
+			if died:
+				RunnerSsh.MASTERCHECK = masterCheck
+		# connected again with a master, the commands go through it
+		self.assertEqual(helpers.readFile(connfile, str).splitlines(), ['localhost master'] * 2)
+		remove(r.ctrlpath)
+
+	def dataProvider_testAssign(self):
+		jobs = [createJob(
+			path.join(self.testdir, 'pTestAssign'),
+			index  = i,
+			config = {
+				'runnerOpts': {'sshRunner': {
+					'servers'   : ['server1', 'server2', 'server3'],
+					'checkAlive': False,
+					'slots'     : [1, 2, 0],
+					'ssh'       : path.join(__here__, 'mocks', 'ssh'),
+				}},
+			}
+		) for i in range(6)]
+		# least loaded, servers with the same load are used in turn
+		yield jobs, ['server1', 'server2', 'server3', 'server2', 'server3', 'server1']
+
+	def testAssign(self, jobs, servers):
+		RunnerSsh.LIVE_SERVERS = None
+		RunnerSsh.ASSIGNED.clear()
+		runners = [RunnerSsh(job) for job in jobs]
+		self.assertEqual(runners[0].slots, [1, 2, 0])
+		for i, runner in enumerate(runners):
+			if i == len(runners) - 1:
+				# job 0 completed, server1 is free
+				runners[0].release()
+			runner._assign()
+			self.assertEqual(runner.server, servers[i])
+			self.assertEqual(runner.sshcmd[2], servers[i])
+			self.assertIn('# run on server: %s' % servers[i], helpers.readFile(runner.script, str))
+		self.assertEqual(RunnerSsh.ASSIGNED, {'server1': 1, 'server2': 2, 'server3': 2})
+		runners[1].release()
+		# released once
+		runners[1].release()
+		self.assertEqual(RunnerSsh.ASSIGNED['server2'], 1)
+		RunnerSsh.ASSIGNED.clear()
+
+	def dataProvider_testAssignWait(self):
+		jobs = [createJob(
+			path.join(self.testdir, 'pTestAssignWait'),
+			index  = i,
+			config = {
+				'runnerOpts': {'sshRunner': {
+					'servers'   : ['server1'],
+					'checkAlive': False,
+					'slots'     : 1,
+					'ssh'       : path.join(__here__, 'mocks', 'ssh'),
+				}},
+			}
+		) for i in range(2)]
+		yield jobs,
+
+	def testAssignWait(self, jobs):
+		from threading import Thread
+		RunnerSsh.LIVE_SERVERS = None
+		RunnerSsh.ASSIGNED.clear()
+		runners = [RunnerSsh(job) for job in jobs]
+		self.assertTrue(runners[0].reserve())
+		# reserved once
+		self.assertTrue(runners[0].reserve())
+		runners[0]._assign()
+		self.assertEqual(RunnerSsh.ASSIGNED, {'server1': 1})
+		# server1 is full
+		self.assertFalse(runners[1].reserve())
+		thread = Thread(target = runners[1]._assign)
+		thread.daemon = True
+		thread.start()
+		thread.join(.5)
+		self.assertTrue(thread.is_alive())
+		self.assertIsNone(runners[1].taken)
+		# woken up once the slot is released
+		runners[0].release()
+		thread.join(5)
+		self.assertFalse(thread.is_alive())
+		self.assertEqual(runners[1].taken, 0)
+		self.assertEqual(RunnerSsh.ASSIGNED, {'server1': 1})
+		RunnerSsh.ASSIGNED.clear()
+
 
 class TestRunnerSge(testly.TestCase):
 
@@ -617,6 +845,121 @@ class TestRunnerSge(testly.TestCase):
 		r.kill()
 		self.assertFalse(r.isRunning())
 
+	def dataProvider_testQueryRunning(self):
+		job0 = createJob(
+			path.join(self.testdir, 'pTestQueryRunning'),
+			config = {
+				'runnerOpts': {'sgeRunner': {
+					'qsub'      : path.join(__here__, 'mocks', 'qsub'),
+					'qstat'     : path.join(__here__, 'mocks', 'qstat'),
+					'qdel'      : path.join(__here__, 'mocks', 'qdel'),
+				}},
+				'_script': 'sleep 3'
+			}
+		)
+		job1 = createJob(
+			path.join(self.testdir, 'pTestQueryRunning'),
+			index = 1,
+			config = {
+				'runnerOpts': {'sgeRunner': {
+					'qsub'      : path.join(__here__, 'mocks', 'qsub'),
+					'qstat'     : path.join(__here__, 'mocks', 'qstat'),
+					'qdel'      : path.join(__here__, 'mocks', 'qdel'),
+				}},
+				'_script': 'sleep 3'
+			}
+		)
+		yield job0, job1
+
+	def testQueryRunning(self, job0, job1):
+		RunnerSge.INTERVAL = 10
+		r0 = RunnerSge(job0)
+		r1 = RunnerSge(job1)
+		r0.submit()
+		r1.submit()
+		Runner.QUERIES.clear()
+		alive = r0.queryRunning()
+		self.assertIn(job0.pid, alive)
+		self.assertIn(job1.pid, alive)
+		# cached and shared by the jobs
+		self.assertIs(r1.queryRunning(), alive)
+		# updated by kill
+		r1.kill()
+		self.assertTrue(r0.isRunning())
+		self.assertFalse(r1.isRunning())
+		r0.kill()
+		self.assertNotIn(job0.pid, r0.queryRunning())
+		# batch query failed
+		r0.commands['qstat'] = path.join(__here__, 'mocks', '_notexist_')
+		self.assertIsNone(r0.queryRunning())
+		RunnerSge.INTERVAL = 5
+
+	def dataProvider_testSubmitArray(self):
+		jobs = [createJob(
+			path.join(self.testdir, 'pTestSubmitArray'),
+			index = i,
+			config = {
+				'runnerOpts': {'sgeRunner': {
+					'array'     : 10,
+					'sge.q'     : 'queue',
+					'qsub'      : path.join(__here__, 'mocks', 'qsub'),
+					'qstat'     : path.join(__here__, 'mocks', 'qstat'),
+					'qdel'      : path.join(__here__, 'mocks', 'qdel'),
+				}},
+				'_script': 'sleep 3'
+			}
+		) for i in range(3)]
+		yield jobs, 
+
+	def testSubmitArray(self, jobs):
+		RunnerSge.INTERVAL = .1
+		runners = [RunnerSge(job) for job in jobs]
+		self.assertEqual(runners[0].array, 10)
+		self.assertEqual(runners[0].directives, ['#$ -q queue', '#$ -cwd'])
+		c = RunnerSge.submitArray(runners)
+		self.assertEqual(c.rc, 0)
+		script = path.join(path.dirname(jobs[0].dir), 'job.array.1.sge')
+		helpers.assertTextEqual(self, helpers.readFile(script, str), '\n'.join([
+			'#!/usr/bin/env bash',
+			'#$ -N pTestRunner.notag.suffix.1',
+			'#$ -t 1-3',
+			'#$ -o /dev/null',
+			'#$ -e /dev/null',
+			'#$ -q queue',
+			'#$ -cwd',
+			'',
+			'case $SGE_TASK_ID in',
+		] + ['\t%s) bash %s >%s 2>%s;;' % (i + 1, job.script + '.sge', job.outfile, job.errfile) for i, job in enumerate(jobs)] + [
+			'esac',
+			''
+		]))
+		pid = jobs[0].pid.split('.')[0]
+		self.assertEqual([job.pid for job in jobs], [pid + '.1', pid + '.2', pid + '.3'])
+		self.assertTrue(all(r.isRunning() for r in runners))
+		runners[1].kill()
+		self.assertTrue(runners[0].isRunning())
+		self.assertFalse(runners[1].isRunning())
+		runners[0].kill()
+		runners[2].kill()
+		RunnerSge.INTERVAL = 5
+
+	def dataProvider_testParseQuery(self):
+		job = createJob(path.join(self.testdir, 'pTestParseQuery'))
+		yield job, '', set()
+		yield job, '\n'.join([
+			'job-ID  prior   name       user         state submit/start at     queue   slots ja-task-ID',
+			'-----------------------------------------------------------------------------------------',
+			'6556149 0.50500 pSort.nota user         r     05/01/2019 10:00:00 all.q@node  1',
+			'6556150 0.50500 pSort.nota user         r     05/01/2019 10:00:00 all.q@node  1 1',
+			'6556150 0.50500 pSort.nota user         qw    05/01/2019 10:00:00             1 2-6:2',
+			'6556151 0.50500 pSort.nota user         qw    05/01/2019 10:00:00             1',
+			'6556152 0.50500 pSort.nota user         qw    05/01/2019 10:00:00             1 3,5',
+		]), set(['6556149', '6556150', '6556150.1', '6556150.2', '6556150.4', '6556150.6', '6556151', '6556152', '6556152.3', '6556152.5'])
+
+	def testParseQuery(self, job, output, ret):
+		r = RunnerSge(job)
+		self.assertEqual(r._parseQuery(output), ret)
+
 class TestRunnerSlurm(testly.TestCase):
 
 	def setUpMeta(self):
@@ -817,6 +1160,100 @@ class TestRunnerSlurm(testly.TestCase):
 		r.kill()
 		self.assertFalse(r.isRunning())
 
+	def dataProvider_testQueryRunning(self):
+		job0 = createJob(
+			path.join(self.testdir, 'pTestQueryRunning'),
+			config = {
+				'runnerOpts': {'slurmRunner': {
+					'sbatch': path.join(__here__, 'mocks', 'sbatch'),
+					'srun': path.join(__here__, 'mocks', 'srun'),
+					'squeue': path.join(__here__, 'mocks', 'squeue'),
+					'scancel': path.join(__here__, 'mocks', 'scancel')
+				}},
+				'_script': 'sleep 3'
+			}
+		)
+		yield job0, 
+
+	def testQueryRunning(self, job):
+		RunnerSlurm.INTERVAL = 10
+		r = RunnerSlurm(job)
+		r.submit()
+		Runner.QUERIES.clear()
+		alive = r.queryRunning()
+		self.assertIn(job.pid, alive)
+		self.assertIs(r.queryRunning(), alive)
+		self.assertTrue(r.isRunning())
+		r.kill()
+		self.assertFalse(r.isRunning())
+		RunnerSlurm.INTERVAL = .1
+		Runner.QUERIES.clear()
+		self.assertNotIn(job.pid, r.queryRunning())
+		RunnerSlurm.INTERVAL = 5
+
+	def dataProvider_testSubmitArray(self):
+		jobs = [createJob(
+			path.join(self.testdir, 'pTestSubmitArray'),
+			index = i,
+			config = {
+				'runnerOpts': {'slurmRunner': {
+					'array'  : 10,
+					'slurm.p': 'partition',
+					'sbatch' : path.join(__here__, 'mocks', 'sbatch'),
+					'srun'   : path.join(__here__, 'mocks', 'srun'),
+					'squeue' : path.join(__here__, 'mocks', 'squeue'),
+					'scancel': path.join(__here__, 'mocks', 'scancel')
+				}},
+				'_script': 'sleep 3'
+			}
+		) for i in range(2)]
+		yield jobs, 
+
+	def testSubmitArray(self, jobs):
+		RunnerSlurm.INTERVAL = .1
+		runners = [RunnerSlurm(job) for job in jobs]
+		self.assertEqual(runners[0].array, 10)
+		self.assertEqual(runners[0].directives, ['#SBATCH -p partition'])
+		c = RunnerSlurm.submitArray(runners)
+		self.assertEqual(c.rc, 0)
+		script = path.join(path.dirname(jobs[0].dir), 'job.array.1.slurm')
+		helpers.assertTextEqual(self, helpers.readFile(script, str), '\n'.join([
+			'#!/usr/bin/env bash',
+			'#SBATCH -J pTestRunner.notag.suffix.1',
+			'#SBATCH --array=1-2',
+			'#SBATCH -o /dev/null',
+			'#SBATCH -e /dev/null',
+			'#SBATCH -p partition',
+			'',
+			'case $SLURM_ARRAY_TASK_ID in',
+		] + ['\t%s) bash %s >%s 2>%s;;' % (i + 1, job.script + '.slurm', job.outfile, job.errfile) for i, job in enumerate(jobs)] + [
+			'esac',
+			''
+		]))
+		pid = jobs[0].pid.split('_')[0]
+		self.assertEqual([job.pid for job in jobs], [pid + '_1', pid + '_2'])
+		self.assertTrue(all(r.isRunning() for r in runners))
+		runners[0].kill()
+		self.assertFalse(runners[0].isRunning())
+		self.assertTrue(runners[1].isRunning())
+		runners[1].kill()
+		RunnerSlurm.INTERVAL = 5
+
+	def dataProvider_testParseQuery(self):
+		job = createJob(path.join(self.testdir, 'pTestParseQuery'))
+		yield job, '', set()
+		yield job, '\n'.join([
+			'1823334668',
+			'1823334669_1',
+			'1823334669_[2-4%2]',
+			'1823334670_[1,3-4]',
+		]), set(['1823334668', '1823334669_1', '1823334669_[2-4%2]', '1823334669_2', '1823334669_3', 
+			'1823334669_4', '1823334670_[1,3-4]', '1823334670_1', '1823334670_3', '1823334670_4'])
+
+	def testParseQuery(self, job, output, ret):
+		r = RunnerSlurm(job)
+		self.assertEqual(r._parseQuery(output), ret)
+
 
 if __name__ == '__main__':
 	clearMockQueue()
@@ -5,11 +5,13 @@ import gzip, tarfile
 import filelock
 from glob import glob
 from copy import deepcopy
-from os import path, symlink, remove, rename, makedirs, utime, X_OK, access, W_OK, getcwd, chdir, getpid
+from os import path, symlink, remove, rename, makedirs, utime, X_OK, access, W_OK, getcwd, chdir, getpid, stat, listdir, chmod
 from pyppl import utils
-from pyppl.utils import Box, uid, ps
+from pyppl.utils import Box, uid, ps, fsnotify, filehash
 from pyppl.utils.cmd import Cmd
 from pyppl.utils.safefs import SafeFs
+from pyppl.utils.sigstore import SigStore, FileSigs
+from pyppl.utils.sharedcache import SharedCache
 from time import time, sleep
 from shutil import copyfile, rmtree, copyfileobj
 from subprocess import Popen, list2cmdline
@@ -768,11 +770,98 @@ class TestSafeFs(testly.TestCase):
 		"""
 		yield filesig5, [filesig5, t], False
 
-	def testFilesig(self, f, sig, dirsig = True):
+		"""
+		#7: Content hash
+		"""
+		hashes = filehash.HashCache()
+		yield filesig1, [filesig1, filehash._hasher(b'').hexdigest()], True, hashes
+
+		"""
+		#8: Content hash, but don't go into the dir
+		"""
+		yield filesig5, [filesig5, t], False, hashes
+
+	def testFilesig(self, f, sig, dirsig = True, hashes = None):
 		sfs = SafeFs(f)
-		self.assertEqual(sfs.filesig(dirsig), sig)
+		self.assertEqual(sfs.filesig(dirsig, hashes), sig)
 		self.assertFalse(any([l.is_locked for l in sfs.locks]))
 
+	def dataProvider_testDirmtime(self):
+		"""
+		#0: Not exists
+		"""
+		yield '/a/b/pathnotexists', 0
+
+		"""
+		#1: Newest file deep in one of the subdirectories
+		"""
+		dirmtime1 = path.join(self.testdir, 'testDirmtime1.dir')
+		t = int(time()) - 100
+		for i in range(6):
+			subdir = path.join(dirmtime1, 'sub%s' % i, 'subsub')
+			makedirs(subdir)
+			helpers.writeFile(path.join(subdir, 'a.txt'))
+			utime(path.join(subdir, 'a.txt'), (t + i, t + i))
+			utime(subdir, (t, t))
+			utime(path.dirname(subdir), (t, t))
+		utime(dirmtime1, (t, t))
+		yield dirmtime1, t + 5
+
+		"""
+		#2: Links to the parent directory (cycle) and dead links
+		"""
+		dirmtime2 = path.join(self.testdir, 'testDirmtime2.dir')
+		makedirs(path.join(dirmtime2, 'sub'))
+		helpers.writeFile(path.join(dirmtime2, 'sub', 'a.txt'))
+		symlink(dirmtime2, path.join(dirmtime2, 'sub', 'parent'))
+		symlink('/a/b/pathnotexists', path.join(dirmtime2, 'dead'))
+		utime(path.join(dirmtime2, 'sub', 'a.txt'), (t + 20, t + 20))
+		utime(path.join(dirmtime2, 'sub'), (t, t))
+		utime(dirmtime2, (t, t))
+		yield dirmtime2, t + 20
+
+	def testDirmtime(self, dirpath, mtime):
+		SafeFs._dirmtimeForget()
+		self.assertEqual(SafeFs._dirmtime(dirpath), mtime)
+
+	def dataProvider_testDirmtimeForget(self):
+		"""
+		#0: Forget the directory itself
+		"""
+		dirmtime1 = path.join(self.testdir, 'testDirmtimeForget1.dir')
+		makedirs(path.join(dirmtime1, 'sub'))
+		yield dirmtime1, path.join(dirmtime1, 'sub', 'a.txt'), dirmtime1
+
+		"""
+		#1: Forget a subdirectory, the parent directories forgot as well
+		"""
+		dirmtime2 = path.join(self.testdir, 'testDirmtimeForget2.dir')
+		makedirs(path.join(dirmtime2, 'sub'))
+		yield dirmtime2, path.join(dirmtime2, 'sub', 'a.txt'), path.join(dirmtime2, 'sub')
+
+		"""
+		#2: Forget all
+		"""
+		dirmtime3 = path.join(self.testdir, 'testDirmtimeForget3.dir')
+		makedirs(path.join(dirmtime3, 'sub'))
+		yield dirmtime3, path.join(dirmtime3, 'sub', 'a.txt'), None
+
+	def testDirmtimeForget(self, dirpath, newfile, forget):
+		t = int(time()) - 100
+		utime(path.join(dirpath, 'sub'), (t, t))
+		utime(dirpath, (t, t))
+		SafeFs._dirmtimeForget()
+		self.assertEqual(SafeFs._dirmtime(dirpath), t)
+		helpers.writeFile(newfile)
+		utime(newfile, (t + 10, t + 10))
+		# memorized
+		self.assertEqual(SafeFs._dirmtime(dirpath), t)
+		# another directory not forgot
+		SafeFs._dirmtimeForget(path.join(self.testdir, 'pathnotexists'))
+		self.assertEqual(SafeFs._dirmtime(dirpath), t)
+		SafeFs._dirmtimeForget(forget)
+		self.assertGreaterEqual(SafeFs._dirmtime(dirpath), t + 10)
+
 	def dataProvider_testChmodX(self):
 		"""
 		#0: plain file, can be made as executable
@@ -890,6 +979,21 @@ class TestUtils (testly.TestCase):
 
 	def testBriefPath(self, p, cutoff, keep, result):
 		self.assertEqual(utils.briefPath(p, cutoff, keep), result)
+
+	def dataProvider_testParseMem(self):
+		yield 512, 512
+		yield '512', 512
+		yield '4G', 4096
+		yield '1.5gb', 1536
+		yield '2048K', 2
+		yield '1T', 1024 * 1024
+		yield '4X', None, ValueError
+
+	def testParseMem(self, mem, mb, exception = None):
+		if exception:
+			self.assertRaises(exception, utils.parseMem, mem)
+		else:
+			self.assertEqual(utils.parseMem(mem), mb)
 		
 	def dataProvider_testBox(self):
 		box = Box()
@@ -2088,6 +2192,268 @@ class TestPs(testly.TestCase):
 		c3 = Cmd('ps -p ' + str(c.pid)).pipe('grep -v defunct').pipe('grep -v ")$"').run()
 		self.assertNotIn(str(c.pid), c3.stdout)
 
+	def testZombie(self):
+		from time import sleep
+		c = Cmd('sleep .1').run(bg = True)
+		sleep(.5)
+		# exited but not reaped
+		self.assertFalse(ps.exists(c.pid))
+		self.assertEqual(c.p.wait(), 0)
+
+	def testKilltree(self):
+		from time import sleep
+		c = Cmd(['bash', '-c', 'sleep 10 & sleep 10; wait']).run(bg = True)
+		sleep(.2)
+		cids = ps.children(c.pid)
+		self.assertEqual(len(cids), 2)
+		self.assertEqual(ps.child(c.pid), cids)
+		# waits for them to exit
+		ps.killtree(c.pid)
+		self.assertFalse(ps.exists(c.pid))
+		self.assertFalse(any(ps.exists(int(cid)) for cid in cids))
+		c.p.wait()
+
+
+class TestFsnotify(testly.TestCase):
+
+	def setUpMeta(self):
+		self.testdir = path.join(gettempdir(), 'PyPPL_unittest', 'TestFsnotify')
+		if path.exists(self.testdir):
+			rmtree(self.testdir)
+		makedirs(self.testdir)
+
+	def dataProvider_testFstype(self):
+		mounts = [('/mnt/nfs/data', 'nfs4'), ('/mnt/nfs', 'nfs'), ('/', 'ext4')]
+		yield '/mnt/nfs/data/1', mounts, 'nfs4'
+		yield '/mnt/nfs/data', mounts, 'nfs4'
+		yield '/mnt/nfsdata', mounts, 'ext4'
+		yield '/mnt/nfs/1', mounts, 'nfs'
+		yield '/mnt/nfs/1', [], None
+
+	def testFstype(self, dirpath, mounts, fstype):
+		self.assertEqual(fsnotify.fstype(dirpath, mounts), fstype)
+
+	def testWatcher(self):
+		watcher = fsnotify.Watcher.shared()
+		if not watcher: # pragma: no cover
+			self.skipTest('inotify is not available.')
+		written = []
+		self.assertTrue(watcher.watch(self.testdir, written.append))
+		helpers.writeFile(path.join(self.testdir, 'job.rc'), '0')
+		t0 = time()
+		while not written and time() - t0 < 3:
+			sleep(.05)
+		self.assertEqual(written, ['job.rc'])
+		watcher.unwatch(self.testdir)
+		helpers.writeFile(path.join(self.testdir, 'job.rc'), '1')
+		sleep(.2)
+		self.assertEqual(written, ['job.rc'])
+		# not watched on network file systems
+		mounts = watcher.mounts
+		watcher.mounts = [(self.testdir, 'nfs')]
+		self.assertFalse(watcher.watch(self.testdir, written.append))
+		watcher.mounts = mounts
+
+
+class TestFilehash(testly.TestCase):
+
+	def setUpMeta(self):
+		self.testdir = path.join(gettempdir(), 'PyPPL_unittest', 'TestFilehash')
+		if path.exists(self.testdir):
+			rmtree(self.testdir)
+		makedirs(self.testdir)
+
+	def dataProvider_testFilehash(self):
+		file1 = path.join(self.testdir, 'testFilehash1.txt')
+		helpers.writeFile(file1, 'a')
+		yield file1, filehash._hasher(b'a').hexdigest()
+		yield path.join(self.testdir, 'testFilehash-notexists.txt'), None
+
+		dir1 = path.join(self.testdir, 'testFilehash2.dir')
+		makedirs(path.join(dir1, 'sub'))
+		helpers.writeFile(path.join(dir1, 'b.txt'), 'b')
+		helpers.writeFile(path.join(dir1, 'sub', 'c.txt'), 'c')
+		subhash = filehash._hasher(('c.txt:%s\n' % filehash._hasher(b'c').hexdigest()).encode()).hexdigest()
+		yield dir1, filehash._hasher((
+			'b.txt:%s\nsub:%s\n' % (filehash._hasher(b'b').hexdigest(), subhash)
+		).encode()).hexdigest()
+
+	def testFilehash(self, filepath, digest):
+		self.assertEqual(filehash.HashCache().filehash(filepath), digest)
+
+	def testPersistent(self):
+		dbfile = path.join(self.testdir, 'testPersistent.db')
+		file1  = path.join(self.testdir, 'testPersistent.txt')
+		helpers.writeFile(file1, 'a')
+		digest = filehash._hasher(b'a').hexdigest()
+		hashes = filehash.HashCache.get(dbfile)
+		self.assertIs(filehash.HashCache.get(dbfile), hashes)
+		self.assertEqual(hashes.filehash(file1), digest)
+		if not hashes.db: # pragma: no cover
+			self.skipTest('sqlite3 is not available.')
+		# the hash is read from the database by the next session, without reading the file
+		key = filehash._statkey(stat(file1))
+		hashes.db.execute('UPDATE hashes SET hash = ? WHERE dev = ? AND ino = ? AND size = ? AND mtime = ?', ('fake', ) + key)
+		hashes.db.commit()
+		self.assertEqual(filehash.HashCache(dbfile).filehash(file1), 'fake')
+		# touched, hashed again, with the same content hash
+		t = int(time())
+		utime(file1, (t + 10, t + 10))
+		self.assertEqual(filehash.HashCache(dbfile).filehash(file1), digest)
+
+
+class TestSigStore(testly.TestCase):
+
+	def setUpMeta(self):
+		self.testdir = path.join(gettempdir(), 'PyPPL_unittest', 'TestSigStore')
+		if path.exists(self.testdir):
+			rmtree(self.testdir)
+		makedirs(self.testdir)
+
+	def testSigStore(self):
+		sigfile = path.join(self.testdir, 'testSigStore.cache')
+		store = SigStore(sigfile)
+		self.assertIsNone(store.get(0))
+		store.set(0, {'script': ['a', 1]})
+		store.set(1, {'script': ['b', 1]})
+		store.set(0, {'script': ['a', 2]})
+		self.assertEqual(store.get(0), {'script': ['a', 2]})
+		store.close()
+		self.assertEqual(len(helpers.readFile(sigfile).splitlines()), 3)
+		# partially written line
+		with open(sigfile, 'a') as f:
+			f.write('{"index": 2, "sig": {"scr')
+		store = SigStore(sigfile)
+		self.assertEqual(store.get(0), {'script': ['a', 2]})
+		self.assertEqual(store.get(1), {'script': ['b', 1]})
+		self.assertIsNone(store.get(2))
+		store.set(2, {'script': ['c', 1]})
+		store.close()
+		self.assertEqual(SigStore(sigfile).get(2), {'script': ['c', 1]})
+
+	def testCompact(self):
+		sigfile = path.join(self.testdir, 'testCompact.cache')
+		store = SigStore(sigfile)
+		for i in range(5):
+			store.set(0, {'script': ['a', i]})
+		store.close()
+		self.assertEqual(len(helpers.readFile(sigfile).splitlines()), 5)
+		self.assertEqual(SigStore(sigfile).get(0), {'script': ['a', 4]})
+		self.assertEqual(len(helpers.readFile(sigfile).splitlines()), 1)
+
+	def testFiles(self):
+		sigfile = path.join(self.testdir, 'testFiles.cache')
+		store = SigStore(sigfile)
+		store.set(0, {
+			'script': ['job.script', 1],
+			'i': {'var': {'a': 1}, 'file': {'infile': ['a.txt', 1]}, 'files': {'infiles': [['b.txt', 1], ['a.txt', 1]]}},
+			'o': {'var': {'b': 2}, 'file': {'outfile': ['c.txt', 1]}, 'dir': {'outdir': ['d.dir', 1]}}
+		})
+		store.set(1, {
+			'script': ['job.script', 1],
+			'i': {'var': {}, 'file': {'infile': ['', 0]}, 'files': {}},
+			'o': {'var': {}, 'file': {}, 'dir': {}}
+		})
+		# not a signature
+		store.set(2, '')
+		self.assertEqual(store.files(), set(['a.txt', 'b.txt', 'c.txt', 'd.dir']))
+		store.close()
+
+class TestFileSigs(testly.TestCase):
+
+	def setUpMeta(self):
+		self.testdir = path.join(gettempdir(), 'PyPPL_unittest', 'TestFileSigs')
+		if path.exists(self.testdir):
+			rmtree(self.testdir)
+		makedirs(self.testdir)
+
+	def dataProvider_testGet(self):
+		file1 = path.join(self.testdir, 'testGet1.txt')
+		helpers.writeFile(file1)
+		yield file1, [file1, int(path.getmtime(file1))]
+		yield path.join(self.testdir, 'testGet2.txt'), False
+
+	def testGet(self, filepath, sig):
+		filesigs = FileSigs(dirsig = False)
+		self.assertEqual(filesigs.get(filepath), sig)
+		# calculated once
+		if sig:
+			utime(filepath, (sig[1] + 10, sig[1] + 10))
+		self.assertEqual(filesigs.get(filepath), sig)
+
+	def testPrefetch(self):
+		filepaths = [path.join(self.testdir, 'testPrefetch%s.txt' % i) for i in range(10)]
+		for filepath in filepaths[:8]:
+			helpers.writeFile(filepath)
+		filesigs = FileSigs()
+		filesigs.prefetch(filepaths, nthread = 3)
+		self.assertEqual(len(filesigs.sigs), 10)
+		for filepath in filepaths[:8]:
+			self.assertEqual(filesigs.sigs[filepath], [filepath, int(path.getmtime(filepath))])
+		self.assertFalse(filesigs.sigs[filepaths[8]])
+		filesigs.prefetch([])
+		self.assertEqual(len(filesigs.sigs), 10)
+
+class TestSharedCache(testly.TestCase):
+
+	def setUpMeta(self):
+		self.testdir = path.join(gettempdir(), 'PyPPL_unittest', 'TestSharedCache')
+		if path.exists(self.testdir):
+			rmtree(self.testdir)
+		makedirs(self.testdir)
+
+	def dataProvider_testStoreFetch(self):
+		testdir = path.join(self.testdir, 'testStoreFetch')
+		outdir1 = path.join(testdir, 'outdir1')
+		outdir2 = path.join(testdir, 'outdir2')
+		makedirs(path.join(outdir1, 'b.dir'))
+		makedirs(outdir2)
+		helpers.writeFile(path.join(outdir1, 'a.txt'), 'a')
+		helpers.writeFile(path.join(outdir1, 'b.dir', 'b.txt'), 'b')
+		# an existing output file to be overwritten
+		helpers.writeFile(path.join(outdir2, 'a.txt'), 'x')
+		yield path.join(testdir, 'cache'), outdir1, outdir2, ['a.txt', 'b.dir']
+
+	def testStoreFetch(self, cachedir, outdir1, outdir2, outfiles):
+		cache = SharedCache(cachedir)
+		self.assertTrue(path.isdir(cachedir))
+		self.assertEqual(cache.entry('abcdef'), path.join(cachedir, 'ab', 'abcdef'))
+		self.assertFalse(cache.fetch('abcdef', outdir2, [path.join(outdir2, outfile) for outfile in outfiles]))
+
+		self.assertTrue(cache.store('abcdef', outdir1, [path.join(outdir1, outfile) for outfile in outfiles]))
+		self.assertEqual(helpers.readFile(path.join(cachedir, 'ab', 'abcdef', '0')), 'a')
+		self.assertEqual(helpers.readFile(path.join(cachedir, 'ab', 'abcdef', '1', 'b.txt')), 'b')
+		# copied and read-only, not to be changed by the jobs
+		self.assertEqual(stat(path.join(outdir1, 'a.txt')).st_nlink, 1)
+		self.assertTrue(stat(path.join(outdir1, 'a.txt')).st_mode & 0o200)
+		self.assertFalse(stat(path.join(cachedir, 'ab', 'abcdef', '0')).st_mode & 0o222)
+		self.assertFalse(stat(path.join(cachedir, 'ab', 'abcdef', '1', 'b.txt')).st_mode & 0o222)
+		# no temporary directories left
+		self.assertEqual(listdir(path.join(cachedir, 'ab')), ['abcdef'])
+		# not overwritten
+		self.assertFalse(cache.store('abcdef', outdir2, [path.join(outdir2, outfile) for outfile in outfiles]))
+
+		# different outputs
+		self.assertFalse(cache.fetch('abcdef', outdir2, [path.join(outdir2, 'a.txt')]))
+		self.assertEqual(helpers.readFile(path.join(outdir2, 'a.txt')), 'x')
+		self.assertTrue(cache.fetch('abcdef', outdir2, [path.join(outdir2, outfile) for outfile in outfiles]))
+		self.assertEqual(helpers.readFile(path.join(outdir2, 'a.txt')), 'a')
+		self.assertEqual(helpers.readFile(path.join(outdir2, 'b.dir', 'b.txt')), 'b')
+		# hard-linked from the cache
+		self.assertEqual(stat(path.join(outdir2, 'a.txt')).st_nlink, 2)
+
+		# edited in place anyway, the entry is dropped
+		chmod(path.join(outdir2, 'a.txt'), 0o644)
+		with open(path.join(outdir2, 'a.txt'), 'a') as fa:
+			fa.write('x')
+		self.assertFalse(cache.fetch('abcdef', outdir2, [path.join(outdir2, outfile) for outfile in outfiles]))
+		self.assertFalse(path.exists(path.join(cachedir, 'ab', 'abcdef')))
+		self.assertEqual(listdir(path.join(cachedir, 'ab')), [])
+		# and stored again
+		self.assertTrue(cache.store('abcdef', outdir1, [path.join(outdir1, outfile) for outfile in outfiles]))
+		self.assertTrue(cache.fetch('abcdef', outdir2, [path.join(outdir2, outfile) for outfile in outfiles]))
+		self.assertEqual(helpers.readFile(path.join(outdir2, 'a.txt')), 'a')
+
 
 if __name__ == '__main__':
 	testly.main(verbosity=2, failfast = True)